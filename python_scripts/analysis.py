@@ -0,0 +1,307 @@
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import geometry
+import luminance
+
+#Region statistics for single frames or stacks of frames.
+#The region masks of each frame shape are built once and cached. Statistics are calculated from a histogram of
+#each region and channel, so averages, white fractions and relative luminance all come from the same integer
+#counts. Cam_Image uses these kernels for each frame, so batch and per-frame results are identical.
+
+#The inner region is the fisheye circle of the active geometry (see geometry.py)
+#Margin around the inner region which is excluded from the outer region
+MARGIN = 100
+CORNER_RADIUS = 200
+
+#Pixels with values above this are counted as saturated
+SATURATION_THRESHOLD = 250
+
+#Number of frames of a stack read and processed at once
+CHUNK_SIZE = 4
+
+REGIONS = ["inner", "outer", "corner"]
+#Regions which receive no direct light, so their averages measure the dark signal
+DARK_REGIONS = ["outer", "corner"]
+
+
+def centre_mask(shape:tuple[int], centre:tuple[int], radius:int) -> np.ndarray:
+    """Create a boolean mask which is True inside a circle
+
+    Args:
+        shape (tuple[int]): Shape (height, width) of the frame
+        centre (tuple[int]): The centre (x, y) of the circle
+        radius (int): Radius of the circle
+
+    Returns:
+        np.ndarray: Boolean mask of shape (height, width)
+    """
+    height, width = shape[:2]
+    mask = Image.new('L', (width, height), 0)
+    draw = ImageDraw.Draw(mask)
+    x, y = centre
+    draw.ellipse((x-radius, y-radius, x+radius, y+radius), fill=255)
+    return np.asarray(mask) == 255
+
+
+def corner_mask(shape:tuple[int], radius:int) -> np.ndarray:
+    """Create a boolean mask which is True inside a circle of the set radius centred on each corner
+
+    Args:
+        shape (tuple[int]): Shape (height, width) of the frame
+        radius (int): Radius of the corner circles
+
+    Returns:
+        np.ndarray: Boolean mask of shape (height, width)
+    """
+    height, width = shape[:2]
+    mask = Image.new("L", (width, height), color="black")
+    draw = ImageDraw.Draw(mask)
+    draw.ellipse((-radius, -radius, radius, radius), fill="white")
+    draw.ellipse((width - radius, -radius, width + radius, radius), fill="white")
+    draw.ellipse((-radius, height - radius, radius, height + radius), fill="white")
+    draw.ellipse((width - radius, height - radius, width + radius, height + radius), fill="white")
+    return np.asarray(mask) == 255
+
+
+class Region_Masks:
+
+    def __init__(self, shape:tuple[int], centre:tuple[int], radius:int, margin:int=MARGIN, corner_radius:int=CORNER_RADIUS) -> None:
+        """Masks of the inner, outer and corner regions of a frame shape, and the flat index of the pixels in each.
+        Use get_region_masks() to share them between frames.
+
+        Args:
+            shape (tuple[int]): Shape (height, width) of the frames
+            centre (tuple[int]): Centre (x, y) of the inner region
+            radius (int): Radius of the inner region
+            margin (int, optional): Margin around the inner region excluded from the outer region. Defaults to MARGIN.
+            corner_radius (int, optional): Radius of the corner regions. Defaults to CORNER_RADIUS.
+        """
+        self.shape = tuple(shape[:2])
+        self.masks = {"inner": centre_mask(self.shape, centre, radius),
+                      "outer": np.invert(centre_mask(self.shape, centre, radius+margin)),
+                      "corner": corner_mask(self.shape, corner_radius)}
+        self.indices = {region: np.flatnonzero(mask) for region, mask in self.masks.items()}
+        for array in [*self.masks.values(), *self.indices.values()]:
+            array.setflags(write=False)
+
+
+def get_region_masks(shape:tuple[int], centre:tuple[int]|None=None, radius:int|None=None, margin:int=MARGIN, corner_radius:int=CORNER_RADIUS) -> Region_Masks:
+    """Get the region masks for a frame shape, built once for each geometry and kept in memory
+
+    Args:
+        shape (tuple[int]): Shape (height, width) of the frames
+        centre (tuple[int] | None, optional): Centre (x, y) of the inner region. Defaults to None (the active geometry).
+        radius (int | None, optional): Radius of the inner region. Defaults to None (the active geometry).
+
+    Returns:
+        Region_Masks: Region masks
+    """
+    active = geometry.get_geometry()
+    centre = active.centre if centre is None else centre
+    radius = active.radius if radius is None else radius
+    return _region_masks(tuple(shape[:2]), tuple(centre), int(radius), margin, corner_radius)
+
+
+@lru_cache(maxsize=8)
+def _region_masks(shape:tuple[int], centre:tuple[int], radius:int, margin:int, corner_radius:int) -> Region_Masks:
+    return Region_Masks(shape, centre, radius, margin, corner_radius)
+
+
+def region_channel_means(frame:np.ndarray, format:str="Mono8", regions:list[str]=DARK_REGIONS, masks:Region_Masks|None=None) -> dict[str, list[float]]:
+    """Mean of each colour channel of a raw frame of any type (e.g. a float frame before it is clipped) in some regions.
+    For BayerRG8 frames each channel is the mean of the pixels of its colour filter (the two green filters together).
+
+    Args:
+        frame (np.ndarray): Raw frame of shape (height, width)
+        format (str, optional): Pixel format of the frame. Defaults to "Mono8".
+        regions (list[str], optional): Regions. Defaults to DARK_REGIONS.
+        masks (Region_Masks | None, optional): Region masks. Defaults to None (get_region_masks() for the frame shape).
+
+    Returns:
+        dict[str, list[float]]: Mean of each channel in each region, rounded to 3 decimal places
+    """
+    if masks is None:
+        masks = get_region_masks(frame.shape[:2])
+    if format == "BayerRG8":
+        #RGGB: red at (0, 0), green at (0, 1) and (1, 0), blue at (1, 1)
+        even, odd = slice(0, None, 2), slice(1, None, 2)
+        phases = [(0, (even, even)), (1, (even, odd)), (1, (odd, even)), (2, (odd, odd))]
+        channels = 3
+    else:
+        phases = [(0, (slice(None), slice(None)))]
+        channels = 1
+
+    means = {}
+    for region in regions:
+        sums = np.zeros(channels)
+        counts = np.zeros(channels)
+        for channel, phase in phases:
+            values = frame[phase][masks.masks[region][phase]]
+            sums[channel] += values.sum(dtype=np.float64)
+            counts[channel] += values.size
+        means[region] = np.round(sums / np.maximum(counts, 1), 3).tolist()
+    return means
+
+
+def region_histograms(frames:np.ndarray, index:np.ndarray) -> np.ndarray:
+    """Count the pixels with each value in a region of each frame, for each channel
+
+    Args:
+        frames (np.ndarray): uint8 frames of shape (N, height, width) or (N, height, width, channels)
+        index (np.ndarray): Flat index of the pixels in the region
+
+    Returns:
+        np.ndarray: Counts of shape (N, channels, 256)
+    """
+    count = frames.shape[0]
+    channels = 1 if frames.ndim == 3 else frames.shape[3]
+    pixels = frames.reshape(count, -1, channels)[:, index]
+    histograms = np.empty((count, channels, 256), dtype=np.int64)
+    for frame in range(count):
+        for channel in range(channels):
+            histograms[frame, channel] = np.bincount(pixels[frame, :, channel], minlength=256)
+    return histograms
+
+
+def histogram_means(histograms:np.ndarray) -> np.ndarray:
+    """Mean pixel value from histograms (see region_histograms), rounded to 3 decimal places
+
+    Args:
+        histograms (np.ndarray): Counts of shape (..., 256)
+
+    Returns:
+        np.ndarray: Means of shape (...)
+    """
+    sums = histograms @ np.arange(256, dtype=np.int64)
+    return np.round(sums / histograms.sum(axis=-1), 3)
+
+
+def histogram_white_fractions(histograms:np.ndarray, threshold:int=SATURATION_THRESHOLD) -> np.ndarray:
+    """Fraction of pixels above the threshold from histograms (see region_histograms), over all channels
+
+    Args:
+        histograms (np.ndarray): Counts of shape (N, channels, 256)
+        threshold (int, optional): Pixel values above this are counted as saturated. Defaults to SATURATION_THRESHOLD.
+
+    Returns:
+        np.ndarray: White fraction of each frame, shape (N,)
+    """
+    return histograms[..., threshold+1:].sum(axis=(-2, -1)) / histograms.sum(axis=(-2, -1))
+
+
+def histogram_relative_luminance(histograms:np.ndarray) -> np.ndarray:
+    """Relative luminance of each frame from RGB histograms (see region_histograms). The mean linear value
+    of each channel is the dot product of its histogram with the sRGB transfer lookup table.
+
+    Args:
+        histograms (np.ndarray): Counts of shape (N, 3, 256)
+
+    Returns:
+        np.ndarray: Relative luminance of each frame, shape (N,)
+    """
+    mean_lin = (histograms @ luminance.transfer_lut(8)) / histograms.sum(axis=-1)
+    return mean_lin @ luminance.LUMINANCE_WEIGHTS
+
+
+def analyse_stack(raw:np.ndarray, format:str="Mono8", processed:np.ndarray|None=None, integration_time:float|np.ndarray|None=None,
+                  gain:float|np.ndarray|None=None, masks:Region_Masks|None=None, chunk_size:int=CHUNK_SIZE,
+                  threshold:int=SATURATION_THRESHOLD, histograms:bool=False) -> dict:
+    """Calculate the region statistics of a stack of frames, as Cam_Image does for a single frame.
+    The stack is processed chunk_size frames at a time, so it can be a memory-mapped array larger than memory.
+
+    Args:
+        raw (np.ndarray): Raw uint8 frames of shape (N, height, width)
+        format (str, optional): Pixel format of the frames ("Mono8" or "BayerRG8"). Defaults to "Mono8".
+        processed (np.ndarray | None, optional): Demosaiced frames of shape (N, height, width, 3) for BayerRG8 frames.
+        Defaults to None (for BayerRG8, each chunk is demosaiced with cam_image.debayer).
+        integration_time (float | np.ndarray | None, optional): Integration time(s) in microseconds, for unscaled absolute luminance. Defaults to None.
+        gain (float | np.ndarray | None, optional): Gain(s) in dB, for unscaled absolute luminance. Defaults to None.
+        masks (Region_Masks | None, optional): Region masks. Defaults to None (get_region_masks() for the frame shape).
+        chunk_size (int, optional): Number of frames processed at once. Defaults to CHUNK_SIZE.
+        threshold (int, optional): Pixel values above this are counted as saturated. Defaults to SATURATION_THRESHOLD.
+        histograms (bool, optional): Also return the histograms the statistics are calculated from. Defaults to False.
+
+    Returns:
+        dict: Arrays of length N: "[region]_fraction_white", "[region]_avgs" (shape (N, channels)), "relative_luminance",
+        "unscaled_absolute_luminance" if integration_time and gain are given, and if histograms is True,
+        "raw_histograms" (uint32, shape (N, regions, 256)) and "channel_histograms" (uint32, shape (N, regions, channels, 256))
+    """
+    count = raw.shape[0]
+    if masks is None:
+        masks = get_region_masks(raw.shape[1:3])
+    channels = 3 if format == "BayerRG8" else 1
+
+    results = {"relative_luminance": np.empty(count)}
+    for region in REGIONS:
+        results[f"{region}_fraction_white"] = np.empty(count)
+        results[f"{region}_avgs"] = np.empty((count, channels))
+    if histograms:
+        results["raw_histograms"] = np.empty((count, len(REGIONS), 256), dtype=np.uint32)
+        results["channel_histograms"] = np.empty((count, len(REGIONS), channels, 256), dtype=np.uint32)
+
+    for start in range(0, count, chunk_size):
+        end = min(start + chunk_size, count)
+        raw_chunk = np.asarray(raw[start:end])
+        if format == "BayerRG8":
+            if processed is not None:
+                processed_chunk = np.asarray(processed[start:end])
+            else:
+                #Imported here as cam_image uses this module
+                from cam_image import debayer
+                processed_chunk = np.stack([debayer(frame, method="menon", pattern="RGGB") for frame in raw_chunk])
+        else:
+            processed_chunk = raw_chunk
+
+        for region_number, region in enumerate(REGIONS):
+            index = masks.indices[region]
+            processed_histograms = region_histograms(processed_chunk, index)
+            raw_histograms = processed_histograms if format != "BayerRG8" else region_histograms(raw_chunk, index)
+            if histograms:
+                results["raw_histograms"][start:end, region_number] = raw_histograms[:, 0]
+                results["channel_histograms"][start:end, region_number] = processed_histograms
+            results[f"{region}_fraction_white"][start:end] = histogram_white_fractions(raw_histograms, threshold)
+            results[f"{region}_avgs"][start:end] = histogram_means(processed_histograms)
+
+            if region == "inner":
+                #Monochrome pixels are relative luminance scaled to 255
+                if format == "BayerRG8":
+                    results["relative_luminance"][start:end] = histogram_relative_luminance(processed_histograms)
+                else:
+                    results["relative_luminance"][start:end] = results["inner_avgs"][start:end, 0] / 255
+
+    if integration_time is not None and gain is not None:
+        scale = luminance.absolute_luminance_scale(integration_time=np.asarray(integration_time)/1000000, aperture=1,
+                                                   speed=np.asarray(gain), speed_format=luminance.DB)
+        results["unscaled_absolute_luminance"] = results["relative_luminance"] * scale
+
+    return results
+
+
+def analyse_frame(raw:np.ndarray, format:str="Mono8", processed:np.ndarray|None=None, masks:Region_Masks|None=None,
+                  threshold:int=SATURATION_THRESHOLD, histograms:bool=False) -> dict:
+    """Calculate the region statistics of a single frame (see analyse_stack)
+
+    Args:
+        raw (np.ndarray): Raw uint8 frame of shape (height, width)
+        format (str, optional): Pixel format of the frame. Defaults to "Mono8".
+        processed (np.ndarray | None, optional): Demosaiced frame for BayerRG8 frames. Defaults to None.
+        masks (Region_Masks | None, optional): Region masks. Defaults to None.
+        threshold (int, optional): Pixel values above this are counted as saturated. Defaults to SATURATION_THRESHOLD.
+        histograms (bool, optional): Also return the histograms of the frame. Defaults to False.
+
+    Returns:
+        dict: "[region]_fraction_white" (float), "[region]_avgs" (tuple[float]) and "relative_luminance" (float),
+        and if histograms is True, "raw_histograms" and "channel_histograms" (arrays, see analyse_stack)
+    """
+    results = analyse_stack(raw[np.newaxis], format=format, processed=None if processed is None else processed[np.newaxis],
+                            masks=masks, threshold=threshold, histograms=histograms)
+    frame = {}
+    for key, value in results.items():
+        if key.endswith("_histograms"):
+            frame[key] = value[0]
+        else:
+            frame[key] = tuple(value[0].tolist()) if value.ndim == 2 else float(value[0])
+    return frame
@@ -1,24 +1,38 @@
 import argparse
 from pathlib import Path
-import json
 import os
 from dotenv import load_dotenv
 import traceback
 import sys
 from datetime import datetime
 from time import time
-from contextlib import contextmanager
+import logging
+import logging.handlers
 
 
 import routine
 import session
+import calibration
+import dark_model
+import defects
+import hdr
+import live_view
+import memory_budget
+import metrics
+import profiling
+import stacking
+import run_table
+import session_index
 import ids_interface
+import session_logging
 from cam_image import Cam_Image
 
 load_dotenv()
 
 DATA_DIR = Path(os.environ.get("DATA_DIRECTORY"))
 
+log = session_logging.get_logger("auto_capture")
+
 def main():
     
     """Loads a session and routine from arguments passed when calling the script.
@@ -32,32 +46,22 @@ def main():
     otherwise it will exit with error code 1.
     
     """    
-    stored_strings = ""
-    
     current_session: session.Session = None
     current_routine: routine.Routine = None
     
-    def print_and_log(*args, **kwargs):
+    #Messages logged before a session is opened are held in memory, and written to the session output file once it is
+    pending_records = logging.handlers.MemoryHandler(capacity=10000, flushLevel=logging.CRITICAL+1)
+    logging.getLogger(session_logging.LOGGER_NAME).addHandler(pending_records)
+    logging.getLogger(session_logging.LOGGER_NAME).setLevel(logging.INFO)
+    
+    def print_and_log(*args, level:int=logging.INFO, stage:str|None=None, frame:int|None=None, **kwargs):
         """Function for logging output of this script. If this is run from a systemd service the output should go to the RPi logs 
         to be read with journalctl, but this also writes to a file in the session which is loaded. If there is no session loaded 
         it saves the output until one is opened and then writes it.
         """
         try:
-            str_args = ""
-            for arg in args:
-                str_args+=str(arg)
-            string = datetime.now().strftime("%Y/%m/%d %H:%M:%S: ") + str_args
-            nonlocal stored_strings
             print(*args, **kwargs)
-            if current_session is not None:
-                if stored_strings != "":
-                    current_session.output(stored_strings)
-                    stored_strings = ""
-                    
-                current_session.output(string)
-                
-            else:
-                stored_strings += string + "\n"
+            log.log(level, "".join(str(arg) for arg in args), extra={"stage": stage, "frame": frame})
         except Exception as e: 
             traceback.print_exc(e)
 
@@ -71,6 +75,21 @@ def main():
     parser.add_argument('--routine', help='Routine', required=True)
     parser.add_argument('--session', help='Session', required=True)
     parser.add_argument('--complete',action='store_true')
+    parser.add_argument('--csv', action='store_true', help='Also export the run table to run_[number].csv when the routine completes')
+    parser.add_argument('--luminance-maps', action='store_true', help='Save per-pixel relative and unscaled absolute luminance maps (.npy) alongside each image')
+    parser.add_argument('--irradiance', action='store_true', help='Calculate planar and scalar irradiance for each image')
+    parser.add_argument('--calibrate', action='store_true', help='Apply master dark and flat corrections (see calibration.py) to each image')
+    parser.add_argument('--dark-model', action='store_true', help='Subtract the dark signal predicted by the dark model (see dark_model.py) from each image')
+    parser.add_argument('--defects', action='store_true', help='Replace hot and dead pixels (see defects.py) in each image')
+    parser.add_argument('--hdr', action='store_true', help='Merge the images of each repeat of the routine into an HDR frame')
+    parser.add_argument('--stack', type=int, default=0, metavar='N', help='Stack every N consecutive frames with the same settings, saving only the mean and variance frames instead of each image')
+    parser.add_argument('--memory-budget', type=float, default=None, metavar='MB', help='Limit the memory used to process each frame (e.g. on a Raspberry Pi) by demosaicing in bands of rows into a reused float32 buffer. Pixels differ from the default result by at most 1 level')
+    parser.add_argument('--no-previews', action='store_true', help='Do not save thumbnail and quicklook previews (see preview.py) of each image')
+    parser.add_argument('--live-view', type=int, default=None, metavar='PORT', help='Serve an MJPEG stream of downscaled frames and the latest image statistics over HTTP on this port while the routine runs')
+    parser.add_argument('--live-view-fps', type=float, default=live_view.MAX_FPS, help=f'Maximum frames per second streamed by the live view (default: {live_view.MAX_FPS})')
+    parser.add_argument('--metrics-file', default=None, metavar='PATH', help='Write capture and processing metrics in the Prometheus text format to this file every few seconds (e.g. for a node_exporter textfile collector)')
+    profiling.add_arguments(parser)
+    parser.add_argument('--memory-report', action='store_true', help='Record the peak memory allocated by each processing stage and print it when the routine completes')
         
     #Attempt to open connection to the device - exit with error code 1 if not
     try:
@@ -81,7 +100,7 @@ def main():
             sys.exit(1)
     except Exception as e:
         print_and_log("Could not connect to Device")
-        print_and_log(*traceback.format_exception(e))
+        print_and_log(*traceback.format_exception(e), level=logging.ERROR)
         sys.exit(1)
         
       
@@ -102,10 +121,12 @@ def main():
             device.exposure_time(seconds=integration_time_secs)
             
             
-        image: Cam_Image = current_session.run_and_log(lambda: device.capture_image(auto=auto))
+        #Messages logged while capturing are recorded with the capture stage and image number
+        image_number = current_routine.image_count + 1
+        image: Cam_Image = current_session.run_and_log(lambda: device.capture_image(auto=auto), stage="capture", frame=image_number)
         
         
-        print_and_log(f"Captured Image #{current_routine.image_count}")
+        print_and_log(f"Captured Image #{image_number}", stage="capture", frame=image_number)
         
         
                     
@@ -119,6 +140,18 @@ def main():
 
     # Access the values of named arguments
     routine_name:str = args.routine
+    device.image_options["luminance_maps"] = args.luminance_maps
+    device.image_options["irradiance"] = args.irradiance
+    if args.calibrate:
+        device.image_options["calibration"] = calibration.Calibration()
+    if args.dark_model:
+        device.image_options["dark_model"] = dark_model.Dark_Model()
+    if args.defects:
+        device.image_options["defects"] = defects.Defect_Maps(device.info.get("Serial Number"))
+    if args.memory_budget is not None:
+        memory_budget.set_budget(args.memory_budget)
+    if args.memory_report:
+        memory_budget.start_report()
     session_name:str = args.session
 
 
@@ -164,81 +197,125 @@ def main():
 
 
 
-    #Set location of the session list file (It's in json format)
-    session_list_file= DATA_DIR / "sessions" / "session_list.json"
+    #Open the session index (an SQLite database in the data directory). The first time it is used,
+    #existing sessions (including those in the old session_list.json file) are imported into it.
+    index = session_index.Session_Index()
+    index.ensure_imported()
     
     #Set empty variables to fill with session info
     session_path: Path = None
     current_session: session.Session = None  
-    new_session = False
-    session_dict:dict = None
     
-
-    with open( session_list_file, mode="r") as session_list:
-        #Open the session list and parse the json data into a dict object 
-        session_dict = json.load(session_list)
-        
-        #Check if a session of the specified name is in the session list
-        if session_name in session_dict:
-            #If it is get the session directory path and load the session from the file.
-            session_path = Path(session_dict[session_name]['directory_path']) / session_name.replace(" ", "_")
-            if session_path is not None and session_path.exists():
-                print_and_log("Session Exists")
-                current_session = session.from_file(session_path)
-                current_session.print_info()
-        else:
-            #If the session is not in the list, make a new session with that name. Session info such as coordinates/location
-            # will have to be added later in the console interface
-            print_and_log(f"Session {session_name} not found")
-            print_and_log("Creating new session...")
-            new_session = True
-            current_session = session.Session(name=session_name, directory=DATA_DIR / "sessions")
-    
-    #If a new session was created, add it to the session list file.
-    if new_session:
-        with open(session_list_file, mode="w") as session_list:
-            session_dict.update({current_session.name: 
-                                    {"start_time":current_session.time_string(),
-                                        "coords" : current_session.coords,
-                                        "directory_path": str(current_session.directory_path),
-                                        "images" : 0
-                                        }
-                                    })
-            json.dump(session_dict, session_list, indent=4)
+    #Check if a session of the specified name is in the index
+    sessions_dict:dict = index.sessions()
+    if session_name in sessions_dict:
+        #If it is get the session directory path and load the session from the file.
+        session_path = Path(sessions_dict[session_name]['directory_path']) / session_name.replace(" ", "_")
+        if session_path is not None and session_path.exists():
+            print_and_log("Session Exists")
+            current_session = session.from_file(session_path, index=index)
+            current_session.print_info()
+    
+    if current_session is None:
+        #If the session is not in the index, make a new session with that name. Session info such as coordinates/location
+        # will have to be added later in the console interface. Creating the session adds it to the index.
+        print_and_log(f"Session {session_name} not found")
+        print_and_log("Creating new session...")
+        current_session = session.Session(name=session_name, directory=DATA_DIR / "sessions", index=index)
+    current_session.previews = not args.no_previews
+    
+    #Write messages logged before the session was opened to its output file
+    pending_records.setTarget(current_session.session_log.queue_handler)
+    pending_records.flush()
+    logging.getLogger(session_logging.LOGGER_NAME).removeHandler(pending_records)
+    pending_records.close()
     
 
     Path("./image_data").mkdir(parents=True, exist_ok=True)
     
     run_number = 0
-    while os.path.exists(DATA_DIR /"sessions" / f"{current_session.name}" / f"run_{run_number}.csv"):
+    session_dir = DATA_DIR / "sessions" / f"{current_session.name}"
+    while (session_dir / f"run_{run_number}.npy").exists() or (session_dir / f"run_{run_number}.csv").exists():
         run_number += 1
     
-    filename = DATA_DIR / "sessions" / f"{current_session.name}" / f"run_{run_number}.csv"
-    
-    open(filename, "w").close()
+    #The run table is kept open for the whole routine and written to in blocks
+    run_table_writer = run_table.Run_Table_Writer(session_dir / f"run_{run_number}.npy")
+    index.add_run(current_session.name, run_number, routine=current_routine.name, table_path=run_table_writer.path)
     
         
     def save_image_data(image:Cam_Image):
-        nonlocal filename
-        
-        image_data = [image.integration_time/1000000, image.temp, image.inner_fraction_white, image.outer_fraction_white, image.corner_fraction_white,
-                           *image.inner_avgs, *image.outer_avgs, *image.corner_avgs]
-        
-        new_file = False
-        
-        with open(filename, "r") as file:
-            new_file = len(file.read()) == 0
-        
-        with open(filename, "a") as file:
-            if new_file:
-                file.write(f"int_time_s temp_C inner_wf outer_wf corner_wf {' '.join([f'inner_avg_{index}' for index, _ in enumerate(image.inner_avgs)])} {' '.join([f'outer_avg_{index}' for index, _ in enumerate(image.outer_avgs)])} {' '.join([f'corner_avg_{index}' for index, _ in enumerate(image.corner_avgs)])}\n")
-                
-            
-            file.write(' '.join(str(item) for item in image_data))
-            file.write('\n')
+        with metrics.stage("run table"):
+            run_table_writer.append_image(image)
+    
+    #Each repeat of the routine (e.g. an integration time ladder) is merged into one HDR frame as it is captured
+    hdr_merger = hdr.HDR_Merger() if args.hdr else None
+    if hdr_merger is not None and not current_routine.bracketed:
+        print_and_log("HDR merging needs more than one integration time or gain in each repeat of the routine. Ignoring --hdr", level=logging.WARNING, stage="hdr")
+        hdr_merger = None
+    hdr_repeat = None
+    hdr_format = None
+    
+    def save_hdr():
+        if len(hdr_merger) == 0:
+            return
+        record = hdr_merger.record()
+        record["run"] = run_number
+        record["repeat"] = hdr_repeat
+        record["format"] = hdr_format
+        #Repeats with failed captures, or cut short by the routine's limits, are saved with the frames they have
+        record["complete"] = len(hdr_merger) == current_routine.bracket_length
+        if not record["complete"]:
+            print_and_log(f"Repeat {hdr_repeat} has {len(hdr_merger)} of {current_routine.bracket_length} frames", level=logging.WARNING, stage="hdr")
+        product_path = current_session.add_product("hdr", hdr_merger.result(), record)
+        print_and_log(f"Saved HDR frame {product_path}", stage="hdr")
+        hdr_merger.reset()
+    
+    def merge_image(image:Cam_Image, repeat:int, number:int|None=None):
+        nonlocal hdr_repeat, hdr_format
+        if repeat != hdr_repeat:
+            save_hdr()
+            hdr_repeat = repeat
+            hdr_format = image.format
+        with metrics.stage("hdr"):
+            hdr_merger.add(image.raw, image.integration_time, image.gain, number=number)
+        if len(hdr_merger) >= current_routine.bracket_length:
+            save_hdr()
+    
+    #In stacking mode, frames are added to a stack instead of being saved, and every N frames (or when the settings change)
+    #the stack's mean and variance frames are saved with the statistics of each frame
+    frame_stack = stacking.Frame_Stack() if args.stack > 0 else None
+    
+    def save_stack():
+        if len(frame_stack) == 0:
+            return
+        record = frame_stack.record()
+        record["run"] = run_number
+        record["format"] = frame_stack.frames[-1]["format"]
+        product_path = current_session.add_product("stack", frame_stack.result(), record)
+        print_and_log(f"Saved stack of {len(frame_stack)} frames {product_path}", stage="stack")
+        frame_stack.reset()
+    
+    def stack_image(image:Cam_Image):
+        if not frame_stack.matches(image.integration_time, image.gain):
+            save_stack()
+        with metrics.stage("stack"):
+            frame_stack.add(image.raw, image.integration_time, image.gain, record=current_session.image_record(image, run=run_number))
+        if len(frame_stack) >= args.stack:
+            save_stack()
             
             
             
+    #The live view server runs on background threads, and viewers never hold up the routine
+    viewer : live_view.Live_View|None = None
+    if args.live_view is not None:
+        try:
+            viewer = live_view.Live_View(args.live_view, max_fps=args.live_view_fps)
+            viewer.update_telemetry({"session": current_session.name, "routine": current_routine.name, "run": run_number,
+                                     "device": device.info.get("Model"), "serial": device.info.get("Serial Number")})
+        except Exception as e:
+            print_and_log(f"Unable to start live view on port {args.live_view}", level=logging.ERROR)
+            print_and_log(*traceback.format_exception(e), level=logging.ERROR)
+    
     print_and_log(f"Running routine {current_routine.name}...")
     print_and_log(current_routine.to_string())
     
@@ -255,12 +332,22 @@ def main():
     
     complete = False
 
+    #Metrics are summarised for this run only
+    metrics.reset()
+    profiler = profiling.from_arguments(args, session_dir, f"run_{run_number}")
+    if profiler is not None:
+        profiler.start()
     check_time = time()
     
     while not complete:
         try:
             if time() - check_time > 5:
-                print_and_log(f"Device Temp: {device.get_temperature()}°C")
+                device_temp = device.get_temperature()
+                print_and_log(f"Device Temp: {device_temp}°C")
+                if viewer is not None:
+                    viewer.update_telemetry({"device temp (°C)": device_temp})
+                if args.metrics_file is not None:
+                    metrics.write_textfile(args.metrics_file)
                 check_time = time()
             tick_result = current_routine.tick()
             complete = tick_result["complete"]
@@ -271,14 +358,60 @@ def main():
             #If the tick returns with a Cam_Image object, add it to the session (Which will save it 
             # to the session directory and add its info to the session log).
             if img is not None:
-                current_session.add_image(img)
+                number = None
+                if frame_stack is not None:
+                    stack_image(img)
+                else:
+                    with metrics.stage("add image"):
+                        current_session.add_image(img, run=run_number)
+                    number = current_session.image_count
                 save_image_data(img)
+                if hdr_merger is not None:
+                    merge_image(img, tick_result["repeat"], number)
+                if viewer is not None:
+                    viewer.publish(img, {"image count": current_routine.image_count, "session image": number})
+                if profiler is not None:
+                    profiler.frame(number)
+                #The pixel buffers are no longer needed, so only the image's metadata is kept until the next tick
+                img.release()
                 
         except Exception as e:
-            print_and_log("Tick Error")
-            print_and_log(*traceback.format_exception(e))
+            metrics.count("tick_errors")
+            print_and_log("Tick Error", level=logging.ERROR)
+            print_and_log(*traceback.format_exception(e), level=logging.ERROR)
 
     
+    if frame_stack is not None:
+        save_stack()
+    if hdr_merger is not None:
+        save_hdr()
+    
+    if viewer is not None:
+        viewer.close()
+    if profiler is not None:
+        for path in profiler.close():
+            print_and_log(f"Saved profile {path}", stage="profile")
+    run_table_writer.close()
+    if args.memory_report:
+        print_and_log(memory_budget.format_report(memory_budget.stop_report()), stage="memory")
+    if args.csv:
+        run_table.export_csv(run_table_writer.path)
+    
+    #Keep log.json available as an export of the session
+    current_session.export_log()
+    
+    #Summarise where the time of the run went, and save the summary with the run table
+    try:
+        metrics_path = metrics.write_summary(session_dir / f"run_{run_number}_metrics.json")
+        print_and_log(metrics.format_summary(metrics.summary()), stage="metrics")
+        print_and_log(f"Saved run metrics to {metrics_path}", stage="metrics")
+        if args.metrics_file is not None:
+            metrics.write_textfile(args.metrics_file)
+    except Exception as e:
+        print_and_log("Unable to save run metrics", level=logging.ERROR)
+        print_and_log(*traceback.format_exception(e), level=logging.ERROR)
+    current_session.close()
+    
     print_and_log(f"Complete at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
 
 #Wrapper code for running this script.
@@ -0,0 +1,470 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import traceback
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+
+import warnings
+warnings.filterwarnings("ignore", module=".*colour.*")
+
+load_dotenv()
+
+import analysis
+import cam_image
+import geometry
+import luminance
+import run_table
+import session
+import session_log
+
+#Benchmarks of the analysis and storage hot paths, on synthetic fisheye frames, so optimisations can be checked
+#against a baseline. Each benchmark is timed over several repeats after a warm-up call, and its peak
+#allocation (numpy and Python memory, from tracemalloc) is measured in one more call. Results are saved as JSON,
+#and two results files can be compared to flag regressions.
+
+DATA_DIR = Path(os.environ.get("DATA_DIRECTORY"))
+RESULTS_DIR = DATA_DIR / "benchmarks"
+
+FRAME_SHAPE = (2048, 2448)
+FORMATS = ["BayerRG8", "Mono8"]
+DEBAYER_METHODS = ["menon", "menon_r", "malvar", "bilinear"]
+#Number of images already in the session when Session.add_image is timed
+SESSION_SIZES = [10, 1000, 5000]
+#Rows appended to the run table in each run table benchmark
+RUN_TABLE_ROWS = 1000
+
+DEFAULT_REPEAT = 5
+DEFAULT_WARMUP = 1
+#Benchmarks whose median time or peak memory grows by more than this fraction are flagged by compare
+DEFAULT_THRESHOLD = 0.10
+
+#Relative sensitivity of the R, G and B filters in the synthetic frames
+CHANNEL_GAINS = (0.55, 1.0, 0.75)
+
+#Frames processed by the memory check, and the memory each kept frame record may add. A frame record is a few KB,
+#while a frame whose pixels were not released keeps several MB.
+MEMORY_FRAMES = 20
+MAX_RECORD_BYTES = 16 * 1024
+
+
+def synthetic_frame(format:str="BayerRG8", shape:tuple[int]=FRAME_SHAPE, seed:int=0) -> np.ndarray:
+    """Make a raw frame of a fisheye image: a bright circle (the default lens geometry) which falls off towards
+    its edge, with a small saturated spot, on a dark background with noise. Frames are the same for the same seed.
+
+    Args:
+        format (str, optional): "BayerRG8" or "Mono8". Defaults to "BayerRG8".
+        shape (tuple[int], optional): Frame shape (height, width). Defaults to FRAME_SHAPE.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        np.ndarray: uint8 raw frame of the given shape
+    """
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    (centre_x, centre_y), radius = geometry.DEFAULT_CENTRE, geometry.DEFAULT_RADIUS
+    rows, cols = np.ogrid[:height, :width]
+    distance = np.hypot(cols - centre_x, rows - centre_y) / radius
+    signal = np.where(distance <= 1, 40 + 180 * np.cos(np.minimum(distance, 1) * np.pi / 2), 0).astype(np.float32)
+    #A small saturated spot (e.g. the sun)
+    signal[np.hypot(cols - centre_x - radius // 3, rows - centre_y + radius // 4) < radius / 20] = 400
+
+    if format == "BayerRG8":
+        gains = np.empty(shape, dtype=np.float32)
+        gains[0::2, 0::2] = CHANNEL_GAINS[0]
+        gains[0::2, 1::2] = CHANNEL_GAINS[1]
+        gains[1::2, 0::2] = CHANNEL_GAINS[1]
+        gains[1::2, 1::2] = CHANNEL_GAINS[2]
+        signal *= gains
+
+    frame = rng.poisson(signal + 4).astype(np.float32)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def synthetic_image(format:str="BayerRG8", shape:tuple[int]=FRAME_SHAPE, seed:int=0) -> cam_image.Cam_Image:
+    """Make a Cam_Image from a synthetic frame (see synthetic_frame)
+    """
+    return cam_image.Cam_Image(synthetic_frame(format, shape, seed), timestamp=datetime.now(), integration_time=10000,
+                               gain=1.0, depth=0, temp=30.0, format=format)
+
+
+#Each benchmark is a setup function returning the function to time, and a function to clean up afterwards (or None)
+
+def _debayer(method:str):
+    frame = synthetic_frame("BayerRG8")
+    return lambda: cam_image.debayer(frame, method=method, pattern="RGGB"), None
+
+
+def _cam_image(format:str):
+    frame = synthetic_frame(format)
+    #Cam_Image changes its frame in place if corrections are applied, so each call gets a copy
+    return lambda: cam_image.Cam_Image(frame.copy(), timestamp=datetime.now(), integration_time=10000,
+                                       gain=1.0, depth=0, temp=30.0, format=format), None
+
+
+def _luminance(name:str):
+    rgb = np.asarray(synthetic_image("BayerRG8").image)
+    #Luminance functions take masks with value 255 for pixels to include
+    mask = analysis.centre_mask(rgb.shape[:2], geometry.DEFAULT_CENTRE, geometry.DEFAULT_RADIUS).astype(np.uint8) * 255
+    histograms = luminance.channel_histograms(rgb, mask=mask)
+    functions = {"normalise_colours": lambda: luminance.normalise_colours(rgb),
+                 "linearise_colours": lambda: luminance.linearise_colours(luminance.normalise_colours(rgb)),
+                 #Lookup tables are cached, so building the table is timed
+                 "transfer_lut": lambda: luminance.transfer_lut.__wrapped__(8),
+                 "channel_histograms": lambda: luminance.channel_histograms(rgb, mask=mask),
+                 "relative_luminance_from_histograms": lambda: luminance.relative_luminance_from_histograms(histograms),
+                 "lin_sRGB_to_XYZ": lambda: luminance.lin_sRGB_to_XYZ((0.2, 0.5, 0.3)),
+                 "calc_relative_luminance": lambda: luminance.calc_relative_luminance(rgb, mask=mask),
+                 "absolute_luminance_scale": lambda: luminance.absolute_luminance_scale(integration_time=0.01, aperture=1, speed=1.0, speed_format=luminance.DB),
+                 "calc_unscaled_absolute_luminance": lambda: luminance.calc_unscaled_absolute_luminance(rgb, integration_time=0.01, aperture=1, speed=1.0, speed_format=luminance.DB, mask=mask),
+                 "luminance_map": lambda: luminance.luminance_map(rgb)}
+    return functions[name], None
+
+
+LUMINANCE_FUNCTIONS = ["normalise_colours", "linearise_colours", "transfer_lut", "channel_histograms", "relative_luminance_from_histograms",
+                       "lin_sRGB_to_XYZ", "calc_relative_luminance", "absolute_luminance_scale", "calc_unscaled_absolute_luminance", "luminance_map"]
+
+
+def _masks(kind:str):
+    shape = FRAME_SHAPE
+    centre, radius = geometry.DEFAULT_CENTRE, geometry.DEFAULT_RADIUS
+    functions = {"centre": lambda: analysis.centre_mask(shape, centre, radius),
+                 "corner": lambda: analysis.corner_mask(shape, analysis.CORNER_RADIUS),
+                 #Region masks are cached per shape in use, so the uncached construction is timed here
+                 "regions": lambda: analysis.Region_Masks(shape, centre, radius, analysis.MARGIN, analysis.CORNER_RADIUS)}
+    return functions[kind], None
+
+
+def _png_save(format:str):
+    image = synthetic_image(format)
+    directory = tempfile.TemporaryDirectory()
+    path = Path(directory.name) / "benchmark.png"
+    return lambda: image.save(path), directory.cleanup
+
+
+def _session_add_image(size:int):
+    directory = tempfile.TemporaryDirectory()
+    image = synthetic_image("BayerRG8")
+    name = f"benchmark_{size}"
+    #Fill the image log with records of the same image, then reopen the session so it starts with that many images
+    current_session = session.Session(name, directory=directory.name, previews=False)
+    session_path = Path(directory.name) / name
+    record = current_session.image_record(image, number=1)
+    current_session.close()
+    session_log.write_records(session_path, (dict(record, number=number) for number in range(1, size + 1)))
+    current_session = session.Session(name, directory=directory.name, previews=False)
+
+    def cleanup():
+        current_session.close()
+        directory.cleanup()
+    return lambda: current_session.add_image(image), cleanup
+
+
+def _run_table(kind:str):
+    directory = tempfile.TemporaryDirectory()
+    image = synthetic_image("BayerRG8").release()
+    path = Path(directory.name) / "run_0.npy"
+
+    def append():
+        writer = run_table.Run_Table_Writer(path)
+        for _ in range(RUN_TABLE_ROWS):
+            writer.append_image(image)
+        writer.close()
+
+    if kind == "append":
+        return append, directory.cleanup
+    append()
+    return lambda: run_table.export_csv(path), directory.cleanup
+
+
+BENCHMARKS = {}
+for method in DEBAYER_METHODS:
+    BENCHMARKS[f"debayer_{method}"] = lambda method=method: _debayer(method)
+for format in FORMATS:
+    BENCHMARKS[f"cam_image_{format}"] = lambda format=format: _cam_image(format)
+for name in LUMINANCE_FUNCTIONS:
+    BENCHMARKS[f"luminance_{name}"] = lambda name=name: _luminance(name)
+for kind in ["centre", "corner", "regions"]:
+    BENCHMARKS[f"mask_{kind}"] = lambda kind=kind: _masks(kind)
+for format in FORMATS:
+    BENCHMARKS[f"png_save_{format}"] = lambda format=format: _png_save(format)
+for size in SESSION_SIZES:
+    BENCHMARKS[f"session_add_image_{size}"] = lambda size=size: _session_add_image(size)
+BENCHMARKS[f"run_table_append_{RUN_TABLE_ROWS}"] = lambda: _run_table("append")
+BENCHMARKS[f"run_table_export_csv_{RUN_TABLE_ROWS}"] = lambda: _run_table("export")
+
+
+def run_benchmark(setup, repeat:int=DEFAULT_REPEAT, warmup:int=DEFAULT_WARMUP) -> dict:
+    """Time a benchmark and measure its peak allocation
+
+    Args:
+        setup (callable): Setup function returning the function to time and a cleanup function (or None)
+        repeat (int, optional): Timed calls. Defaults to DEFAULT_REPEAT.
+        warmup (int, optional): Untimed calls first. Defaults to DEFAULT_WARMUP.
+
+    Returns:
+        dict: {"repeat", "min", "median", "mean", "max", "times" (seconds), "peak_memory" (bytes)}
+    """
+    function, cleanup = setup()
+    try:
+        for _ in range(warmup):
+            function()
+        times = []
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+
+        #Peak memory is measured separately, as tracing allocations slows the timed calls
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    finally:
+        if cleanup is not None:
+            cleanup()
+
+    return {"repeat": repeat,
+            "min": min(times),
+            "median": float(np.median(times)),
+            "mean": float(np.mean(times)),
+            "max": max(times),
+            "times": times,
+            "peak_memory": peak}
+
+
+def memory_check(frames:int=MEMORY_FRAMES, format:str="BayerRG8", limit:int=MAX_RECORD_BYTES) -> dict:
+    """Check that memory stays flat over a long routine: process frames one after another, releasing each image
+    and keeping only its frame record (as the capture loops do), and measure the growth of traced memory.
+
+    Args:
+        frames (int, optional): Frames processed after the warm-up frames. Defaults to MEMORY_FRAMES.
+        format (str, optional): Pixel format of the frames. Defaults to "BayerRG8".
+        limit (int, optional): Maximum growth (bytes) per frame. Defaults to MAX_RECORD_BYTES.
+
+    Returns:
+        dict: {"frames", "growth" (bytes after each frame), "per_frame" (bytes), "peak_memory" (bytes), "limit", "passed"}
+    """
+    make_image, _ = _cam_image(format)
+    records = []
+    #Lookup tables, masks and radiance bins are cached on first use, so they are built before measuring
+    for _ in range(2):
+        make_image().release()
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        growth = []
+        for _ in range(frames):
+            records.append(make_image().release())
+            gc.collect()
+            growth.append(tracemalloc.get_traced_memory()[0] - start)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    per_frame = growth[-1] / frames if frames > 0 else 0.0
+    return {"frames": frames, "growth": growth, "per_frame": per_frame, "peak_memory": peak,
+            "limit": limit, "passed": per_frame <= limit}
+
+
+def log_recovery_check(records:int=3) -> dict:
+    """Check that reopening an image log with a partly written final record (e.g. after a power cut)
+    drops only that record: write complete records and a torn tail, append one more record, and read the log back.
+
+    Args:
+        records (int, optional): Complete records written before the torn tail. Defaults to 3.
+
+    Returns:
+        dict: {"expected" (record numbers), "found" (record numbers read back), "passed"}
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        session_log.write_header({"session": "log recovery"}, directory)
+        log = session_log.Image_Log(directory)
+        for number in range(1, records + 1):
+            log.append({"number": number})
+        log.close()
+        with open(Path(directory) / session_log.IMAGE_LOG_FILE, mode="ab") as log_file:
+            log_file.write(b'{"number":%d' % (records + 1))
+
+        log = session_log.Image_Log(directory)
+        log.append({"number": records + 2})
+        log.close()
+        found = [record["number"] for record in session_log.iter_records(directory)]
+        indexed = [record["number"] for record in session_log.Session_View(directory)]
+
+    expected = list(range(1, records + 1)) + [records + 2]
+    return {"expected": expected, "found": found, "passed": found == expected and indexed == expected}
+
+
+def environment() -> dict:
+    """Describe the software and machine the benchmarks ran on
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                                capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {"time": datetime.now().isoformat(timespec="seconds"),
+            "commit": commit,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count()}
+
+
+def run(names:list[str], repeat:int=DEFAULT_REPEAT, warmup:int=DEFAULT_WARMUP) -> dict:
+    """Run benchmarks, printing each result as it completes
+
+    Args:
+        names (list[str]): Benchmark names (see BENCHMARKS)
+        repeat (int, optional): Timed calls of each. Defaults to DEFAULT_REPEAT.
+        warmup (int, optional): Untimed calls of each first. Defaults to DEFAULT_WARMUP.
+
+    Returns:
+        dict: {"environment": ..., "results": {name: result}}
+    """
+    results = {}
+    print(f"{'benchmark'.ljust(44)} {'median (ms)':>12} {'min (ms)':>10} {'peak (MB)':>10}")
+    for name in names:
+        try:
+            result = run_benchmark(BENCHMARKS[name], repeat=repeat, warmup=warmup)
+        except Exception as e:
+            print(f"{name.ljust(44)} failed")
+            traceback.print_exception(e)
+            continue
+        results[name] = result
+        print(f"{name.ljust(44)} {result['median']*1000:>12.2f} {result['min']*1000:>10.2f} {result['peak_memory']/1024/1024:>10.1f}")
+    return {"environment": environment(), "results": results}
+
+
+def compare(baseline:dict, current:dict, threshold:float=DEFAULT_THRESHOLD, statistic:str="median") -> tuple[str, list[str]]:
+    """Compare two sets of results
+
+    Args:
+        baseline (dict): Earlier results (see run)
+        current (dict): Later results
+        threshold (float, optional): Fractional increase in time or peak memory flagged as a regression. Defaults to DEFAULT_THRESHOLD.
+        statistic (str, optional): Time statistic compared: "median", "min" or "mean". Defaults to "median".
+
+    Returns:
+        tuple[str, list[str]]: Comparison table, and the names of the benchmarks which regressed
+    """
+    def change(old:float, new:float) -> float:
+        return (new - old) / old if old > 0 else 0.0
+
+    lines = [f"{'benchmark'.ljust(44)} {'before (ms)':>12} {'after (ms)':>12} {'time':>8} {'memory':>8}"]
+    regressions = []
+    for name in sorted(set(baseline["results"]) | set(current["results"])):
+        if name not in baseline["results"] or name not in current["results"]:
+            lines.append(f"{name.ljust(44)} only in {'current' if name in current['results'] else 'baseline'} results")
+            continue
+        old, new = baseline["results"][name], current["results"][name]
+        time_change = change(old[statistic], new[statistic])
+        memory_change = change(old["peak_memory"], new["peak_memory"])
+        flags = []
+        if time_change > threshold:
+            flags.append("slower")
+        if memory_change > threshold:
+            flags.append("more memory")
+        if flags:
+            regressions.append(name)
+        lines.append(f"{name.ljust(44)} {old[statistic]*1000:>12.2f} {new[statistic]*1000:>12.2f} {time_change:>+8.1%} {memory_change:>+8.1%}"
+                     + (f"  REGRESSION ({', '.join(flags)})" if flags else ""))
+    return "\n".join(lines), regressions
+
+
+def main():
+    """Run and compare benchmarks of the analysis and storage hot paths.
+    Call from command line with:
+    $> benchmark.py run [--filter debayer session] [--repeat 5] [--output results.json]
+    $> benchmark.py compare [baseline results] [current results] [--threshold 0.1]   (exits with 1 if there are regressions)
+    $> benchmark.py list
+    $> benchmark.py memory [--frames 20] [--format BayerRG8]    (exits with 1 if memory grows by more than the frame records)
+    """
+    parser = argparse.ArgumentParser(description="Run and compare benchmarks of the analysis and storage hot paths")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run benchmarks and save the results")
+    run_parser.add_argument("--filter", nargs="+", default=None, help="Only run benchmarks with names containing any of these")
+    run_parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help=f"Timed calls of each benchmark (default: {DEFAULT_REPEAT})")
+    run_parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP, help=f"Untimed calls of each benchmark first (default: {DEFAULT_WARMUP})")
+    run_parser.add_argument("--output", help="Results file (default: [data directory]/benchmarks/benchmark_[time].json)")
+    compare_parser = subparsers.add_parser("compare", help="Compare two results files and flag regressions")
+    compare_parser.add_argument("baseline", help="Earlier results file")
+    compare_parser.add_argument("current", help="Later results file")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help=f"Fractional increase flagged as a regression (default: {DEFAULT_THRESHOLD})")
+    compare_parser.add_argument("--statistic", choices=["median", "min", "mean"], default="median", help="Time statistic compared (default: median)")
+    subparsers.add_parser("list", help="List the benchmarks")
+    subparsers.add_parser("log-recovery", help="Check that a torn image log loses only its partly written record")
+    memory_parser = subparsers.add_parser("memory", help="Check that memory stays flat when frames are released after processing")
+    memory_parser.add_argument("--frames", type=int, default=MEMORY_FRAMES, help=f"Frames to process (default: {MEMORY_FRAMES})")
+    memory_parser.add_argument("--format", choices=FORMATS, default="BayerRG8", help="Pixel format (default: BayerRG8)")
+    memory_parser.add_argument("--limit", type=int, default=MAX_RECORD_BYTES, help=f"Maximum growth in bytes per frame (default: {MAX_RECORD_BYTES})")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        print("\n".join(BENCHMARKS))
+        return
+
+    if args.command == "memory":
+        result = memory_check(args.frames, args.format, args.limit)
+        print(f"{result['frames']} {args.format} frames: traced memory grew {result['growth'][-1]/1024:.1f}KB "
+              f"({result['per_frame']:.0f} bytes per frame, limit {result['limit']}), peak {result['peak_memory']/1024/1024:.1f}MB")
+        if not result["passed"]:
+            print("Memory is not flat: images are being kept after they are released")
+            sys.exit(1)
+        print("Memory is flat")
+        return
+
+    if args.command == "log-recovery":
+        result = log_recovery_check()
+        print(f"Image log records after recovering a torn tail: {result['found']} (expected {result['expected']})")
+        if not result["passed"]:
+            print("Complete records were lost when the torn tail was dropped")
+            sys.exit(1)
+        print("Only the torn record was dropped")
+        return
+
+    if args.command == "compare":
+        with open(args.baseline, mode="r") as baseline_file, open(args.current, mode="r") as current_file:
+            table, regressions = compare(json.load(baseline_file), json.load(current_file), args.threshold, args.statistic)
+        print(table)
+        if regressions:
+            print(f"{len(regressions)} regressions beyond {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%}")
+        return
+
+    names = [name for name in BENCHMARKS if args.filter is None or any(part in name for part in args.filter)]
+    results = run(names, repeat=args.repeat, warmup=args.warmup)
+    output = Path(args.output) if args.output is not None else RESULTS_DIR / f"benchmark_{datetime.now().strftime(session.FILEPATH_FORMAT)}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, mode="w") as results_file:
+        json.dump(results, results_file, indent=4)
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+        sys.exit(0)
+    except Exception as e:
+        traceback.print_exception(e)
+        sys.exit(1)
@@ -0,0 +1,445 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import traceback
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+
+import analysis
+
+load_dotenv()
+
+#Dark frame and flat field calibration.
+#Master darks are built from many raw frames captured with the lens covered, for each combination of
+#integration time, gain and temperature bin. The master flat is built from raw frames of a uniformly lit target.
+#Masters are stored in [data directory]/calibration/masters as float32 .npy files with a JSON index,
+#and are kept in an in-memory cache once loaded. Darks for integration times between two masters are interpolated.
+#Corrections are applied to the raw sensor frame, before demosaicing and before any region statistics are calculated.
+
+DATA_DIR = Path(os.environ.get("DATA_DIRECTORY"))
+MASTERS_DIR = DATA_DIR / "calibration" / "masters"
+INDEX_FILE = "masters.json"
+FLAT_FILE = "flat.npy"
+
+#Width of temperature bins in °C. Darks are only used for frames in the same bin (or the nearest bin if there is none).
+TEMP_BIN_C = 5.0
+
+#Number of frames combined at each level of the median accumulator
+REMEDIAN_BASE = 7
+
+#Number of masters (and interpolated darks) kept in memory
+CACHE_SIZE = 8
+
+MAX_VALUE = 255
+
+#Flat values below this fraction of the mean response (e.g. vignetted edges of the circle and dead pixels) are set to 1
+MIN_FLAT_RESPONSE = 0.1
+
+
+def temp_bin(temp:float) -> int:
+    """Get the temperature bin of a device temperature
+
+    Args:
+        temp (float): Device temperature in °C
+
+    Returns:
+        int: Temperature bin (bin centre is temp_bin * TEMP_BIN_C)
+    """
+    return int(round(temp / TEMP_BIN_C))
+
+
+class Mean_Accumulator:
+
+    def __init__(self) -> None:
+        """Accumulates the per-pixel mean of a stream of frames, holding only a running sum
+        """
+        self._sum = None
+        self.count = 0
+
+    def add(self, frame:np.ndarray) -> None:
+        if self._sum is None:
+            self._sum = np.zeros(frame.shape, dtype=np.float64)
+        self._sum += frame
+        self.count += 1
+
+    def result(self) -> np.ndarray:
+        """Get the mean of all frames added
+
+        Returns:
+            np.ndarray: float32 mean frame
+        """
+        if self.count == 0:
+            raise ValueError("No frames have been added")
+        return (self._sum / self.count).astype(np.float32)
+
+
+class Median_Accumulator:
+
+    def __init__(self, base:int=REMEDIAN_BASE) -> None:
+        """Accumulates an approximate per-pixel median of a stream of frames using the remedian
+        (Rousseeuw & Bassett 1990). Frames are collected in buffers of base frames. When a buffer is full its median
+        is passed to the buffer of the next level, so only base frames per level are held in memory
+        (e.g. 3 levels of 7 cover 343 frames).
+
+        Args:
+            base (int, optional): Number of frames in each buffer. Defaults to REMEDIAN_BASE.
+        """
+        self.base = base
+        self._levels : list[np.ndarray] = []
+        self._filled : list[int] = []
+        self.count = 0
+
+    def _add_to_level(self, level:int, frame:np.ndarray) -> None:
+        if level == len(self._levels):
+            self._levels.append(np.empty((self.base, *frame.shape), dtype=np.float32))
+            self._filled.append(0)
+        self._levels[level][self._filled[level]] = frame
+        self._filled[level] += 1
+        if self._filled[level] == self.base:
+            median = np.median(self._levels[level], axis=0)
+            self._filled[level] = 0
+            self._add_to_level(level+1, median)
+
+    def add(self, frame:np.ndarray) -> None:
+        self._add_to_level(0, frame)
+        self.count += 1
+
+    def result(self) -> np.ndarray:
+        """Get the approximate median of all frames added. This is the median of the buffer of the highest level
+        with frames in it, as that represents the most frames.
+
+        Returns:
+            np.ndarray: float32 median frame
+        """
+        if self.count == 0:
+            raise ValueError("No frames have been added")
+        for level in reversed(range(len(self._levels))):
+            if self._filled[level] > 0:
+                return np.median(self._levels[level][:self._filled[level]], axis=0).astype(np.float32)
+        return self._levels[-1][0].astype(np.float32)
+
+
+class Calibration:
+
+    def __init__(self, directory:str|Path=MASTERS_DIR, cache_size:int=CACHE_SIZE) -> None:
+        """Master dark and flat frames, and correction of raw frames using them
+
+        Args:
+            directory (str | Path, optional): Directory masters are stored in. Defaults to MASTERS_DIR.
+            cache_size (int, optional): Number of masters kept in memory. Defaults to CACHE_SIZE.
+        """
+        self.directory = Path(directory)
+        self.cache_size = cache_size
+        self._cache : OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._scratch : np.ndarray|None = None
+        self.darks : list[dict] = []
+        self.load_index()
+
+    def load_index(self) -> None:
+        """Read the list of master darks from the index file
+        """
+        index_path = self.directory / INDEX_FILE
+        self.darks = []
+        if index_path.exists():
+            with open(index_path, mode="r") as index_file:
+                self.darks = json.load(index_file)["darks"]
+        with self._lock:
+            self._cache.clear()
+
+    def _write_index(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        temp_path = self.directory / (INDEX_FILE + ".tmp")
+        with open(temp_path, mode="w") as index_file:
+            json.dump({"darks": self.darks}, index_file, indent=4)
+        os.replace(temp_path, self.directory / INDEX_FILE)
+
+    def _load(self, file:str) -> np.ndarray|None:
+        #Load a master from disk, or from the in-memory cache if it has been used recently
+        with self._lock:
+            if file in self._cache:
+                self._cache.move_to_end(file)
+                return self._cache[file]
+        path = self.directory / file
+        if not path.exists():
+            return None
+        master = np.load(path)
+        master.setflags(write=False)
+        self._remember(file, master)
+        return master
+
+    def _remember(self, key:str, master:np.ndarray) -> None:
+        with self._lock:
+            self._cache[key] = master
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _save_master(self, file:str, master:np.ndarray) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        temp_path = self.directory / (file + ".tmp.npy")
+        master = master.astype(np.float32)
+        master.setflags(write=False)
+        np.save(temp_path, master)
+        os.replace(temp_path, self.directory / file)
+        self._remember(file, master)
+
+    def add_dark(self, master:np.ndarray, integration_time:int, gain:float, temp:float, frames:int) -> dict:
+        """Save a master dark, replacing any existing master with the same integration time, gain and temperature bin
+
+        Args:
+            master (np.ndarray): Master dark frame
+            integration_time (int): Integration time in microseconds
+            gain (float): Gain in dB
+            temp (float): Device temperature in °C
+            frames (int): Number of frames combined in the master
+
+        Returns:
+            dict: Index entry of the master
+        """
+        entry = {"integration_time": int(integration_time),
+                 "gain": round(float(gain), 2),
+                 "temp_bin": temp_bin(temp),
+                 "temp": round(float(temp), 2),
+                 "frames": frames,
+                 "created": datetime.now().isoformat(timespec="seconds")}
+        entry["file"] = f"dark_{entry['integration_time']}us_{entry['gain']:g}dB_T{entry['temp_bin']}.npy"
+        self._save_master(entry["file"], master)
+
+        self.darks = [dark for dark in self.darks if dark["file"] != entry["file"]]
+        self.darks.append(entry)
+        self.darks.sort(key=lambda dark: (dark["gain"], dark["temp_bin"], dark["integration_time"]))
+        self._write_index()
+        #Interpolated darks may depend on the new master
+        with self._lock:
+            for key in [key for key in self._cache if key.startswith("interpolated")]:
+                del self._cache[key]
+        return entry
+
+    def set_flat(self, master:np.ndarray) -> None:
+        """Save the master flat
+
+        Args:
+            master (np.ndarray): Master flat frame, normalised so the mean of each colour filter position is 1
+        """
+        self._save_master(FLAT_FILE, master)
+
+    def flat(self) -> np.ndarray|None:
+        """Get the master flat
+
+        Returns:
+            np.ndarray | None: Master flat frame, or None if there is no master flat
+        """
+        return self._load(FLAT_FILE)
+
+    def dark(self, integration_time:int, gain:float, temp:float) -> tuple[np.ndarray|None, str|None]:
+        """Get the dark frame for a set of capture settings. Only masters with the same gain are used, from the
+        temperature bin closest to temp. If there is no master with the same integration time, the dark is linearly
+        interpolated between the masters with the nearest shorter and longer integration times (or the nearest
+        master is used if the integration time is outside the range of the masters).
+
+        Args:
+            integration_time (int): Integration time in microseconds
+            gain (float): Gain in dB
+            temp (float): Device temperature in °C
+
+        Returns:
+            tuple[np.ndarray|None, str|None]: Dark frame and a description of how it was made, or (None, None) if there are no masters for the gain
+        """
+        gain = round(float(gain), 2)
+        candidates = [dark for dark in self.darks if dark["gain"] == gain]
+        if len(candidates) == 0:
+            return None, None
+
+        closest_bin = min({dark["temp_bin"] for dark in candidates}, key=lambda bin: abs(bin - temp_bin(temp)))
+        candidates = [dark for dark in candidates if dark["temp_bin"] == closest_bin]
+
+        shorter = [dark for dark in candidates if dark["integration_time"] <= integration_time]
+        longer = [dark for dark in candidates if dark["integration_time"] >= integration_time]
+        lower = shorter[-1] if len(shorter) > 0 else None
+        upper = longer[0] if len(longer) > 0 else None
+
+        if lower is None or upper is None or lower["file"] == upper["file"]:
+            nearest = lower if upper is None else upper if lower is None else lower
+            return self._load(nearest["file"]), nearest["file"]
+
+        key = f"interpolated_{integration_time}_{lower['file']}_{upper['file']}"
+        description = f"{lower['file']} + {upper['file']}"
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key], description
+
+        weight = (integration_time - lower["integration_time"]) / (upper["integration_time"] - lower["integration_time"])
+        dark = self._load(lower["file"]) * np.float32(1 - weight)
+        dark += self._load(upper["file"]) * np.float32(weight)
+        dark.setflags(write=False)
+        self._remember(key, dark)
+        return dark, description
+
+    def correct(self, raw:np.ndarray, integration_time:int, gain:float, temp:float, format:str="Mono8") -> dict|None:
+        """Subtract the dark frame from a raw frame and divide it by the master flat, in place.
+        The corrected values are rounded and clipped to the range of the raw frame.
+        Clipping negative noise at 0 raises the averages of the dark regions, so the mean amount added by clipping
+        in each dark region is returned, to be subtracted from their averages (see Cam_Image).
+
+        Args:
+            raw (np.ndarray): Raw uint8 sensor frame (before demosaicing). It is overwritten with the corrected frame.
+            integration_time (int): Integration time in microseconds
+            gain (float): Gain in dB
+            temp (float): Device temperature in °C
+            format (str, optional): Pixel format of the frame. Defaults to "Mono8".
+
+        Returns:
+            dict|None: Description of the corrections applied ({"dark": ..., "flat": ..., "clipped fraction": fraction of pixels
+            clipped at 0, "clip deficits": {region: mean added to each channel by clipping}}), or None if no masters apply to the frame
+        """
+        dark, dark_description = self.dark(integration_time, gain, temp)
+        flat = self.flat()
+        if dark is not None and dark.shape != raw.shape:
+            dark, dark_description = None, None
+        if flat is not None and flat.shape != raw.shape:
+            flat = None
+        if dark is None and flat is None:
+            return None
+
+        #A float32 buffer is reused between frames so no full size temporary arrays are created
+        with self._lock:
+            if self._scratch is None or self._scratch.shape != raw.shape:
+                self._scratch = np.empty(raw.shape, dtype=np.float32)
+            work = self._scratch
+            np.copyto(work, raw, casting="unsafe")
+            if dark is not None:
+                work -= dark
+            if flat is not None:
+                work /= flat
+            np.rint(work, out=work)
+            clipped = np.maximum(-work, 0)
+            clipped_fraction = float(np.count_nonzero(clipped) / clipped.size)
+            deficits = analysis.region_channel_means(clipped, format, analysis.DARK_REGIONS)
+            np.clip(work, 0, MAX_VALUE, out=work)
+            np.copyto(raw, work, casting="unsafe")
+
+        return {"dark": dark_description, "flat": flat is not None,
+                "clipped fraction": round(clipped_fraction, 6), "clip deficits": deficits}
+
+
+def build_master_dark(frames, method:str="median") -> tuple[np.ndarray, int]:
+    """Combine raw dark frames into a master dark
+
+    Args:
+        frames (Iterable[np.ndarray]): Raw frames captured with the lens covered, all with the same settings
+        method (str, optional): "median" (streaming approximate median) or "mean". Defaults to "median".
+
+    Returns:
+        tuple[np.ndarray, int]: float32 master dark and the number of frames combined
+    """
+    accumulator = Median_Accumulator() if method == "median" else Mean_Accumulator()
+    for frame in frames:
+        accumulator.add(np.asarray(frame, dtype=np.float32).squeeze())
+    return accumulator.result(), accumulator.count
+
+
+def build_master_flat(frames, dark:np.ndarray|None=None, method:str="mean", mask:np.ndarray|None=None) -> tuple[np.ndarray, int]:
+    """Combine raw frames of a uniformly lit target into a master flat. Each colour filter position of the
+    2x2 Bayer pattern is normalised to a mean of 1 separately, so the flat does not change the colour balance.
+    Only pixels inside the lens circle are used for the means. Outside it (where no light reaches the sensor) and where
+    the response is below MIN_FLAT_RESPONSE, the flat is 1, so the dark outer and corner regions are left unchanged.
+
+    Args:
+        frames (Iterable[np.ndarray]): Raw frames of a uniform target
+        dark (np.ndarray | None, optional): Dark frame to subtract from the frames. Defaults to None.
+        method (str, optional): "mean" or "median" (streaming approximate median). Defaults to "mean".
+        mask (np.ndarray | None, optional): Boolean mask of the lit pixels. Defaults to None (the inner region of the active geometry).
+
+    Returns:
+        tuple[np.ndarray, int]: float32 master flat and the number of frames combined
+    """
+    accumulator = Median_Accumulator() if method == "median" else Mean_Accumulator()
+    for frame in frames:
+        frame = np.asarray(frame, dtype=np.float32).squeeze()
+        if dark is not None:
+            frame -= dark
+        accumulator.add(frame)
+
+    flat = accumulator.result()
+    if mask is None:
+        mask = analysis.get_region_masks(flat.shape).masks["inner"]
+    for row in range(2):
+        for col in range(2):
+            flat[row::2, col::2] /= np.mean(flat[row::2, col::2][mask[row::2, col::2]])
+    #Avoid dividing by zero (or by the noise of unlit pixels) outside the circle and for dead pixels
+    flat[np.invert(mask) | (flat < MIN_FLAT_RESPONSE)] = 1
+    return flat, accumulator.count
+
+
+def main():
+    """Build master dark and flat frames by capturing raw frames with the connected device.
+    Call from command line with:
+    $> calibration.py dark --int-times [seconds]... --gain [dB] --frames [N]
+    $> calibration.py flat --frames [N]
+    $> calibration.py list
+    """
+    parser = argparse.ArgumentParser(description="Build master dark and flat frames")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    dark_parser = subparsers.add_parser("dark", help="Capture master darks (cover the lens first)")
+    dark_parser.add_argument("--int-times", type=float, nargs="+", required=True, help="Integration times (seconds)")
+    dark_parser.add_argument("--gain", type=float, default=1.0, help="Gain (dB)")
+    dark_parser.add_argument("--frames", type=int, default=21, help="Frames per master")
+    dark_parser.add_argument("--method", choices=["median", "mean"], default="median")
+    flat_parser = subparsers.add_parser("flat", help="Capture the master flat (point at a uniformly lit target first)")
+    flat_parser.add_argument("--frames", type=int, default=21, help="Frames to combine")
+    flat_parser.add_argument("--method", choices=["median", "mean"], default="mean")
+    subparsers.add_parser("list", help="List master darks")
+    args = parser.parse_args()
+
+    calibration = Calibration()
+
+    if args.command == "list":
+        for dark in calibration.darks:
+            print(f"{dark['integration_time']/1000000}s {dark['gain']}dB {dark['temp_bin']*TEMP_BIN_C}°C ({dark['frames']} frames): {dark['file']}")
+        print(f"Master flat: {'Yes' if calibration.flat() is not None else 'No'}")
+        return
+
+    import ids_interface
+    device = ids_interface.Connection()
+    if not device.connected:
+        print("Could not connect to Device")
+        sys.exit(1)
+
+    def capture(count:int):
+        for i in range(count):
+            print(f"Capturing frame {i+1}/{count}", end="\r")
+            yield device.single_frame_acquisition()
+        print()
+
+    try:
+        if args.command == "dark":
+            device.gain(args.gain)
+            for int_time in args.int_times:
+                device.exposure_time(seconds=int_time)
+                master, frames = build_master_dark(capture(args.frames), method=args.method)
+                entry = calibration.add_dark(master, device.exposure_time(), device.gain(), device.get_temperature(), frames)
+                print(f"Saved {entry['file']}")
+        elif args.command == "flat":
+            dark, _ = calibration.dark(device.exposure_time(), device.gain(), device.get_temperature())
+            master, frames = build_master_flat(capture(args.frames), dark=dark, method=args.method)
+            calibration.set_flat(master)
+            print(f"Saved master flat from {frames} frames")
+    finally:
+        device.close_connection()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+        sys.exit(0)
+    except Exception as e:
+        traceback.print_exception(e)
+        sys.exit(1)
@@ -1,4 +1,4 @@
-from PIL import Image, ImageDraw
+from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 import numpy as np
 import traceback
@@ -10,12 +10,19 @@ warnings.filterwarnings("ignore", module=".*colour.*")
 
 import colour_demosaicing
 
+import analysis
 import luminance
+import memory_budget
+import metrics
+import radiance
+import session_logging
+
+log = session_logging.get_logger("cam_image")
 
 
 class Cam_Image:
     
-    def __init__(self, image:np.ndarray, timestamp:datetime, integration_time:int, gain:float, depth:float, temp:float, format:str) -> None:
+    def __init__(self, image:np.ndarray, timestamp:datetime, integration_time:int, gain:float, depth:float, temp:float, format:str, luminance_maps:bool=False, irradiance:bool=False, calibration=None, dark_model=None, defects=None) -> None:
         """Create Cam_Image object which contains an Image and a combination of pre-set and calculated metadata.
 
         Args:
@@ -25,11 +32,37 @@ class Cam_Image:
             gain (float): gain in dB
             depth (float): depth below surface when image was captured
             temp (float): Temperature of device when image was captured
+            luminance_maps (bool, optional): If True, per-pixel relative and unscaled absolute luminance maps are saved alongside the image. Defaults to False.
+            irradiance (bool, optional): If True, planar and scalar irradiance are calculated from the fisheye circle. Defaults to False.
+            calibration (calibration.Calibration, optional): If passed, dark and flat corrections are applied to the raw image before it is processed. Defaults to None.
+            dark_model (dark_model.Dark_Model, optional): If passed, the dark signal it predicts is subtracted from the raw image, unless a master dark was applied. Defaults to None.
+            defects (defects.Defect_Maps, optional): If passed, hot and dead pixels of the raw image are replaced by the mean of their neighbours. Defaults to None.
         """        
         try:
             #remove extra empty dimensions
             image = image.squeeze().astype(np.uint8)
             
+            #Subtract the dark frame and divide by the flat field (in place) before any processing
+            self._calibration : dict|None = None
+            if calibration is not None:
+                with metrics.stage("calibration"):
+                    self._calibration = calibration.correct(image, integration_time, gain, temp, format)
+            
+            #Otherwise, subtract the dark signal predicted from the device temperature and integration time
+            self._dark_offset : list[float]|None = None
+            if dark_model is not None and (self._calibration is None or self._calibration["dark"] is None):
+                with metrics.stage("dark model"):
+                    self._dark_offset = dark_model.subtract(image, integration_time/1000000, temp, gain, format)
+            
+            #Replace hot and dead pixels so they do not bias the region statistics (especially of the dark outer regions)
+            self._defects_corrected : int|None = None
+            if defects is not None:
+                with metrics.stage("defects"):
+                    self._defects_corrected = defects.correct(image, temp)
+            
+            #Keep the (corrected) raw sensor frame for processing which needs the raw values e.g. HDR merging
+            self._raw : np.ndarray = image
+            
             #Assume image mode is L (greyscale) unless the format is BayerRG8
             mode="L"
             
@@ -38,7 +71,8 @@ class Cam_Image:
             #Debayer (demosaic) image using cv2 colour conversion function
             if format=="BayerRG8":
                 mode="RGB"
-                processed_colour_image = debayer(image, method="menon", pattern="RGGB")
+                with memory_budget.stage("demosaic"), metrics.stage("demosaic"):
+                    processed_colour_image = debayer(image, method="menon", pattern="RGGB")
             
             
             
@@ -56,66 +90,69 @@ class Cam_Image:
             
             self._temp :float = temp
             
-
-            
-            #temporary values for active area of camera hardcoded in now
-            #TODO load in from json or similar
-            centre = [1226, 1034]
-            radius = 472
-            
+            self._luminance_maps : bool = luminance_maps
             
-            #Generate a mask which will hide the area outside this circle.
-            #Function was designed for a fisheye lens so this is the sensor active area for that
-            centre_mask = create_centre_mask(image, centre=centre, radius=radius)
+            #Radiance distribution is calculated when it is first used
+            self._radiance_table : np.ndarray|None = None
             
 
             
             #Change integrateion time from microseconds to seconds
             integration_sec = integration_time/1000000
             
+            #Calculate the average pixel value for each channel and fraction of all pixels saturated in the active circle,
+            #the outer dark area (outside the circle plus a margin to avoid the majority of light bleed) and the corners.
+            #If the image is monochrome, the image pixels are just relative luminance scaled to 255.
+            #If RGB, we use the IEC process as implemented in the luminance module to calculate relative luminance.
+            #The same kernels are used for stacks of frames by analysis.analyse_stack
+            with memory_budget.stage("statistics"), metrics.stage("statistics"):
+                stats = analysis.analyse_frame(image, format=format, processed=processed_colour_image if format=="BayerRG8" else None, histograms=True)
             
+            self._relative_luminance = stats["relative_luminance"]
             
-            
-            
-            self._relative_luminance = None  
-            
-            #If the image is monochrome, the image pixels are just relative luminance scaled to 255 so can use this if we apply a mask.
-            #If RGB, we use the IEC process as implemented in the luminance module to calculate relative luminance.        
-            if format == "Mono8":
-                self._relative_luminance = get_average_for_channels(self._image, mask=centre_mask)[0]/255
-            else:
-                self._relative_luminance = luminance.calc_relative_luminance(self._image, mask=centre_mask)
-                
-                
             #Calculate the unscaled absolute luminance using the IEC defined process.
-            
-            self._unscaled_absolute_luminance:float = luminance.calc_unscaled_absolute_luminance(self._image, 
-                                                                                mask=centre_mask,
-                                                                                aperture=1,
+            self._absolute_luminance_scale:float = luminance.absolute_luminance_scale(aperture=1,
                                                                                 integration_time=integration_sec,
                                                                                 speed= gain,
-                                                                                speed_format=luminance.DB,
-                                                                                relative_luminance=self._relative_luminance
-                                                                                )
-            
-            #Calculate the average pixel value for each channel and fraction of all pixels saturated in the active circle
-            self._inner_fraction_white = get_fraction_white_pixels(image, mask=centre_mask)
-            self._inner_avgs :tuple[float]= get_average_for_channels(self._image, mask=centre_mask)
-            
-            #Generate a mask which will hide the centre circle, plus a margin to avoid the majority of light bleed
-            outer_mask = create_centre_mask(image, centre=centre, radius=radius+100)
-            
-            #Calculate the average pixel value for each channel and fraction of all pixels saturated in the outer dark area
-            self._outer_fraction_white = get_fraction_white_pixels(image, mask=outer_mask, invert_mask = True)
-            self._outer_avgs:tuple[float] = get_average_for_channels(self._image, mask=outer_mask, invert_mask = True)
-            
-            
-            #Create mask which hides everything but the corners of the image
-            corner_mask = create_corner_mask(image=image, radius=200)
-            
-            #Calculate the average pixel value for each channel and fraction of all pixels saturated in the corners
-            self._corner_avgs: tuple[float]= get_average_for_channels(self._image, mask=corner_mask)
-            self._corner_fraction_white = get_fraction_white_pixels(image, mask=corner_mask)
+                                                                                speed_format=luminance.DB)
+            self._unscaled_absolute_luminance:float = self._relative_luminance*self._absolute_luminance_scale
+            
+            self._inner_fraction_white = stats["inner_fraction_white"]
+            self._inner_avgs :tuple[float]= stats["inner_avgs"]
+            self._outer_fraction_white = stats["outer_fraction_white"]
+            self._outer_avgs:tuple[float] = stats["outer_avgs"]
+            self._corner_avgs: tuple[float]= stats["corner_avgs"]
+            self._corner_fraction_white = stats["corner_fraction_white"]
+            
+            #Dark subtraction clips negative noise at 0, which raises the averages of the dark regions,
+            #so the amount added by clipping is taken off. Demosaiced frames are scaled to a maximum of 255 (see debayer),
+            #so for BayerRG8 frames the amounts (in raw values) are only recorded with the calibration.
+            if format != "BayerRG8" and self._calibration is not None and self._calibration.get("clip deficits") is not None:
+                deficits = self._calibration["clip deficits"]
+                self._outer_avgs = tuple(round(avg - deficit, 3) for avg, deficit in zip(self._outer_avgs, deficits["outer"]))
+                self._corner_avgs = tuple(round(avg - deficit, 3) for avg, deficit in zip(self._corner_avgs, deficits["corner"]))
+            
+            #Demosaiced frames are scaled per frame, so the outer averages of BayerRG8 frames are not in raw sensor values.
+            #The raw means of each colour filter in the outer region are kept as well, e.g. to fit the dark model.
+            self._outer_raw_avgs : tuple[float]|None = None
+            if format == "BayerRG8":
+                outer_raw_avgs = analysis.region_channel_means(image, format, ["outer"])["outer"]
+                if self._calibration is not None and self._calibration.get("clip deficits") is not None:
+                    outer_raw_avgs = [avg - deficit for avg, deficit in zip(outer_raw_avgs, self._calibration["clip deficits"]["outer"])]
+                self._outer_raw_avgs = tuple(round(avg, 3) for avg in outer_raw_avgs)
+            
+            #Histograms of each region the statistics above are calculated from, stored with the image by the session
+            self._histograms : dict = {"raw": stats["raw_histograms"], "channels": stats["channel_histograms"]}
+            
+            #Integrate relative and unscaled absolute planar and scalar irradiance over the fisheye circle
+            self._irradiance : dict|None = None
+            if irradiance:
+                with memory_budget.stage("irradiance"), metrics.stage("irradiance"):
+                    self._irradiance = radiance.calc_irradiance(processed_colour_image)
+                self._irradiance["unscaled absolute planar"] = self._irradiance["planar"]*self._absolute_luminance_scale
+                self._irradiance["unscaled absolute scalar"] = self._irradiance["scalar"]*self._absolute_luminance_scale
+            
+            metrics.count("frames_processed")
             
         except Exception as e:
             traceback.print_exc(e)
@@ -123,9 +160,17 @@ class Cam_Image:
     #Getter and setter functions  
         
     @property
-    def image(self) -> Image.Image:
+    def image(self) -> Image.Image|None:
+        """Processed image, or None after release()
+        """
         return self._image
     
+    @property
+    def raw(self) -> np.ndarray|None:
+        """Raw sensor frame (before demosaicing), after any dark and flat corrections, or None after release()
+        """
+        return self._raw
+    
     @property
     def format(self) -> str:
         return self._format
@@ -171,6 +216,13 @@ class Cam_Image:
     def outer_avgs(self) -> tuple[float]:
         return self._outer_avgs
     
+    @property
+    def outer_raw_avgs(self) -> tuple[float]|None:
+        """Mean raw sensor value of each colour filter in the outer region of a BayerRG8 frame, or None for other formats
+        (whose outer averages are already raw values)
+        """
+        return self._outer_raw_avgs
+    
     @property
     def outer_fraction_white(self) -> float:
         return self._outer_fraction_white
@@ -182,6 +234,73 @@ class Cam_Image:
     @property
     def corner_fraction_white(self) -> float:
         return self._corner_fraction_white
+    
+    @property
+    def histograms(self) -> dict:
+        """256 bin histograms of each region: "raw" (uint32, shape (regions, 256)) of the raw sensor values and
+        "channels" (uint32, shape (regions, channels, 256)) of the processed image. Regions are analysis.REGIONS.
+        """
+        return self._histograms
+    
+    @property
+    def calibration(self) -> dict|None:
+        """Dark and flat corrections applied to the image (see calibration.Calibration.correct), or None if it was not corrected
+        """
+        return self._calibration
+    
+    @property
+    def dark_offset(self) -> list[float]|None:
+        """Dark signal subtracted from each channel using the dark model, or None if it was not used
+        """
+        return self._dark_offset
+    
+    @property
+    def defects_corrected(self) -> int|None:
+        """Number of hot and dead pixels corrected using the defect map, or None if it was not used
+        """
+        return self._defects_corrected
+    
+    @property
+    def irradiance(self) -> dict|None:
+        """Planar and scalar irradiance (see radiance.calc_irradiance), or None if the image was not created with irradiance=True
+        """
+        return self._irradiance
+    
+    @property
+    def radiance_table(self) -> np.ndarray:
+        """Mean pixel value of each channel in each (zenith, azimuth) bin of the fisheye circle.
+        See radiance.radiance_table()
+        """
+        if self._radiance_table is None:
+            self._radiance_table = radiance.radiance_table(np.asarray(self._image))
+        return self._radiance_table
+    
+    @property
+    def released(self) -> bool:
+        """True once the pixel buffers have been released (see release())
+        """
+        return self._image is None
+
+    def record(self) -> "Frame_Record":
+        """Get the metadata and statistics of the image without its pixels
+
+        Returns:
+            Frame_Record: Frame record
+        """        
+        return Frame_Record(self)
+    
+    def release(self) -> "Frame_Record":
+        """Release the pixel buffers (processed image and raw frame) once the image has been saved and
+        merged, so that only its metadata is kept. The radiance table is calculated first if it has not been.
+        The image can no longer be saved or shown afterwards.
+
+        Returns:
+            Frame_Record: Frame record to keep in place of the image
+        """        
+        frame_record = self.record()
+        self._image = None
+        self._raw = None
+        return frame_record
 
 
 
@@ -227,6 +346,9 @@ class Cam_Image:
             bool: True if saving is successful, False otherwise
         """        
         try:
+            if self.released:
+                print("Saving unsuccessful: image pixels have been released")
+                return False
             
             metadata = self.metadata()
             
@@ -240,7 +362,14 @@ class Cam_Image:
                 except:
                     print("Saving unsuccessful: unable to resolve file path")
                     return False
-            self.image.save(path, pnginfo=metadata)
+            with memory_budget.stage("save"), metrics.stage("save"):
+                self.image.save(path, pnginfo=metadata)
+            metrics.count("bytes_written", path.stat().st_size)
+            
+            if self._luminance_maps:
+                with memory_budget.stage("luminance maps"), metrics.stage("luminance maps"):
+                    self.save_luminance_maps(path)
+                metrics.count("bytes_written", sum(map_path.stat().st_size for map_path in self.luminance_map_paths(path) if map_path.exists()))
             return True
         except Exception as e:
             print("Unable to Save Image")
@@ -248,6 +377,65 @@ class Cam_Image:
             return False
             
             
+    def luminance_map_paths(self, path:str|Path) -> tuple[Path]:
+        """Get the paths of the luminance maps for an image saved at path
+
+        Args:
+            path (str | Path): filepath of the image
+
+        Returns:
+            tuple[Path]: Paths of the relative and unscaled absolute luminance maps ([image name]_rel_lum.npy, [image name]_abs_lum.npy)
+        """        
+        path = Path(path)
+        return path.with_name(f"{path.stem}_rel_lum.npy"), path.with_name(f"{path.stem}_abs_lum.npy")
+            
+    def save_luminance_maps(self, path:str|Path) -> bool:
+        """Save per-pixel relative and unscaled absolute luminance maps of the image as float32 .npy files
+        next to the image (see luminance_map_paths). The maps are written a few rows at a time through memory maps.
+
+        Args:
+            path (str | Path): filepath of the image
+
+        Returns:
+            bool: True if saving is successful, False otherwise
+        """        
+        try:
+            relative_path, absolute_path = self.luminance_map_paths(path)
+            luminance.write_luminance_map(self.image, relative_path)
+            luminance.write_luminance_map(self.image, absolute_path, scale=self._absolute_luminance_scale)
+            return True
+        except Exception as e:
+            print("Unable to Save Luminance Maps")
+            traceback.print_exception(e)
+            return False
+            
+            
+class Frame_Record:
+    
+    #Only the metadata and statistics of a frame are stored, in slots rather than a __dict__,
+    #so a long routine can keep a record of every frame for a few hundred bytes each
+    __slots__ = ("timestamp", "format", "integration_time", "gain", "depth", "temp",
+                 "relative_luminance", "unscaled_absolute_luminance",
+                 "inner_avgs", "inner_fraction_white", "outer_avgs", "outer_raw_avgs", "outer_fraction_white", "corner_avgs", "corner_fraction_white",
+                 "calibration", "dark_offset", "defects_corrected", "irradiance", "radiance_table")
+    
+    def __init__(self, image:Cam_Image) -> None:
+        """Create a record of the metadata and statistics of a Cam_Image without its pixel buffers.
+        It has the same attributes as the Cam_Image properties, so it can be used in its place for logging
+        (e.g. session.image_record and run_table.image_row).
+
+        Args:
+            image (Cam_Image): Image to record. Its radiance table is calculated if it has not been.
+        """        
+        for name in self.__slots__:
+            setattr(self, name, getattr(image, name))
+    
+    def time_string(self, format:str="%Y_%m_%d__%H_%M_%S") -> str:
+        """Generate string of the timestamp (see Cam_Image.time_string)
+        """        
+        return datetime.strftime(self.timestamp, format)
+
+
 #functions
         
 
@@ -273,6 +461,13 @@ def debayer(image:np.ndarray, method="menon", pattern="RGGB")-> np.ndarray:
     """    
     
     start=datetime.now()
+    
+    #In memory budget mode, demosaic a band of rows at a time into a float32 buffer
+    if memory_budget.enabled():
+        rgb_array = memory_budget.debayer(image.astype(np.uint8, copy=False), method=method, pattern=pattern)
+        log.info(f"Debayering Time with method {method} (memory budget mode): {datetime.now()-start}")
+        return rgb_array
+    
     bayer_array = image.astype(np.uint8)/255
     
     debayered_array = None
@@ -301,10 +496,30 @@ def debayer(image:np.ndarray, method="menon", pattern="RGGB")-> np.ndarray:
     
     #Convert back to np.array and set type to uint8 to play nicely with PIL
     rgb_array = np.array(normalised_array).astype(np.uint8)
-    print(f"Debayering Time with method {method}:")
-    print(datetime.now()-start)
+    log.info(f"Debayering Time with method {method}: {datetime.now()-start}")
     return rgb_array
 
+def mosaic(rgb:np.ndarray, pattern:str="RGGB") -> np.ndarray:
+    """## Mosaic an Image.
+    
+    Rebuild a Bayer array from a demosaiced RGB image by taking the value of each pixel's own colour filter.
+    Used to reprocess saved images, which are stored demosaiced. The result is the demosaiced values at each
+    filter position, scaled as they were saved, rather than the original sensor values.
+
+    Args:
+        rgb (np.ndarray): RGB image array of shape (height, width, 3)
+        pattern (str, optional): Bayer pattern. Defaults to "RGGB".
+
+    Returns:
+        np.ndarray: Bayer array of shape (height, width)
+    """    
+    channels = {"R": 0, "G": 1, "B": 2}
+    bayer = np.empty(rgb.shape[:2], dtype=rgb.dtype)
+    for index, colour in enumerate(pattern.upper()):
+        row, col = divmod(index, 2)
+        bayer[row::2, col::2] = rgb[row::2, col::2, channels[colour]]
+    return bayer
+
 def create_metadata(image:Cam_Image) ->PngInfo: 
     """Create Metadata
     Create a set of metadata containing all the Cam_Image info to add to a file when saving
@@ -420,18 +635,7 @@ def create_centre_mask(image:np.ndarray, centre:tuple, radius:int) -> Image:
         Image: Image mask of same shape as  image passed in with a white circle on black background
     """    
     
-    height, width = image.shape
-    mask = Image.new('L', (width, height), 0)
-    draw = ImageDraw.Draw(mask)
-    x,y = centre
-    left = x-radius
-    right = x+radius
-    top = y-radius
-    bottom = y+radius
-    
-    draw.ellipse((left, top, right, bottom), fill=255)
-
-    return mask
+    return Image.fromarray(analysis.centre_mask(image.shape, centre, radius).astype(np.uint8)*255, mode="L")
     
 
 def create_corner_mask(image:np.ndarray, radius:int)->Image:
@@ -445,28 +649,4 @@ def create_corner_mask(image:np.ndarray, radius:int)->Image:
     Returns:
         Image: Mask image of same size as passed-in image. Black background with white corner circles
     """    
-    # Get the size of the original image
-    height, width = image.shape
-    
-    # Create a new black image of the same size
-    mask = Image.new("L", (width, height), color="black")
-    
-    # Draw circles on the new image at each corner
-    draw = ImageDraw.Draw(mask)
-  
-    
-    # Top-left corner
-    draw.ellipse((-radius, -radius, radius, radius), fill="white")
-    
-    # Top-right corner
-    draw.ellipse((width - radius, -radius, width + radius, radius), fill="white")
-    
-    # Bottom-left corner
-    draw.ellipse((-radius, height - radius, radius, height + radius), fill="white")
-    
-    # Bottom-right corner
-    draw.ellipse((width - radius, height - radius, width + radius, height + radius), fill="white")
-    
-
-    return mask
-
+    return Image.fromarray(analysis.corner_mask(image.shape, radius).astype(np.uint8)*255, mode="L")
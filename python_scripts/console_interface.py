@@ -1,9 +1,11 @@
+import argparse
+import contextlib
 import traceback
-import json
 from pathlib import Path
 import os, sys
 
 import time
+from datetime import datetime
 
 import routine
 import threading
@@ -19,14 +21,23 @@ except:
 
 import ids_interface
 import cam_image
+import preview
+import profiling
 import session
+import session_index
 
 DATA_DIR = Path(os.environ.get("DATA_DIRECTORY"))
 
+#Number of images listed on each page of the session image details menu
+IMAGE_PAGE_SIZE = 50
+
 class Console_Interface:
 
-    def __init__(self) -> None:
+    def __init__(self, profile_args:argparse.Namespace|None=None) -> None:
         """Create a console interface object to start controlling a camera device
+
+        Args:
+            profile_args (argparse.Namespace | None, optional): Profiling options (see profiling.add_arguments). Each open session is profiled if any are turned on. Defaults to None.
         """        
         print("Console Interface for Camera Control")
         self.ssh_mode = "SSH_CONNECTION" in os.environ
@@ -41,13 +52,17 @@ class Console_Interface:
         self.sessions_dict = {}
         
         self.auto_integration = False
-        session_list_path = DATA_DIR / "sessions" / "session_list.json"
-        if session_list_path.exists():
-            with open(session_list_path) as sessions_json:
-                try:
-                    self.sessions_dict = json.load(sessions_json)
-                except:
-                    pass
+        
+        self.profile_args = profile_args
+        self.profiler : profiling.Profiler|None = None
+        
+        #Sessions are listed from the session index. Existing sessions are imported the first time it is used.
+        self.index = session_index.Session_Index()
+        try:
+            self.index.ensure_imported()
+            self.sessions_dict = self.index.sessions()
+        except Exception as e:
+            traceback.print_exception(e)
         self.main_loop()       
 
 
@@ -75,6 +90,7 @@ class Console_Interface:
         """  
         try:
             options = ["[n] Start New Recording Session"]
+            self.sessions_dict = self.index.sessions()
             if len(self.sessions_dict) > 0:
                 options.append("Open Existing Session")
             options.append("[q] Quit")
@@ -100,7 +116,7 @@ class Console_Interface:
             str: Session information string
         """        
         line="\n====================================================\n"
-        name_line = f"Session: {self.session.name} | {len(self.session.log['images'])} Images"
+        name_line = f"Session: {self.session.name} | {self.session.image_count} Images"
         
         info_line = f"Start Time: {self.session.time_string()}"
         dir_line = f"Directory: {str(self.session.directory_path / self.session.name.replace(' ', '_'))}"
@@ -118,13 +134,40 @@ class Console_Interface:
         title = f"{title}{line}"
         return title
                 
-    def view_image_details(self):
+    def view_image_details(self, page:int=0):
         """# View Image Details
         
-        Shows list of images in current session and information about them
+        Shows list of images in current session and information about them.
+        Images are listed in pages of IMAGE_PAGE_SIZE, and only the records of the current page are read from the session.
+        Selecting an image shows its preview in the console.
         #TODO: Add ability to add note to image
+        
+        Args:
+            page (int, optional): Page of images to show. Defaults to 0.
         """
         
+        if self.session is None:
+            return False
+        
+        view = self.session.view()
+        page_count = view.page_count(IMAGE_PAGE_SIZE)
+        page = max(0, min(page, page_count-1))
+        images = {image['number']: image for image in view.page(page, IMAGE_PAGE_SIZE)}
+        
+        def image_number(option:str) -> int|None:
+            """Get the image number of a menu option, or None if it is not an image
+            """            
+            if option is None:
+                return None
+            if option.startswith("["): #remove shortcut part of string
+                option = option.split("] ", 1)[1]
+            
+            try:
+                number = int(option.split(".", 1)[0]) #get number part
+            except:
+                return None
+            return number if number in images else None
+        
         def get_image_details(number:str) -> str:
             """# Get Image Details
             
@@ -138,45 +181,62 @@ class Console_Interface:
             Returns:
                 str: string containing image details
             """            
-            if number.startswith("["): #remove shortcut part of string
-                number = number.split("] ", 1)[1]
-            
-            number = number.split(".", 1)[0] #get number part
-            
-            try:
-                number = int(number)
-            except:
+            number = image_number(number)
+            if number is None:
                 return "Back"
             
-            if number > len(self.session.log["images"]):
-                return "Back"
-            
-            image = self.session.log["images"][int(number)-1]
-            #print(image)
+            image = images[number]
             img_strings = []
-            i = 0
             for key, value in image.items():
                 img_strings.append(f"{key.ljust(35, '.')}{value}")
             
             return "\n".join(img_strings)
-            
-        if self.session is None:
-            return False
 
         options = []
-        for index, image in enumerate(self.session.log["images"]):
-            image:cam_image.Cam_Image
+        for index, image in enumerate(images.values()):
             img_string = f"{str(image['number']).ljust(20, '.')} - {image['time']}"
             if index < 9:
                 img_string = f"[{index+1}] {img_string}"
             options.append(img_string)
+        if page < page_count-1:
+            options.append("[n] Next Page")
+        if page > 0:
+            options.append("[p] Previous Page")
         options.append("[esc] Back")
             
-        title = f"{self.session.name} Images"
+        title = f"{self.session.name} Images (Page {page+1} of {page_count})"
+        
+        choice = get_menu_choice(options=options, title = title, status_bar=lambda x: get_image_details(x) )
+        match choice:
+            case "Next Page":
+                return self.view_image_details(page+1)
+            case "Previous Page":
+                return self.view_image_details(page-1)
         
-        get_menu_choice(options=options, title = title, status_bar=lambda x: get_image_details(x) )
+        number = image_number(choice)
+        if number is not None:
+            self.show_preview(number)
+            return self.view_image_details(page)
         
         return True
+    
+    def show_preview(self, number:int) -> None:
+        """# Show Preview
+        
+        Shows the quicklook preview of an image in the current session as coloured text, which works over SSH
+        without a display. The full size image is not opened.
+
+        Args:
+            number (int): number of image in session
+        """        
+        clear_console()
+        session_path = self.session.directory_path / self.session.name.replace(' ', '_')
+        image_path = session_path / f"{self.session.name.replace(' ', '_')}_{str(number).rjust(3, '0')}.png"
+        print(f"{image_path.name}")
+        #Previews are finished on a background thread, so wait for any still queued for this session
+        self.session.flush_previews()
+        preview.show(image_path, quicklook=True)
+        input("Press Enter to return to image list...")
                 
     def session_menu(self) -> bool:
         """# Session Menu
@@ -192,7 +252,7 @@ class Console_Interface:
             title = self.session_info_text()
             
             options = []
-            if len(self.session.log['images']) > 0:
+            if self.session.image_count > 0:
                 options.append("[d] View Session Image Details")
             if self.ids_connection is not None:
                 options.extend( ["[c] Capture Image", "[r] Run Routine", "[t] Start auto-capture process", "[i] Set Integration Time", "[g] Set Gain"])
@@ -209,7 +269,7 @@ class Console_Interface:
             
             match get_menu_choice(options, title=title):
                 case "Close Session":
-                    self.session = None
+                    self.close_session()
                     return True
                 case "View Session Image Details":
                     self.view_image_details()
@@ -232,7 +292,7 @@ class Console_Interface:
                 case "Turn off integration time auto-adjust":
                         self.auto_integration = False
                 case "Quit":
-                    self.session = None
+                    self.close_session()
                     return False
                 
                     
@@ -269,12 +329,18 @@ class Console_Interface:
         
     def run(self):
         try:
-            while self.running:
-                tick_val = self.routine.tick()
-                self.running = not tick_val["complete"]
-                img = tick_val["image"]
-                if img is not None:
-                    self.session.add_image(img)
+            #The routine runs on its own thread, which cProfile has to be enabled in
+            with self.profile_thread():
+                while self.running:
+                    tick_val = self.routine.tick()
+                    self.running = not tick_val["complete"]
+                    img = tick_val["image"]
+                    if img is not None:
+                        self.session.add_image(img)
+                        if self.profiler is not None:
+                            self.profiler.frame(self.session.image_count)
+                        #Only the image's metadata is needed once it is saved
+                        img.release()
             print("Press Enter to return to session menu...")
             self.done+=1
         except Exception as e:
@@ -411,22 +477,16 @@ class Console_Interface:
                 if name == "[open_session]":
                     return True
                     
-            self.session = session.start_session(name=name)
-            self.sessions_dict.update({self.session.name: 
-                                        {"start_time":self.session.time_string(),
-                                         "coords" : self.session.coords,
-                                         "directory_path": str(self.session.directory_path),
-                                         "images" : 0
-                                         }
-                                        })
-            with open(DATA_DIR / "sessions" / "session_list.json", "w") as session_list:
-                json.dump(self.sessions_dict, session_list, indent=4)
+            #Starting the session adds it to the session index
+            self.session = session.start_session(name=name, index=self.index)
+            self.sessions_dict = self.index.sessions()
+            self.start_profiler()
             return True
         else:
             print("Session is already running:")
             self.session.print_info()
             if confirm("Close this session and start a new one?"):
-                self.session = None
+                self.close_session()
                 return self.create_session()
         return False
     
@@ -439,6 +499,7 @@ class Console_Interface:
         """        
         options = []
         i = 0
+        self.sessions_dict = self.index.sessions()
         for key, value in self.sessions_dict.items():
             shortcut = ""
             if i < 10:
@@ -510,12 +571,55 @@ class Console_Interface:
                 if name in self.sessions_dict:
                     file_path = Path(self.sessions_dict[name]['directory_path']) / name.replace(' ', "_")
                     
-            self.session = session.from_file(file_path)
+            self.session = session.from_file(file_path, index=self.index)
+            self.start_profiler()
             return True
         except Exception as e:
             traceback.print_exc(e)
             return False
               
+    def close_session(self) -> None:
+        """# Close Session
+        Exports the current session to log.json and closes its image log
+        """        
+        if self.session is not None:
+            self.stop_profiler()
+            self.session.export_log()
+            self.session.close()
+        self.session = None
+    
+    def start_profiler(self) -> None:
+        """# Start Profiler
+        Starts profiling the open session if profiling options were given. Results are saved in the session's profile/ directory when it is closed.
+        """        
+        if self.profile_args is None or self.session is None or self.profiler is not None:
+            return
+        session_path = self.session.directory_path / self.session.name.replace(' ', '_')
+        self.profiler = profiling.from_arguments(self.profile_args, session_path, f"console_{datetime.now().strftime(session.FILEPATH_FORMAT)}")
+        if self.profiler is not None:
+            #cProfile statistics are recorded only while capturing (see profile_thread), not of the menus
+            self.profiler.start(profile_thread=False)
+    
+    def profile_thread(self):
+        """# Profile Thread
+        Context in which the current (capturing) thread is profiled, if the open session is being profiled
+        """        
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.thread()
+    
+    def stop_profiler(self) -> None:
+        """# Stop Profiler
+        Stops profiling and saves the results
+        """        
+        if self.profiler is not None:
+            try:
+                for path in self.profiler.close():
+                    print(f"Saved profile {path}")
+            except Exception as e:
+                traceback.print_exception(e)
+            self.profiler = None
+              
     def open_connection(self) ->bool:
         try:
             self.ids_connection = ids_interface.Connection()
@@ -610,11 +714,14 @@ class Console_Interface:
             if self.check_start_session() and self.check_open_connection() : #check a session is started and a device is connected
 
 
-                image = self.get_device_image()
-                if image is not None:   
-                    self.session.add_image(image)
-                    self.sessions_dict[self.session.name]["images"] += 1
-                    return True
+                with self.profile_thread():
+                    image = self.get_device_image()
+                    if image is not None:   
+                        self.session.add_image(image)
+                        if self.profiler is not None:
+                            self.profiler.frame(self.session.image_count)
+                        image.release()
+                        return True
 
             return False
         except Exception as e:
@@ -738,6 +845,9 @@ def check_integration(image:cam_image.Cam_Image, target_fraction:float) -> float
     return target_fraction - image.fraction_white
 
 if __name__ == "__main__":
-    ui = Console_Interface()
+    parser = argparse.ArgumentParser(description="Console interface for camera control")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    ui = Console_Interface(profile_args=args)
     sys.exit(0)
     
@@ -0,0 +1,328 @@
+import argparse
+import ast
+import json
+import os
+import sys
+import traceback
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+
+import session_log
+
+load_dotenv()
+
+#Model of the dark signal of the sensor against integration time and temperature.
+#The outer region of each image receives no direct light from the lens, so its pixel averages measure the dark signal.
+#The model is in raw sensor values, so for BayerRG8 images the raw mean of each colour filter in the outer region
+#is used rather than the averages of the demosaiced image, which is scaled per frame (see cam_image.debayer).
+#For each gain and channel the model is:
+#   dark = a + b*T + t*(c + d*T + e*T^2)
+#where t is the integration time in seconds and T the device temperature in °C (a fixed offset plus a
+#dark current which rises with temperature). It is fitted by least squares, and only the sums needed for the
+#normal equations are stored, so sessions can be added at any time without reading earlier sessions again.
+
+DATA_DIR = Path(os.environ.get("DATA_DIRECTORY"))
+MODEL_FILE = DATA_DIR / "calibration" / "dark_model.json"
+
+FEATURES = ["1", "T", "t", "t*T", "t*T^2"]
+CHANNELS = 3
+
+
+def features(integration_time_s:float|np.ndarray, temp:float|np.ndarray) -> np.ndarray:
+    """Get the model features for a set of capture settings
+
+    Args:
+        integration_time_s (float | np.ndarray): Integration time(s) in seconds
+        temp (float | np.ndarray): Device temperature(s) in °C
+
+    Returns:
+        np.ndarray: Array of shape (..., len(FEATURES))
+    """
+    t = np.asarray(integration_time_s, dtype=np.float64)
+    T = np.asarray(temp, dtype=np.float64)
+    return np.stack([np.ones_like(t*T), T*np.ones_like(t), t*np.ones_like(T), t*T, t*T*T], axis=-1)
+
+
+def gain_key(gain:float) -> str:
+    return f"{round(float(gain), 1):g}"
+
+
+def dark_corrected(record:dict) -> bool:
+    """Check whether the dark signal was subtracted from an image before its statistics were calculated
+
+    Args:
+        record (dict): Image record from the session output file
+
+    Returns:
+        bool: True if a master dark or the dark model was applied
+    """
+    if record.get("dark model offset") is not None:
+        return True
+    applied = record.get("calibration")
+    if isinstance(applied, str):
+        try:
+            applied = ast.literal_eval(applied)
+        except (ValueError, SyntaxError):
+            return True
+    return isinstance(applied, dict) and applied.get("dark") is not None
+
+
+class Dark_Model:
+
+    def __init__(self, path:str|Path=MODEL_FILE) -> None:
+        """Dark signal model (see module description). Loads the model from path if it exists.
+
+        Args:
+            path (str | Path, optional): Model file. Defaults to MODEL_FILE.
+        """
+        self.path = Path(path)
+        #For each gain: sums of X^T X, X^T y (one column per channel) and the number of images
+        self._sums : dict[str, dict] = {}
+        #Number of images already fitted from each session directory
+        self.sessions : dict[str, int] = {}
+        #Number of images of each session directory left out because their dark signal had already been subtracted,
+        #or because they are BayerRG8 images recorded without raw outer averages
+        self.excluded : dict[str, int] = {}
+        self._coefficients : dict[str, np.ndarray] = {}
+        if self.path.exists():
+            self.load()
+
+    def load(self) -> None:
+        with open(self.path, mode="r") as model_file:
+            model = json.load(model_file)
+        self.sessions = model["sessions"]
+        self.excluded = model.get("excluded", {})
+        self._sums = {gain: {"xtx": np.array(sums["xtx"]), "xty": np.array(sums["xty"]), "n": sums["n"]}
+                      for gain, sums in model["gains"].items()}
+        self._solve()
+
+    def save(self) -> Path:
+        """Write the model (sums, coefficients and fitted sessions) to its file
+
+        Returns:
+            Path: Model file
+        """
+        model = {"features": FEATURES,
+                 "updated": datetime.now().isoformat(timespec="seconds"),
+                 "sessions": self.sessions,
+                 "excluded": self.excluded,
+                 "gains": {gain: {"xtx": sums["xtx"].tolist(),
+                                  "xty": sums["xty"].tolist(),
+                                  "n": sums["n"],
+                                  "coefficients": self._coefficients[gain].tolist() if gain in self._coefficients else None}
+                           for gain, sums in self._sums.items()}}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(temp_path, mode="w") as model_file:
+            json.dump(model, model_file, indent=4)
+        os.replace(temp_path, self.path)
+        return self.path
+
+    def _solve(self) -> None:
+        self._coefficients = {}
+        for gain, sums in self._sums.items():
+            #Features which are constant in the data (e.g. all images at one temperature) make the system singular,
+            #so the least squares solution with the smallest coefficients is used
+            self._coefficients[gain] = np.linalg.lstsq(sums["xtx"], sums["xty"], rcond=None)[0]
+
+    def add(self, integration_time_s:np.ndarray, temp:np.ndarray, gain:np.ndarray, dark:np.ndarray) -> None:
+        """Add observations of the dark signal to the model sums. Call fit() afterwards to update the coefficients.
+
+        Args:
+            integration_time_s (np.ndarray): Integration times in seconds
+            temp (np.ndarray): Device temperatures in °C
+            gain (np.ndarray): Gains in dB
+            dark (np.ndarray): Dark signal of each channel, shape (observations, CHANNELS). Unused channels are NaN.
+        """
+        gain_keys = np.array([gain_key(g) for g in np.atleast_1d(gain)])
+        x = features(integration_time_s, temp)
+        dark = np.nan_to_num(np.asarray(dark, dtype=np.float64))
+        for key in np.unique(gain_keys):
+            rows = gain_keys == key
+            sums = self._sums.setdefault(key, {"xtx": np.zeros((len(FEATURES), len(FEATURES))),
+                                               "xty": np.zeros((len(FEATURES), CHANNELS)),
+                                               "n": 0})
+            sums["xtx"] += x[rows].T @ x[rows]
+            sums["xty"] += x[rows].T @ dark[rows]
+            sums["n"] += int(rows.sum())
+
+    def fit(self) -> None:
+        """Update the coefficients from the observations added
+        """
+        self._solve()
+
+    def add_session(self, directory:str|Path) -> int:
+        """Add the images of a session which have not already been added to the model.
+        The outer region pixel averages of each image are used as its dark signal, or for BayerRG8 images
+        the raw means of each colour filter in the outer region ("outer raw averages").
+        Images which were dark corrected when captured (with a master dark or this model) are left out and counted
+        in self.excluded, as their outer averages are only the residual and would pull the model towards 0.
+        BayerRG8 images recorded without raw outer averages (by earlier versions) are also left out and counted,
+        as the averages of the demosaiced image are not in raw values.
+
+        Args:
+            directory (str | Path): Session directory
+
+        Returns:
+            int: Number of images added
+        """
+        directory = Path(directory)
+        key = str(directory.resolve())
+        done = self.sessions.get(key, 0)
+
+        rows = []
+        excluded = 0
+        count = 0
+        for count, record in enumerate(session_log.iter_records(directory), start=1):
+            if count <= done:
+                continue
+            if dark_corrected(record) or (record.get("format") == "BayerRG8" and record.get("outer raw averages") is None):
+                excluded += 1
+                continue
+            try:
+                averages = record["outer raw averages"] if record.get("format") == "BayerRG8" else record["outer_pixel_averages"]
+                if isinstance(averages, str):
+                    averages = ast.literal_eval(averages)
+                averages = [np.nan if value is None else value for value in averages]
+                rows.append((record["integration (seconds)"], record["device temp (°C)"], record["gain (dB)"],
+                             (averages + [np.nan]*CHANNELS)[:CHANNELS]))
+            except Exception:
+                #Images without the needed fields are skipped
+                continue
+
+        if len(rows) > 0:
+            int_times, temps, gains, darks = zip(*rows)
+            self.add(np.array(int_times), np.array(temps), np.array(gains), np.array(darks))
+        self.sessions[key] = max(count, done)
+        if excluded > 0:
+            self.excluded[key] = self.excluded.get(key, 0) + excluded
+        return len(rows)
+
+    def gains(self) -> list[float]:
+        return sorted(float(gain) for gain in self._coefficients)
+
+    def coefficients(self, gain:float) -> np.ndarray|None:
+        """Get the coefficients of the model for a gain
+
+        Args:
+            gain (float): Gain in dB
+
+        Returns:
+            np.ndarray | None: Array of shape (len(FEATURES), CHANNELS), or None if there is no model for the gain
+        """
+        return self._coefficients.get(gain_key(gain))
+
+    def predict(self, integration_time_s:float, temp:float, gain:float) -> np.ndarray|None:
+        """Predict the dark signal of each channel
+
+        Args:
+            integration_time_s (float): Integration time in seconds
+            temp (float): Device temperature in °C
+            gain (float): Gain in dB
+
+        Returns:
+            np.ndarray | None: Dark signal of each channel, or None if there is no model for the gain
+        """
+        coefficients = self.coefficients(gain)
+        if coefficients is None:
+            return None
+        t, T = integration_time_s, temp
+        return np.array([1, T, t, t*T, t*T*T]) @ coefficients
+
+    def subtract(self, raw:np.ndarray, integration_time_s:float, temp:float, gain:float, format:str) -> list[float]|None:
+        """Subtract the predicted dark signal from a raw frame in place, clipping at 0.
+        For BayerRG8 frames, each channel's offset is subtracted from the pixels of its colour filter
+        (the model is fitted on the raw means of each colour filter, so the offsets are in raw values).
+
+        Args:
+            raw (np.ndarray): Raw uint8 sensor frame (before demosaicing). It is overwritten with the corrected frame.
+            integration_time_s (float): Integration time in seconds
+            temp (float): Device temperature in °C
+            gain (float): Gain in dB
+            format (str): Pixel format of the frame ("Mono8" or "BayerRG8")
+
+        Returns:
+            list[float] | None: Offset subtracted from each channel, or None if there is no model for the gain
+        """
+        offsets = self.predict(integration_time_s, temp, gain)
+        if offsets is None:
+            return None
+        offsets = np.clip(np.rint(offsets), 0, 255).astype(raw.dtype)
+
+        if format == "BayerRG8":
+            #RGGB: red at (0, 0), green at (0, 1) and (1, 0), blue at (1, 1)
+            views = [(raw[0::2, 0::2], offsets[0]), (raw[0::2, 1::2], offsets[1]),
+                     (raw[1::2, 0::2], offsets[1]), (raw[1::2, 1::2], offsets[2])]
+        else:
+            views = [(raw, offsets[0])]
+
+        for view, offset in views:
+            #Subtracting the smaller of the pixel and the offset clips at 0 without leaving the integer type
+            np.subtract(view, np.minimum(view, offset), out=view)
+
+        return offsets[:1 if format != "BayerRG8" else CHANNELS].tolist()
+
+
+def main():
+    """Fit the dark signal model from session data.
+    Call from command line with:
+    $> dark_model.py fit [session directories]...     (all sessions in the index if none are given)
+    $> dark_model.py show
+    $> dark_model.py predict --int-time [seconds] --temp [°C] --gain [dB]
+    """
+    parser = argparse.ArgumentParser(description="Fit the dark signal model from session data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    fit_parser = subparsers.add_parser("fit", help="Add sessions to the model")
+    fit_parser.add_argument("directories", nargs="*", help="Session directories")
+    subparsers.add_parser("show", help="Show the model coefficients")
+    predict_parser = subparsers.add_parser("predict", help="Predict the dark signal")
+    predict_parser.add_argument("--int-time", type=float, required=True, help="Integration time (seconds)")
+    predict_parser.add_argument("--temp", type=float, required=True, help="Device temperature (°C)")
+    predict_parser.add_argument("--gain", type=float, required=True, help="Gain (dB)")
+    args = parser.parse_args()
+
+    model = Dark_Model()
+
+    if args.command == "fit":
+        directories = args.directories
+        if len(directories) == 0:
+            import session_index
+            index = session_index.Session_Index()
+            index.ensure_imported()
+            directories = [Path(details["directory_path"]) / name.replace(" ", "_") for name, details in index.sessions().items()]
+        total = 0
+        for directory in directories:
+            if Path(directory).exists():
+                added = model.add_session(directory)
+                total += added
+                print(f"{directory}: {added} new images")
+                excluded = model.excluded.get(str(Path(directory).resolve()), 0)
+                if excluded > 0:
+                    print(f"{directory}: {excluded} images left out (dark corrected, or BayerRG8 without raw outer averages)")
+        model.fit()
+        print(f"Added {total} images. Model saved to {model.save()}")
+
+    elif args.command == "show":
+        for gain in model.gains():
+            print(f"Gain {gain}dB ({model._sums[gain_key(gain)]['n']} images):")
+            for feature, row in zip(FEATURES, model.coefficients(gain)):
+                print(f"  {feature.ljust(6)} " + " ".join(f"{value:12.5g}" for value in row))
+
+    elif args.command == "predict":
+        prediction = model.predict(args.int_time, args.temp, args.gain)
+        if prediction is None:
+            print(f"No model for gain {args.gain}dB. Fitted gains: {model.gains()}")
+        else:
+            print(" ".join(f"{value:.3f}" for value in prediction))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+        sys.exit(0)
+    except Exception as e:
+        traceback.print_exception(e)
+        sys.exit(1)
@@ -0,0 +1,364 @@
+import argparse
+import json
+import os
+import sys
+import traceback
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+
+import calibration
+import stacking
+
+load_dotenv()
+
+#Hot and dead pixel maps.
+#Hot pixels are found from the per-pixel mean of dark frames, and dead pixels from the mean of flat frames.
+#The means are accumulated frame by frame (see mean_frame). Each map is a sorted array of the flat index
+#of every defective pixel, stored for each device and temperature bin (see calibration.temp_bin) as defects increase
+#with temperature. Defects are replaced in the raw frame, before demosaicing and region statistics, by the mean of their
+#nearest neighbours with the same colour filter. The neighbours of each defect are found once when the map is loaded,
+#so correcting a frame only reads and writes the defective pixels and their neighbours.
+
+DATA_DIR = Path(os.environ.get("DATA_DIRECTORY"))
+DEFECTS_DIR = DATA_DIR / "calibration" / "defects"
+INDEX_FILE = "defects.json"
+
+HOT = 1
+DEAD = 2
+
+#A pixel is hot if its dark mean is this many robust standard deviations (1.4826 x median absolute deviation)
+#above the median of pixels with the same colour filter, and at least HOT_MIN_OFFSET above it
+HOT_SIGMA = 8.0
+HOT_MIN_OFFSET = 8.0
+#A pixel is dead if its flat mean is below this fraction of the median of lit pixels with the same colour filter
+DEAD_FRACTION = 0.5
+
+#Number of defect maps kept in memory
+CACHE_SIZE = 4
+
+
+def phase_views(frame:np.ndarray, bayer:bool) -> list[np.ndarray]:
+    """Split a frame into the pixels of each colour filter position (2x2 for Bayer frames)
+    """
+    if not bayer:
+        return [frame]
+    return [frame[row::2, col::2] for row in range(2) for col in range(2)]
+
+
+def find_hot_pixels(dark_mean:np.ndarray, bayer:bool, sigma:float=HOT_SIGMA, min_offset:float=HOT_MIN_OFFSET) -> np.ndarray:
+    """Find hot pixels in the mean of dark frames
+
+    Args:
+        dark_mean (np.ndarray): Per-pixel mean of dark frames
+        bayer (bool): The frames are raw Bayer frames, so each colour filter position is compared separately
+        sigma (float, optional): Threshold in robust standard deviations. Defaults to HOT_SIGMA.
+        min_offset (float, optional): Minimum value above the median. Defaults to HOT_MIN_OFFSET.
+
+    Returns:
+        np.ndarray: Boolean map of hot pixels
+    """
+    hot = np.zeros(dark_mean.shape, dtype=bool)
+    for values, flags in zip(phase_views(dark_mean, bayer), phase_views(hot, bayer)):
+        median = np.median(values)
+        spread = 1.4826 * np.median(np.abs(values - median))
+        flags[...] = values > median + max(sigma * spread, min_offset)
+    return hot
+
+
+def find_dead_pixels(flat_mean:np.ndarray, bayer:bool, lit:np.ndarray|None=None, fraction:float=DEAD_FRACTION) -> np.ndarray:
+    """Find dead pixels in the mean of flat frames
+
+    Args:
+        flat_mean (np.ndarray): Per-pixel mean of flat frames
+        bayer (bool): The frames are raw Bayer frames, so each colour filter position is compared separately
+        lit (np.ndarray | None, optional): Boolean map of the lit area (e.g. the fisheye circle). Defaults to None (the whole frame).
+        fraction (float, optional): Pixels below this fraction of the median are dead. Defaults to DEAD_FRACTION.
+
+    Returns:
+        np.ndarray: Boolean map of dead pixels
+    """
+    if lit is None:
+        lit = np.ones(flat_mean.shape, dtype=bool)
+    dead = np.zeros(flat_mean.shape, dtype=bool)
+    for values, lit_flags, flags in zip(phase_views(flat_mean, bayer), phase_views(lit, bayer), phase_views(dead, bayer)):
+        median = np.median(values[lit_flags])
+        flags[...] = lit_flags & (values < median * fraction)
+    return dead
+
+
+class Defect_Map:
+
+    def __init__(self, shape:tuple[int], index:np.ndarray, kind:np.ndarray, bayer:bool) -> None:
+        """Defective pixels of a sensor, and the neighbours used to correct each one
+
+        Args:
+            shape (tuple[int]): Shape (height, width) of the raw frames
+            index (np.ndarray): Sorted flat index of each defective pixel
+            kind (np.ndarray): HOT or DEAD for each defective pixel
+            bayer (bool): The frames are raw Bayer frames, so defects are replaced from pixels with the same colour filter
+        """
+        self.shape = tuple(shape[:2])
+        self.index = np.asarray(index, dtype=np.int64)
+        self.kind = np.asarray(kind, dtype=np.uint8)
+        self.bayer = bayer
+        self.neighbours, self.valid = self._find_neighbours()
+        self._counts = np.maximum(self.valid.sum(axis=1), 1)
+        #Defects with no usable neighbour are left as they are
+        self._correctable = self.valid.any(axis=1)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _find_neighbours(self) -> tuple[np.ndarray, np.ndarray]:
+        height, width = self.shape
+        step = 2 if self.bayer else 1
+        rows, cols = np.divmod(self.index, width)
+        offsets = [(-step, 0), (step, 0), (0, -step), (0, step)]
+        neighbour_rows = rows[:, np.newaxis] + np.array([offset[0] for offset in offsets])
+        neighbour_cols = cols[:, np.newaxis] + np.array([offset[1] for offset in offsets])
+        valid = (neighbour_rows >= 0) & (neighbour_rows < height) & (neighbour_cols >= 0) & (neighbour_cols < width)
+        neighbours = np.where(valid, neighbour_rows * width + neighbour_cols, 0)
+
+        #Neighbours which are also defects are not used
+        position = np.minimum(np.searchsorted(self.index, neighbours), max(len(self.index) - 1, 0))
+        if len(self.index) > 0:
+            valid &= self.index[position] != neighbours
+        return neighbours, valid
+
+    def correct(self, raw:np.ndarray) -> int:
+        """Replace each defective pixel of a raw frame in place with the mean of its neighbours
+
+        Args:
+            raw (np.ndarray): Raw frame of shape self.shape. It is overwritten with the corrected frame.
+
+        Returns:
+            int: Number of pixels corrected
+        """
+        if raw.shape[:2] != self.shape:
+            raise ValueError(f"Frame shape {raw.shape} does not match the defect map {self.shape}")
+        if len(self.index) == 0:
+            return 0
+        pixels = raw.reshape(-1)
+        values = np.where(self.valid, pixels[self.neighbours], 0).sum(axis=1, dtype=np.float64) / self._counts
+        index = self.index[self._correctable]
+        pixels[index] = np.rint(values[self._correctable]).astype(raw.dtype)
+        return len(index)
+
+
+def mean_frame(frames) -> tuple[np.ndarray, int]:
+    """Get the per-pixel mean of a stream of raw frames, accumulated one frame at a time
+
+    Args:
+        frames: Iterable of raw frames
+
+    Returns:
+        tuple[np.ndarray, int]: float32 mean frame and the number of frames
+    """
+    stack = stacking.Frame_Stack()
+    for frame in frames:
+        stack.add(frame)
+    return stack.mean(), stack.count
+
+
+def detect(dark_mean:np.ndarray, flat_mean:np.ndarray|None=None, bayer:bool=True, lit:np.ndarray|None=None) -> tuple[Defect_Map, dict]:
+    """Find the hot and dead pixels of a sensor
+
+    Args:
+        dark_mean (np.ndarray): Mean of raw frames captured with the lens covered (see mean_frame())
+        flat_mean (np.ndarray | None, optional): Mean of raw frames of a uniformly lit target. Defaults to None (only hot pixels are found).
+        bayer (bool, optional): The frames are raw Bayer frames. Defaults to True.
+        lit (np.ndarray | None, optional): Boolean map of the area lit in the flat frames. Defaults to None (the whole frame).
+
+    Returns:
+        tuple[Defect_Map, dict]: Defect map, and {"hot", "dead"} counts
+    """
+    hot = find_hot_pixels(dark_mean, bayer)
+    dead = np.zeros(hot.shape, dtype=bool)
+    if flat_mean is not None:
+        dead = find_dead_pixels(flat_mean, bayer, lit=lit) & ~hot
+
+    index = np.flatnonzero(hot | dead)
+    kind = np.where(hot.reshape(-1)[index], HOT, DEAD).astype(np.uint8)
+    summary = {"hot": int(np.count_nonzero(hot)), "dead": int(np.count_nonzero(dead))}
+    return Defect_Map(hot.shape, index, kind, bayer), summary
+
+
+class Defect_Maps:
+
+    def __init__(self, serial:str|None, directory:str|Path=DEFECTS_DIR) -> None:
+        """Defect maps of a device for each temperature bin
+
+        Args:
+            serial (str | None): Device serial number
+            directory (str | Path, optional): Directory the maps are stored in. Defaults to DEFECTS_DIR.
+        """
+        self.serial = str(serial)
+        self.directory = Path(directory)
+        self.entries : list[dict] = []
+        self._cache : dict[int, Defect_Map] = {}
+        self.load_index()
+
+    def load_index(self) -> None:
+        index_path = self.directory / INDEX_FILE
+        self.entries = []
+        if index_path.exists():
+            with open(index_path, mode="r") as index_file:
+                self.entries = json.load(index_file).get(self.serial, [])
+
+    def add(self, defect_map:Defect_Map, temp:float, summary:dict|None=None) -> dict:
+        """Save a defect map for a temperature, replacing any map in the same temperature bin
+
+        Args:
+            defect_map (Defect_Map): Defect map
+            temp (float): Device temperature when the frames were captured in °C
+            summary (dict | None, optional): Detection summary to store with the map (see detect()). Defaults to None.
+
+        Returns:
+            dict: Index entry of the map
+        """
+        temperature_bin = calibration.temp_bin(temp)
+        file_name = f"defects_{self.serial}_t{temperature_bin}.npz"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        temp_path = self.directory / f"{file_name}.tmp.npz"
+        np.savez(temp_path, index=defect_map.index, kind=defect_map.kind, shape=np.array(defect_map.shape), bayer=defect_map.bayer)
+        os.replace(temp_path, self.directory / file_name)
+
+        entry = {"temp_bin": temperature_bin, "temp": temp, "file": file_name, "defects": len(defect_map),
+                 "created": datetime.now().isoformat(timespec="seconds"), **(summary or {})}
+        self.entries = [existing for existing in self.entries if existing["temp_bin"] != temperature_bin] + [entry]
+        self.entries.sort(key=lambda existing: existing["temp_bin"])
+        self._save_index()
+        self._cache[temperature_bin] = defect_map
+        return entry
+
+    def _save_index(self) -> None:
+        index_path = self.directory / INDEX_FILE
+        index = {}
+        if index_path.exists():
+            with open(index_path, mode="r") as index_file:
+                index = json.load(index_file)
+        index[self.serial] = self.entries
+        temp_path = index_path.with_name(INDEX_FILE + ".tmp")
+        with open(temp_path, mode="w") as index_file:
+            json.dump(index, index_file, indent=4)
+        os.replace(temp_path, index_path)
+
+    def get(self, temp:float) -> Defect_Map|None:
+        """Get the defect map for a device temperature: the map of its temperature bin, or the nearest bin if there is none
+
+        Args:
+            temp (float): Device temperature in °C
+
+        Returns:
+            Defect_Map | None: Defect map, or None if there are no maps for the device
+        """
+        if len(self.entries) == 0:
+            return None
+        temperature_bin = calibration.temp_bin(temp)
+        entry = min(self.entries, key=lambda existing: abs(existing["temp_bin"] - temperature_bin))
+        if entry["temp_bin"] not in self._cache:
+            with np.load(self.directory / entry["file"]) as saved:
+                defect_map = Defect_Map(tuple(saved["shape"]), saved["index"], saved["kind"], bool(saved["bayer"]))
+            if len(self._cache) >= CACHE_SIZE:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[entry["temp_bin"]] = defect_map
+        return self._cache[entry["temp_bin"]]
+
+    def correct(self, raw:np.ndarray, temp:float) -> int|None:
+        """Correct the defective pixels of a raw frame in place using the map for the device temperature
+
+        Args:
+            raw (np.ndarray): Raw frame. It is overwritten with the corrected frame.
+            temp (float): Device temperature in °C
+
+        Returns:
+            int | None: Number of pixels corrected, or None if there is no map for the frame
+        """
+        defect_map = self.get(temp)
+        if defect_map is None or defect_map.shape != raw.shape[:2]:
+            return None
+        return defect_map.correct(raw)
+
+
+def main():
+    """Find the hot and dead pixels of the connected device.
+    Call from command line with:
+    $> defects.py detect --int-time [seconds] --gain [dB] --frames [N] [--flat [--flat-int-time seconds]]
+    $> defects.py list
+    """
+    parser = argparse.ArgumentParser(description="Find the hot and dead pixels of the connected device")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    detect_parser = subparsers.add_parser("detect", help="Capture dark (and flat) frames and save a defect map")
+    detect_parser.add_argument("--int-time", type=float, default=10, help="Integration time of the dark frames (seconds). Long exposures show more hot pixels.")
+    detect_parser.add_argument("--gain", type=float, default=1.0, help="Gain (dB)")
+    detect_parser.add_argument("--frames", type=int, default=16, help="Frames to capture")
+    detect_parser.add_argument("--flat", action="store_true", help="Also capture flat frames to find dead pixels")
+    detect_parser.add_argument("--flat-int-time", type=float, default=0.01, help="Integration time of the flat frames (seconds)")
+    list_parser = subparsers.add_parser("list", help="List the defect maps of a device")
+    list_parser.add_argument("--serial", help="Device serial number (default: every device)")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        index_path = DEFECTS_DIR / INDEX_FILE
+        index = {}
+        if index_path.exists():
+            with open(index_path, mode="r") as index_file:
+                index = json.load(index_file)
+        for serial, entries in index.items():
+            if args.serial is not None and serial != args.serial:
+                continue
+            for entry in entries:
+                print(f"{serial} {entry['temp_bin']*calibration.TEMP_BIN_C}°C: {entry.get('hot', '?')} hot, {entry.get('dead', '?')} dead ({entry['file']})")
+        return
+
+    import analysis
+    import geometry
+    import ids_interface
+    device = ids_interface.Connection()
+    if not device.connected:
+        print("Could not connect to Device")
+        sys.exit(1)
+
+    def capture(count:int):
+        for i in range(count):
+            print(f"Capturing frame {i+1}/{count}", end="\r")
+            yield device.single_frame_acquisition()
+        print()
+
+    try:
+        bayer = not device.mono
+        device.gain(args.gain)
+        input("Cover the lens and press Enter...")
+        device.exposure_time(seconds=args.int_time)
+        temp = device.get_temperature()
+        dark_mean, dark_count = mean_frame(capture(args.frames))
+        summary = {"dark frames": dark_count, "integration (seconds)": args.int_time, "gain (dB)": args.gain}
+
+        flat_mean = None
+        lit = None
+        if args.flat:
+            input("Point the device at a uniformly lit target and press Enter...")
+            device.exposure_time(seconds=args.flat_int_time)
+            flat_mean, summary["flat frames"] = mean_frame(capture(args.frames))
+            #Only the fisheye circle is lit
+            active = geometry.get_geometry()
+            lit = analysis.centre_mask(flat_mean.shape, active.centre, active.radius)
+
+        defect_map, counts = detect(dark_mean, flat_mean, bayer=bayer, lit=lit)
+        summary.update(counts)
+        entry = Defect_Maps(device.info.get("Serial Number")).add(defect_map, temp, summary)
+        print(f"Found {summary['hot']} hot and {summary['dead']} dead pixels. Saved {entry['file']}")
+    finally:
+        device.close_connection()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+        sys.exit(0)
+    except Exception as e:
+        traceback.print_exception(e)
+        sys.exit(1)
@@ -0,0 +1,311 @@
+import argparse
+import json
+import os
+import sys
+import traceback
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+#Geometry of the fisheye circle (the active area of the sensor) for each device.
+#The circle is detected from a bright frame and saved by device serial number in the calibration directory.
+#The geometry of the connected device is loaded once when it is opened, and every mask and region
+#(analysis region masks, radiance bins, irradiance weights and auto exposure) uses the one active geometry.
+
+DATA_DIR = Path(os.environ.get("DATA_DIRECTORY"))
+GEOMETRY_FILE = DATA_DIR / "calibration" / "geometry.json"
+
+#Geometry used when none has been saved for the device
+DEFAULT_CENTRE = (1226, 1034)
+DEFAULT_RADIUS = 472
+
+#Frames are reduced by this factor in each direction before detection
+DOWNSAMPLE = 8
+#A detected circle must contain at least this fraction of the bright pixels
+MIN_FILL = 0.9
+
+
+class Lens_Geometry:
+
+    def __init__(self, centre:tuple[int], radius:int, serial:str|None=None, shape:tuple[int]|None=None, detected:str|None=None) -> None:
+        """Centre and radius of the fisheye circle of a device
+
+        Args:
+            centre (tuple[int]): Centre (x, y) of the circle in pixels
+            radius (int): Radius of the circle in pixels
+            serial (str | None, optional): Serial number of the device. Defaults to None.
+            shape (tuple[int] | None, optional): Shape (height, width) of the frame it was detected from. Defaults to None.
+            detected (str | None, optional): Time it was detected. Defaults to None.
+        """
+        self.centre : tuple[int] = (int(centre[0]), int(centre[1]))
+        self.radius : int = int(radius)
+        self.serial = serial
+        self.shape = None if shape is None else tuple(shape)
+        self.detected = detected
+
+    def __repr__(self) -> str:
+        return f"Lens_Geometry(centre={self.centre}, radius={self.radius}, serial={self.serial})"
+
+    def to_dict(self) -> dict:
+        return {"centre": list(self.centre), "radius": self.radius, "serial": self.serial,
+                "shape": None if self.shape is None else list(self.shape), "detected": self.detected}
+
+
+def from_dict(values:dict, serial:str|None=None) -> Lens_Geometry:
+    """Make a geometry from a dict written by Lens_Geometry.to_dict (e.g. saved in a session header)
+
+    Args:
+        values (dict): Geometry dict
+        serial (str | None, optional): Device serial number, if it is not in the dict. Defaults to None.
+
+    Returns:
+        Lens_Geometry: Geometry
+    """
+    return Lens_Geometry(values["centre"], values["radius"], serial=values.get("serial", serial),
+                         shape=values.get("shape"), detected=values.get("detected"))
+
+
+DEFAULT_GEOMETRY = Lens_Geometry(DEFAULT_CENTRE, DEFAULT_RADIUS)
+
+_active : Lens_Geometry = DEFAULT_GEOMETRY
+
+
+def get_geometry() -> Lens_Geometry:
+    """Get the active geometry (of the connected device, or the default geometry)
+
+    Returns:
+        Lens_Geometry: Active geometry
+    """
+    return _active
+
+
+def set_geometry(geometry:Lens_Geometry) -> None:
+    """Make a geometry the active geometry used by all masks and regions
+
+    Args:
+        geometry (Lens_Geometry): Geometry
+    """
+    global _active
+    _active = geometry
+
+
+def read_geometries(path:str|Path=GEOMETRY_FILE) -> dict:
+    """Read the saved geometries
+
+    Args:
+        path (str | Path, optional): Geometry file. Defaults to GEOMETRY_FILE.
+
+    Returns:
+        dict: {serial number: geometry dict}
+    """
+    path = Path(path)
+    if not path.exists():
+        return {}
+    with open(path, mode="r") as geometry_file:
+        return json.load(geometry_file)
+
+
+def save_geometry(geometry:Lens_Geometry, path:str|Path=GEOMETRY_FILE) -> Path:
+    """Save a geometry for its device serial number
+
+    Args:
+        geometry (Lens_Geometry): Geometry with a serial number
+        path (str | Path, optional): Geometry file. Defaults to GEOMETRY_FILE.
+
+    Returns:
+        Path: Geometry file
+    """
+    if geometry.serial is None:
+        raise ValueError("A geometry must have a device serial number to be saved")
+    path = Path(path)
+    geometries = read_geometries(path)
+    geometries[geometry.serial] = geometry.to_dict()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, mode="w") as geometry_file:
+        json.dump(geometries, geometry_file, indent=4)
+    os.replace(temp_path, path)
+    return path
+
+
+def load_geometry(serial:str|None, path:str|Path=GEOMETRY_FILE) -> Lens_Geometry:
+    """Load the saved geometry of a device and make it the active geometry.
+    The default geometry is used if none has been saved for the device.
+
+    Args:
+        serial (str | None): Device serial number
+        path (str | Path, optional): Geometry file. Defaults to GEOMETRY_FILE.
+
+    Returns:
+        Lens_Geometry: Active geometry
+    """
+    geometry = None
+    try:
+        saved = read_geometries(path).get(serial)
+        if saved is not None:
+            geometry = from_dict(saved, serial=serial)
+    except Exception as e:
+        print(f"Unable to load geometry from {path}")
+        traceback.print_exception(e)
+
+    if geometry is None:
+        print(f"No geometry saved for device {serial}, using centre {DEFAULT_CENTRE} and radius {DEFAULT_RADIUS}. Run geometry.py detect to detect it.")
+        geometry = Lens_Geometry(DEFAULT_CENTRE, DEFAULT_RADIUS, serial=serial)
+    set_geometry(geometry)
+    return geometry
+
+
+def downsample(frame:np.ndarray, factor:int=DOWNSAMPLE) -> np.ndarray:
+    """Reduce a frame by averaging blocks of factor x factor pixels (and all channels).
+    For a raw Bayer frame each block covers every colour filter, so it can be used without demosaicing.
+
+    Args:
+        frame (np.ndarray): Frame of shape (height, width) or (height, width, channels)
+        factor (int, optional): Block size. Defaults to DOWNSAMPLE.
+
+    Returns:
+        np.ndarray: float32 array of shape (height // factor, width // factor)
+    """
+    height, width = frame.shape[:2]
+    height, width = height - height % factor, width - width % factor
+    blocks = frame[:height, :width].reshape(height // factor, factor, width // factor, factor, -1)
+    return blocks.mean(axis=(1, 3, 4), dtype=np.float32)
+
+
+def otsu_threshold(values:np.ndarray, bins:int=256) -> float:
+    """Find the threshold which best separates values into two classes (Otsu's method)
+
+    Args:
+        values (np.ndarray): Values
+        bins (int, optional): Number of histogram bins. Defaults to 256.
+
+    Returns:
+        float: Threshold
+    """
+    counts, edges = np.histogram(values, bins=bins)
+    centres = (edges[:-1] + edges[1:]) / 2
+    weight_low = np.cumsum(counts)
+    weight_high = weight_low[-1] - weight_low
+    sum_low = np.cumsum(counts * centres)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_low = sum_low / weight_low
+        mean_high = (sum_low[-1] - sum_low) / weight_high
+        between = weight_low * weight_high * (mean_low - mean_high)**2
+    return float(centres[np.nanargmax(between)])
+
+
+def detect_circle(frame:np.ndarray, factor:int=DOWNSAMPLE) -> tuple[tuple[int], int]:
+    """Detect the fisheye circle in a bright frame (e.g. pointed at a lit, even scene).
+    The frame is downsampled, thresholded with Otsu's method, and the circle is taken as the centroid of the bright
+    pixels, with the radius of a circle of the same area.
+
+    Args:
+        frame (np.ndarray): Raw or processed frame
+        factor (int, optional): Downsampling factor. Defaults to DOWNSAMPLE.
+
+    Returns:
+        tuple[tuple[int], int]: Centre (x, y) and radius in full resolution pixels
+
+    Raises:
+        ValueError: If no circle is found
+    """
+    small = downsample(frame, factor)
+    bright = small > otsu_threshold(small)
+    if np.count_nonzero(bright) < 16:
+        raise ValueError("No bright area found. Use a frame of a bright, even scene.")
+
+    rows, cols = np.nonzero(bright)
+    x, y = cols.mean(), rows.mean()
+    radius = np.sqrt(rows.size / np.pi)
+
+    #The bright pixels should be a filled circle. Stray light or a scene with dark areas gives a poor fit.
+    inside = np.hypot(cols - x, rows - y) <= radius
+    fill = np.count_nonzero(inside) / rows.size
+    if fill < MIN_FILL:
+        raise ValueError(f"Bright area is not circular ({fill:.0%} inside the fitted circle). Use a frame of a bright, even scene.")
+
+    #Block (i, j) covers full resolution pixels i*factor to (i+1)*factor - 1
+    centre = (int(round((x + 0.5) * factor - 0.5)), int(round((y + 0.5) * factor - 0.5)))
+    return centre, int(round(radius * factor))
+
+
+def detect_geometry(frame:np.ndarray, serial:str|None=None, factor:int=DOWNSAMPLE) -> Lens_Geometry:
+    """Detect the geometry of a device from a bright frame (see detect_circle)
+
+    Args:
+        frame (np.ndarray): Raw or processed frame
+        serial (str | None, optional): Device serial number. Defaults to None.
+        factor (int, optional): Downsampling factor. Defaults to DOWNSAMPLE.
+
+    Returns:
+        Lens_Geometry: Detected geometry
+    """
+    centre, radius = detect_circle(frame, factor)
+    return Lens_Geometry(centre, radius, serial=serial, shape=frame.shape[:2], detected=datetime.now().isoformat(timespec="seconds"))
+
+
+def main():
+    """Detect and save the fisheye circle of a device.
+    Call from command line with:
+    $> geometry.py detect [--image image file] [--serial serial number]   (captures a frame with the connected device if no image is given)
+    $> geometry.py set --serial [serial number] --centre [x] [y] --radius [r]
+    $> geometry.py show
+    """
+    parser = argparse.ArgumentParser(description="Detect and save the fisheye circle of a device")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    detect_parser = subparsers.add_parser("detect", help="Detect the circle from a bright frame")
+    detect_parser.add_argument("--image", help="Image of a bright, even scene (default: capture a frame with the connected device)")
+    detect_parser.add_argument("--serial", help="Device serial number (default: the connected device)")
+    detect_parser.add_argument("--dry-run", action="store_true", help="Show the detected circle without saving it")
+    set_parser = subparsers.add_parser("set", help="Set the circle manually")
+    set_parser.add_argument("--serial", required=True, help="Device serial number")
+    set_parser.add_argument("--centre", type=int, nargs=2, required=True, metavar=("X", "Y"))
+    set_parser.add_argument("--radius", type=int, required=True)
+    subparsers.add_parser("show", help="Show saved geometries")
+    args = parser.parse_args()
+
+    if args.command == "show":
+        for serial, saved in read_geometries().items():
+            print(f"{serial}: centre {tuple(saved['centre'])}, radius {saved['radius']} (detected {saved.get('detected')})")
+        return
+
+    if args.command == "set":
+        print(f"Saved to {save_geometry(Lens_Geometry(args.centre, args.radius, serial=args.serial))}")
+        return
+
+    serial = args.serial
+    if args.image is not None:
+        from PIL import Image
+        with Image.open(args.image) as image:
+            frame = np.asarray(image)
+    else:
+        import ids_interface
+        device = ids_interface.Connection()
+        if not device.connected:
+            print("Could not connect to Device")
+            sys.exit(1)
+        try:
+            serial = serial or device.info.get("Serial Number")
+            frame = device.single_frame_acquisition()
+        finally:
+            device.close_connection()
+
+    geometry = detect_geometry(frame, serial=serial)
+    print(f"Detected centre {geometry.centre}, radius {geometry.radius}")
+    if serial is None and not args.dry_run:
+        print("Not saved: use --serial to give the serial number of the device the image was captured with")
+    elif not args.dry_run:
+        print(f"Saved to {save_geometry(geometry)}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+        sys.exit(0)
+    except Exception as e:
+        traceback.print_exception(e)
+        sys.exit(1)
@@ -0,0 +1,111 @@
+import numpy as np
+
+#Merging of exposure brackets into a single high dynamic range frame.
+#Each raw frame is divided by its exposure (integration time x linear gain) to put every frame on the
+#same linear radiance scale, and the frames are averaged per pixel with saturated pixels given no weight.
+#Frames are added one at a time and only the running sums are kept, so a bracket of any length
+#needs the same memory as two float32 frames.
+
+#Pixels with values above this are saturated (as for the white fraction in cam_image)
+SATURATION_THRESHOLD = 250
+
+
+def exposure(integration_time:int, gain:float) -> float:
+    """Get the exposure factor of a frame: integration time in seconds times the linear gain (10^(gain/20))
+
+    Args:
+        integration_time (int): Integration time in microseconds
+        gain (float): Gain in dB
+
+    Returns:
+        float: Exposure factor
+    """
+    return (integration_time / 1000000) * 10**(gain / 20)
+
+
+class HDR_Merger:
+
+    def __init__(self, threshold:int=SATURATION_THRESHOLD) -> None:
+        """Merge a bracket of raw frames with different integration times and/or gains into one float32 frame
+        of linear radiance (raw value per second of integration at unity gain).
+
+        Each unsaturated pixel is weighted by the exposure of its frame, so longer exposures (with more signal
+        relative to noise) count for more. Pixels which are saturated in every frame of the bracket take their
+        value from the frame with the smallest exposure, as a lower limit.
+
+        Args:
+            threshold (int, optional): Pixel values above this are saturated and given no weight. Defaults to SATURATION_THRESHOLD.
+        """
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self) -> None:
+        """Clear the accumulators to start a new bracket
+        """
+        self._weighted_sum : np.ndarray|None = None
+        self._weight_sum : np.ndarray|None = None
+        self._fallback : np.ndarray|None = None
+        self._fallback_exposure = None
+        self._scratch : np.ndarray|None = None
+        self.frames : list[dict] = []
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def add(self, raw:np.ndarray, integration_time:int, gain:float, number:int|None=None) -> None:
+        """Add a frame to the bracket
+
+        Args:
+            raw (np.ndarray): Raw sensor frame
+            integration_time (int): Integration time in microseconds
+            gain (float): Gain in dB
+            number (int | None, optional): Image number of the frame in the session, recorded with the result. Defaults to None.
+        """
+        frame_exposure = exposure(integration_time, gain)
+        if frame_exposure <= 0:
+            raise ValueError(f"Frame exposure must be positive. Integration time: {integration_time}us, gain: {gain}dB")
+
+        if self._weighted_sum is None:
+            self._weighted_sum = np.zeros(raw.shape, dtype=np.float32)
+            self._weight_sum = np.zeros(raw.shape, dtype=np.float32)
+            self._scratch = np.empty(raw.shape, dtype=np.float32)
+        elif raw.shape != self._weighted_sum.shape:
+            raise ValueError(f"Frame shape {raw.shape} does not match the bracket {self._weighted_sum.shape}")
+
+        #weight = exposure where unsaturated, else 0. Each pixel's radiance is raw / exposure,
+        #so weight * radiance is just the raw value where unsaturated.
+        unsaturated = raw <= self.threshold
+        np.multiply(unsaturated, np.float32(frame_exposure), out=self._scratch)
+        self._weight_sum += self._scratch
+        np.multiply(raw, unsaturated, out=self._scratch, casting="unsafe")
+        self._weighted_sum += self._scratch
+
+        if self._fallback_exposure is None or frame_exposure < self._fallback_exposure:
+            self._fallback = raw.astype(np.float32) / np.float32(frame_exposure)
+            self._fallback_exposure = frame_exposure
+
+        self.frames.append({"number": number, "integration (microseconds)": integration_time, "gain (dB)": gain})
+
+    def result(self) -> np.ndarray:
+        """Get the merged frame
+
+        Returns:
+            np.ndarray: float32 linear radiance frame
+        """
+        if self._weighted_sum is None:
+            raise ValueError("No frames have been added")
+        merged = np.divide(self._weighted_sum, self._weight_sum, out=self._fallback.copy(), where=self._weight_sum > 0)
+        return merged
+
+    def record(self) -> dict:
+        """Get a record of the bracket to store with the result
+
+        Returns:
+            dict: {"frames": [...], "saturation threshold", "saturated fraction": fraction of pixels saturated in every frame}
+        """
+        saturated = 0.0
+        if self._weight_sum is not None:
+            saturated = float(np.count_nonzero(self._weight_sum == 0) / self._weight_sum.size)
+        return {"frames": self.frames,
+                "saturation threshold": self.threshold,
+                "saturated fraction": saturated}
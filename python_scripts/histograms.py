@@ -0,0 +1,190 @@
+import argparse
+import sys
+import traceback
+from pathlib import Path
+
+import numpy as np
+
+import npy_log
+
+#Each image added to a session stores its region histograms in the session's histograms.npy.
+#For every region there is a 256 bin histogram of the raw sensor values (used for white fractions) and one
+#for each channel of the processed image (used for averages). White fractions at any threshold, medians and
+#percentiles can be calculated from the stored histograms without loading the images again.
+
+HISTOGRAM_FILE = "histograms.npy"
+
+REGIONS = ["inner", "outer", "corner"]
+
+#Histograms are stored for 3 channels. Mono8 images only use the first, the others are 0.
+CHANNELS = 3
+BINS = 256
+
+HISTOGRAM_DTYPE = np.dtype([("number", np.int32),
+                            ("raw", np.uint32, (len(REGIONS), BINS)),
+                            ("channels", np.uint32, (len(REGIONS), CHANNELS, BINS))])
+
+
+def image_row(number:int, image) -> tuple:
+    """Build a histogram row from a Cam_Image
+
+    Args:
+        number (int): Image number in the session
+        image (Cam_Image): Captured image
+
+    Returns:
+        tuple: Row values in the order of HISTOGRAM_DTYPE
+    """
+    histograms = image.histograms
+    channels = np.zeros((len(REGIONS), CHANNELS, BINS), dtype=np.uint32)
+    channels[:, :histograms["channels"].shape[1]] = histograms["channels"]
+    return (number, histograms["raw"], channels)
+
+
+class Histogram_Writer:
+
+    def __init__(self, path:str|Path, block_size:int=16) -> None:
+        """Open a histogram file for writing. The file is kept open and rows are written in blocks.
+
+        Args:
+            path (str | Path): Path of the histogram file (.npy)
+            block_size (int, optional): Number of rows held in memory before being written to the file. Defaults to 16.
+        """
+        self.path = Path(path)
+        self._appender = npy_log.Npy_Appender(self.path, HISTOGRAM_DTYPE, block_size=block_size)
+
+    def __len__(self) -> int:
+        return len(self._appender)
+
+    def append_image(self, number:int, image) -> bool:
+        """Add the histograms of a Cam_Image
+
+        Args:
+            number (int): Image number in the session
+            image (Cam_Image): Captured image
+
+        Returns:
+            bool: True if successful, otherwise False
+        """
+        try:
+            self._appender.append(image_row(number, image))
+            return True
+        except Exception as e:
+            traceback.print_exception(e)
+            return False
+
+    def append_row(self, row:tuple) -> None:
+        """Add a row to the histogram file
+
+        Args:
+            row (tuple): Row values in the order of HISTOGRAM_DTYPE (see image_row)
+        """
+        self._appender.append(tuple(row))
+
+    def flush(self) -> None:
+        self._appender.flush()
+
+    def close(self) -> None:
+        self._appender.close()
+
+
+def load_histograms(directory:str|Path) -> np.ndarray:
+    """Load the histograms of a session as a read-only memory-mapped structured array
+
+    Args:
+        directory (str | Path): Session directory
+
+    Returns:
+        np.ndarray: Structured array with dtype HISTOGRAM_DTYPE
+    """
+    return npy_log.load(Path(directory) / HISTOGRAM_FILE)
+
+
+def region_index(region:str) -> int:
+    if region not in REGIONS:
+        raise ValueError(f"Unknown region '{region}'. Regions: {REGIONS}")
+    return REGIONS.index(region)
+
+
+def white_fraction(histograms:np.ndarray, threshold:int=250) -> np.ndarray:
+    """Fraction of pixels with values above the threshold
+
+    Args:
+        histograms (np.ndarray): Histograms of shape (..., 256), e.g. rows["raw"][:, region_index("inner")]
+        threshold (int, optional): Pixel values above this are counted as saturated. Defaults to 250.
+
+    Returns:
+        np.ndarray: White fraction of each histogram, shape (...)
+    """
+    histograms = np.asarray(histograms, dtype=np.int64)
+    return histograms[..., threshold+1:].sum(axis=-1) / histograms.sum(axis=-1)
+
+
+def mean(histograms:np.ndarray) -> np.ndarray:
+    """Mean pixel value of each histogram
+
+    Args:
+        histograms (np.ndarray): Histograms of shape (..., 256)
+
+    Returns:
+        np.ndarray: Means of shape (...). NaN for empty histograms (e.g. unused channels).
+    """
+    histograms = np.asarray(histograms, dtype=np.int64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (histograms @ np.arange(BINS)) / histograms.sum(axis=-1)
+
+
+def percentile(histograms:np.ndarray, q:float|np.ndarray) -> np.ndarray:
+    """Percentile of the pixel values of each histogram: the lowest value with at least q% of pixels at or below it
+
+    Args:
+        histograms (np.ndarray): Histograms of shape (..., 256)
+        q (float | np.ndarray): Percentile(s) between 0 and 100
+
+    Returns:
+        np.ndarray: Percentiles of shape (...) for a single q, or (..., len(q)). NaN for empty histograms.
+    """
+    cumulative = np.cumsum(np.asarray(histograms, dtype=np.int64), axis=-1)
+    total = cumulative[..., -1:]
+    targets = np.multiply.outer(total[..., 0], np.atleast_1d(q) / 100)
+    #Number of bins whose cumulative count is below each target
+    values = (cumulative[..., np.newaxis, :] < targets[..., np.newaxis]).sum(axis=-1).astype(np.float64)
+    values[total[..., 0] == 0] = np.nan
+    return values[..., 0] if np.ndim(q) == 0 else values
+
+
+def median(histograms:np.ndarray) -> np.ndarray:
+    """Median pixel value of each histogram (see percentile)
+    """
+    return percentile(histograms, 50)
+
+
+def main():
+    """Calculate region statistics of a session from its stored histograms.
+    Call from command line with:
+    $> histograms.py [session directory] [--region inner] [--threshold 250] [--percentile 50 99]
+    """
+    parser = argparse.ArgumentParser(description="Calculate region statistics of a session from its stored histograms")
+    parser.add_argument("session", help="Session directory")
+    parser.add_argument("--region", choices=REGIONS, default="inner", help="Region (default: inner)")
+    parser.add_argument("--threshold", type=int, default=250, help="White fraction threshold (default: 250)")
+    parser.add_argument("--percentile", type=float, nargs="*", default=[50], help="Percentiles of each channel (default: 50)")
+    args = parser.parse_args()
+
+    rows = load_histograms(args.session)
+    region = region_index(args.region)
+    fractions = white_fraction(rows["raw"][:, region], args.threshold)
+    percentiles = percentile(rows["channels"][:, region], args.percentile)
+
+    print(" ".join(["number", f"wf_{args.threshold}", *[f"p{q:g}_{channel}" for channel in range(CHANNELS) for q in args.percentile]]))
+    for number, fraction, values in zip(rows["number"], fractions, percentiles):
+        print(" ".join([str(number), f"{fraction:.6f}", *[f"{value:g}" for value in values.ravel()]]))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+        sys.exit(0)
+    except Exception as e:
+        traceback.print_exception(e)
+        sys.exit(1)
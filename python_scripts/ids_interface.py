@@ -1,5 +1,6 @@
 from contextlib import contextmanager
 import sys,os
+import logging
 
 
 @contextmanager
@@ -24,6 +25,11 @@ with suppress_stdout():
     import numpy as np
 
     import cam_image
+    import geometry
+    import metrics
+    import session_logging
+
+log = session_logging.get_logger("ids_interface")
 
 class Connection:
 
@@ -54,6 +60,8 @@ class Connection:
             self.TARGET_PIXEL_FORMAT_MONO = ids_peak_ipl.PixelFormatName_Mono8
             self.pixel_format = None
             self.mono = None
+            #Keyword arguments passed to every Cam_Image created from a capture e.g. {"luminance_maps": True}
+            self.image_options : dict = {}
             self.connected = False
             try:
                 self.connected = self.open_connection()
@@ -114,6 +122,9 @@ class Connection:
                      "Model": str(self.device.ModelName()),
                      "Serial Number": str(self.node("DeviceSerialNumber").Value())}
             
+            #Load the fisheye circle of this device, which is used for all image masks and regions
+            geometry.load_geometry(self.info["Serial Number"])
+            
             #Check if RGB8 pixel format is available and set, and deactivate colour correction.
             #If not, device (probably) has monochrome sensor so set to 8 bit mono.
             
@@ -212,11 +223,13 @@ class Connection:
     def capture_image(self, auto=False):
         image = None
         if auto:
-            image = self.capture_auto_exposure()
+            with metrics.stage("auto exposure"):
+                image = self.capture_auto_exposure()
         else:
             image = self.single_frame_acquisition()
         
-        image = self.create_cam_image(image)
+        with metrics.stage("process"):
+            image = self.create_cam_image(image)
         
         return image
         
@@ -232,11 +245,13 @@ class Connection:
                 while not image_correctly_exposed:
                     
                     image = self.single_frame_acquisition() #Capture image from device with current integration time setting
+                    metrics.count("metering_iterations")
                     target_fraction = 0.01 #The target fraction of pixels to be oversaturated. 
                     target_margin = 0.005 #Images with fraction of pixel saturated above or below this margin are incorrectly exposed
                     
                     
-                    circle_mask = cam_image.create_centre_mask(image, centre=[1226, 1034], radius=472)
+                    active_geometry = geometry.get_geometry()
+                    circle_mask = cam_image.create_centre_mask(image, centre=active_geometry.centre, radius=active_geometry.radius)
                     fraction_white = cam_image.get_fraction_white_pixels(image, mask=circle_mask)
                     overexposed_difference = target_fraction - fraction_white #Calculate how far the image is from correct saturation level
                     exposure_time = self.exposure_time()
@@ -291,7 +306,8 @@ class Connection:
                                 integration_time=image_exposure,
                                 gain=image_gain,
                                 depth=image_depth,
-                                temp = image_temp)
+                                temp = image_temp,
+                                **self.image_options)
     
         return image
     
@@ -313,9 +329,10 @@ class Connection:
             self.node("TriggerSelector").SetCurrentEntry("ExposureStart")
             self.node("TriggerMode").SetCurrentEntry("Off")
             
-            self.start_acquisition()
+            with metrics.stage("acquisition"):
+                self.start_acquisition()
 
-            image = self.capture_frame()
+                image = self.capture_frame()
             
             self.stop_acquisition() #Just in case, as in SFA mode acquisition should stop automatically after capture
             
@@ -444,7 +461,9 @@ class Connection:
 
             
             
-            buffer = self.datastream.WaitForFinishedBuffer(buff_time) 
+            #Waiting for the buffer includes the exposure and the transfer from the device
+            with metrics.stage("exposure and transfer"):
+                buffer = self.datastream.WaitForFinishedBuffer(buff_time) 
             
             # Create IDS peak IPL image and convert it to RGBa8 format
             ipl_image = ids_peak_ipl_extension.BufferToImage(buffer)
@@ -469,9 +488,12 @@ class Connection:
             img = image_np_array.reshape(height,width)
 
             
+            metrics.count("frames_captured")
+            metrics.count("bytes_read", img.nbytes)
             return img.copy()
 
         except Exception as e:
+            metrics.count("capture_errors")
             traceback.print_exc(e)
             return False
     
@@ -667,8 +689,11 @@ class Connection:
             return False
         
     def printq(self, *args, **kwargs):
-        """Only prints if Connection instance quiet mode is set to False
+        """Only prints if Connection instance quiet mode is set to False.
+        Messages are always logged at info level, so auto exposure and capture progress is recorded in the session output file.
         """        
+        if log.isEnabledFor(logging.INFO):
+            log.info(" ".join(str(arg) for arg in args))
         if not self.quiet_mode:
             print(*args, **kwargs)
                 
@@ -0,0 +1,283 @@
+import io
+import json
+import threading
+import time
+import traceback
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import metrics
+import preview
+import session_logging
+
+log = session_logging.get_logger("live_view")
+
+#Optional HTTP server run inside the capture process (auto_capture.py --live-view PORT) to watch a routine while it runs,
+#as the console interface needs the device to itself:
+#   /          page showing the stream and statistics
+#   /stream    MJPEG stream of downscaled frames
+#   /frame.jpg latest frame
+#   /stats     latest image statistics and device telemetry (JSON)
+#   /metrics   capture and processing metrics in the Prometheus text format (see metrics.py)
+#The capture loop only hands each image to the server, which never waits on viewers. One encoder thread makes a JPEG
+#of the newest frame at most MAX_FPS times a second, and every viewer is sent the same cached JPEG.
+
+DEFAULT_HOST = "0.0.0.0"
+MAX_FPS = 2.0
+#Width of streamed frames (see preview.make_previews)
+STREAM_WIDTH = preview.QUICKLOOK_WIDTH
+JPEG_QUALITY = 75
+#Viewers are sent the latest frame again after this long without a new one, so connections stay open between captures
+KEEPALIVE_SECS = 10.0
+
+BOUNDARY = "frame"
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head><title>TRITON live view</title></head>
+<body style="background:#111;color:#ddd;font-family:monospace">
+<img src="/stream" style="max-width:100%">
+<pre id="stats"></pre>
+<script>
+async function update() {
+    try { document.getElementById("stats").textContent = JSON.stringify(await (await fetch("/stats")).json(), null, 2); }
+    catch (e) {}
+}
+update();
+setInterval(update, 2000);
+</script>
+</body>
+</html>
+"""
+
+
+def image_stats(image) -> dict:
+    """Get the statistics of a Cam_Image (or Frame_Record) as JSON values
+
+    Args:
+        image (Cam_Image | Frame_Record): Image
+
+    Returns:
+        dict: Statistics
+    """
+    stats = {"time": image.time_string("%Y-%m-%d %H:%M:%S"),
+             "format": image.format,
+             "integration (seconds)": image.integration_time/1000000,
+             "gain (dB)": image.gain,
+             "device temp (°C)": image.temp,
+             "inner fraction white": image.inner_fraction_white,
+             "inner pixel averages": image.inner_avgs,
+             "outer fraction white": image.outer_fraction_white,
+             "outer pixel averages": image.outer_avgs,
+             "corner fraction white": image.corner_fraction_white,
+             "corner pixel averages": image.corner_avgs,
+             "relative luminance": image.relative_luminance,
+             "unscaled absolute luminance": image.unscaled_absolute_luminance}
+    #Statistics may be numpy scalars or tuples of them
+    return json.loads(json.dumps(stats, default=lambda value: value.tolist() if isinstance(value, np.generic | np.ndarray) else str(value)))
+
+
+class Live_View:
+
+    def __init__(self, port:int, host:str=DEFAULT_HOST, max_fps:float=MAX_FPS, width:int=STREAM_WIDTH) -> None:
+        """Start the live view server on a background thread
+
+        Args:
+            port (int): Port to listen on
+            host (str, optional): Address to listen on. Defaults to DEFAULT_HOST (all interfaces).
+            max_fps (float, optional): Maximum frames encoded (and streamed) per second. Defaults to MAX_FPS.
+            width (int, optional): Maximum width of streamed frames. Defaults to STREAM_WIDTH.
+        """
+        self.min_interval : float = 1 / max_fps
+        self.width = width
+        self.started = time.time()
+
+        #Newest frame waiting to be encoded. Frames published faster than the rate limit replace it, so only the latest is encoded.
+        self._pending : tuple|None = None
+        self._pending_event = threading.Event()
+
+        #Encoded frame shared by every viewer, with a sequence number viewers wait on
+        self._condition = threading.Condition()
+        self._jpeg : bytes|None = None
+        self._sequence : int = 0
+
+        self._lock = threading.Lock()
+        self._stats : dict = {}
+        self._telemetry : dict = {}
+        self.counts : dict = {"published": 0, "encoded": 0, "viewers": 0}
+
+        self._closed = threading.Event()
+        self._encoder = threading.Thread(target=self._encode_loop, name="live_view_encoder", daemon=True)
+        self._encoder.start()
+
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.live_view = self
+        self._server_thread = threading.Thread(target=self.server.serve_forever, name="live_view_server", daemon=True)
+        self._server_thread.start()
+        metrics.gauge_function("live_view_viewers", lambda: self.counts["viewers"])
+        print(f"Live view at http://{host if host != DEFAULT_HOST else 'localhost'}:{self.server.server_address[1]}/")
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def publish(self, image, telemetry:dict|None=None) -> None:
+        """Make an image the latest frame. Only references are kept and nothing is encoded here, so this
+        returns immediately. Call before the image is released.
+
+        Args:
+            image (Cam_Image): Captured image
+            telemetry (dict | None, optional): Values to show with the statistics e.g. session and routine. Defaults to None.
+        """
+        try:
+            stats = image_stats(image)
+            with self._lock:
+                self._stats = stats
+                self.counts["published"] += 1
+                if telemetry is not None:
+                    self._telemetry.update(telemetry)
+            if image.raw is not None:
+                if self._pending is not None:
+                    metrics.count("live_view_frames_skipped")
+                self._pending = (image.raw, image.format)
+                self._pending_event.set()
+        except Exception as e:
+            traceback.print_exception(e)
+
+    def update_telemetry(self, telemetry:dict) -> None:
+        """Update the device telemetry shown with the statistics (e.g. the device temperature between captures)
+
+        Args:
+            telemetry (dict): Values to update
+        """
+        with self._lock:
+            self._telemetry.update(telemetry)
+
+    def stats(self) -> dict:
+        """Get the latest image statistics and telemetry
+
+        Returns:
+            dict: {"image": statistics, "telemetry": telemetry, "server": counts}
+        """
+        with self._lock:
+            server = dict(self.counts, frame=self._sequence, uptime=round(time.time() - self.started, 1),
+                          time=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            return {"image": dict(self._stats), "telemetry": dict(self._telemetry), "server": server}
+
+    def latest(self, after:int=0, timeout:float|None=None) -> tuple[int, bytes|None]:
+        """Get the encoded latest frame, waiting for one newer than the given sequence number
+
+        Args:
+            after (int, optional): Sequence number of the last frame seen. Defaults to 0.
+            timeout (float | None, optional): Maximum time (seconds) to wait. Defaults to None (wait until one arrives or the server is closed).
+
+        Returns:
+            tuple[int, bytes|None]: Sequence number and JPEG of the latest frame (the same frame again if the wait timed out)
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._sequence > after or self._closed.is_set(), timeout=timeout)
+            return self._sequence, self._jpeg
+
+    def _encode_loop(self) -> None:
+        last_encode = 0.0
+        while not self._closed.is_set():
+            if not self._pending_event.wait(timeout=0.5):
+                continue
+            #Rate limit: frames published while waiting replace the pending frame
+            wait = last_encode + self.min_interval - time.monotonic()
+            if wait > 0:
+                self._closed.wait(wait)
+                continue
+            self._pending_event.clear()
+            pending, self._pending = self._pending, None
+            if pending is None:
+                continue
+            try:
+                with metrics.stage("live view"):
+                    _, quicklook = preview.make_previews(*pending, quicklook_width=self.width, thumbnail_width=self.width)
+                    buffer = io.BytesIO()
+                    quicklook.save(buffer, format="JPEG", quality=JPEG_QUALITY)
+                last_encode = time.monotonic()
+                with self._condition:
+                    self._jpeg = buffer.getvalue()
+                    self._sequence += 1
+                    self._condition.notify_all()
+                with self._lock:
+                    self.counts["encoded"] += 1
+            except Exception as e:
+                print("Unable to encode live view frame")
+                traceback.print_exception(e)
+
+    def close(self) -> None:
+        """Stop the server and disconnect viewers
+        """
+        self._closed.set()
+        metrics.gauge_function("live_view_viewers", None)
+        with self._condition:
+            self._condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+        self._encoder.join(timeout=2)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    server_version = "TRITON"
+
+    def do_GET(self) -> None:
+        live_view : Live_View = self.server.live_view
+        match self.path.split("?", 1)[0]:
+            case "/":
+                self._send(PAGE.encode(), "text/html; charset=utf-8")
+            case "/stats":
+                self._send(json.dumps(live_view.stats(), ensure_ascii=False).encode(), "application/json")
+            case "/metrics":
+                self._send(metrics.prometheus_text().encode(), "text/plain; version=0.0.4; charset=utf-8")
+            case "/frame.jpg":
+                _, jpeg = live_view.latest(timeout=0)
+                if jpeg is None:
+                    self.send_error(503, "No frame captured yet")
+                else:
+                    self._send(jpeg, "image/jpeg")
+            case "/stream":
+                self._stream(live_view)
+            case _:
+                self.send_error(404)
+
+    def _send(self, body:bytes, content_type:str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, live_view:Live_View) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={BOUNDARY}")
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        with live_view._lock:
+            live_view.counts["viewers"] += 1
+        try:
+            #Send the current frame straight away, then each new frame as it is encoded
+            sequence = 0
+            while not live_view._closed.is_set():
+                sequence, jpeg = live_view.latest(after=sequence, timeout=KEEPALIVE_SECS)
+                if jpeg is None:
+                    continue
+                self.wfile.write(f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n".encode())
+                self.wfile.write(jpeg)
+                self.wfile.write(b"\r\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with live_view._lock:
+                live_view.counts["viewers"] -= 1
+
+    def log_message(self, format:str, *args) -> None:
+        log.debug(f"{self.address_string()} {format % args}")
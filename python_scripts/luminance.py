@@ -1,10 +1,21 @@
 import numpy as np
 from PIL import Image
 import math
+from functools import lru_cache
+from pathlib import Path
 
 
 ISO = "ISO"
 DB = "DB"
+
+#Bit depths for which transfer function lookup tables can be built
+LUT_BIT_DEPTHS = (8, 10, 12)
+
+#Number of image rows processed at once when building luminance maps
+MAP_TILE_ROWS = 256
+
+#Weights of linear R, G and B in relative luminance (the Y row of the sRGB to XYZ matrix)
+LUMINANCE_WEIGHTS = np.array([0.2126, 0.7152, 0.0722])
  
 def normalise_colours(image_array : np.ndarray) -> np.ndarray:
     """Normalises 8-bit RGB values (0-255) to non-linear sR'G'B' values (0-1)
@@ -40,6 +51,109 @@ def linearise_colours(image_array : np.ndarray) -> np.ndarray:
 
 
 
+@lru_cache(maxsize=None)
+def transfer_lut(bit_depth:int=8) -> np.ndarray:
+    """Lookup table of linear sRGB values for every integer pixel value of the given bit depth,
+    i.e. linearise_colours(normalise_colours(value)) scaled for the bit depth.
+    Tables are built once and cached.
+
+    Args:
+        bit_depth (int, optional): Bit depth of pixel values. One of LUT_BIT_DEPTHS. Defaults to 8.
+
+    Raises:
+        ValueError: If the bit depth is not supported
+
+    Returns:
+        np.ndarray: Read-only array of length 2^bit_depth where lut[value] is the linear sRGB value
+    """
+    if bit_depth not in LUT_BIT_DEPTHS:
+        raise ValueError(f"Bit depth not supported.\nGiven value: '{bit_depth}' \nAccepted values: {list(LUT_BIT_DEPTHS)}")
+    
+    max_value = 2**bit_depth - 1
+    lut = linearise_colours(np.arange(max_value+1) / max_value)
+    lut.setflags(write=False)
+    return lut
+
+
+def integer_bit_depth(image_array:np.ndarray, bit_depth:int|None=None) -> int:
+    """Get the bit depth of an integer image and check every pixel value fits in it.
+    The bit depth of uint8 images defaults to 8. Wider integer types (e.g. 10 or 12-bit data in uint16)
+    cannot be told apart from their values, so their bit depth must be given.
+
+    Args:
+        image_array (np.ndarray): Integer image array
+        bit_depth (int | None, optional): Bit depth of pixel values. Required for integer types wider than uint8. Defaults to None (8 for uint8 images).
+
+    Raises:
+        ValueError: If the bit depth is not given for an image wider than 8 bits, or pixel values are outside 0 to 2^bit_depth - 1
+
+    Returns:
+        int: Bit depth of pixel values
+    """
+    if bit_depth is None:
+        if image_array.dtype.itemsize != 1:
+            raise ValueError(f"Bit depth must be given for {image_array.dtype} images. Accepted values: {list(LUT_BIT_DEPTHS)}")
+        bit_depth = 8
+    
+    if image_array.size > 0:
+        min_value, max_value = int(image_array.min()), int(image_array.max())
+        if min_value < 0 or max_value > 2**bit_depth - 1:
+            raise ValueError(f"Pixel values {min_value}-{max_value} are outside the range of {bit_depth}-bit data (0-{2**bit_depth - 1})")
+    return bit_depth
+
+
+def channel_histograms(image_array:np.ndarray, mask:Image.Image|np.ndarray=None, invert_mask:bool=False, bit_depth:int=8) -> np.ndarray:
+    """Count the number of pixels with each value in each channel of an integer image, within a masked region.
+
+    Args:
+        image_array (np.ndarray): Integer image array of shape (height, width) or (height, width, channels)
+        mask (Image.Image | np.ndarray, optional): Mask with value 255 for pixels to include. Defaults to None (all pixels).
+        invert_mask (bool, optional): Option to only include pixels where the mask is not 255. Defaults to False.
+        bit_depth (int, optional): Bit depth of pixel values. Defaults to 8.
+
+    Raises:
+        ValueError: If any included pixel value is 2^bit_depth or more
+
+    Returns:
+        np.ndarray: Array of shape (channels, 2^bit_depth) of pixel counts
+    """
+    image_array = np.asarray(image_array)
+    if image_array.ndim == 2:
+        image_array = image_array[:, :, np.newaxis]
+    
+    if mask is not None:
+        mask_cond = np.asarray(mask) == 255
+        if invert_mask:
+            mask_cond = np.invert(mask_cond)
+        pixels = image_array[mask_cond] #shape (pixels, channels)
+    else:
+        pixels = image_array.reshape(-1, image_array.shape[-1])
+    
+    bins = 2**bit_depth
+    if pixels.size > 0 and pixels.max() >= bins:
+        raise ValueError(f"Pixel values up to {pixels.max()} are outside the range of {bit_depth}-bit data (0-{bins - 1})")
+    return np.stack([np.bincount(pixels[:, channel].ravel(), minlength=bins) for channel in range(pixels.shape[1])])
+
+
+def relative_luminance_from_histograms(histograms:np.ndarray, bit_depth:int=8) -> float:
+    """Calculate relative luminance from the per-channel histograms of an RGB region (see channel_histograms).
+    The mean linear value of each channel is the dot product of its histogram with the transfer function
+    lookup table, so only 2^bit_depth values are linearised rather than every pixel.
+
+    Args:
+        histograms (np.ndarray): Array of shape (3, 2^bit_depth) of R, G and B pixel counts
+        bit_depth (int, optional): Bit depth of pixel values. Defaults to 8.
+
+    Returns:
+        float: relative luminance of region
+    """
+    histograms = np.asarray(histograms)
+    mean_lin = (histograms @ transfer_lut(bit_depth)) / histograms.sum(axis=1)
+    
+    xyz = lin_sRGB_to_XYZ(mean_lin)
+    return xyz[1]
+
+
 def lin_sRGB_to_XYZ(colour : list[float]|tuple[float]|np.ndarray) -> tuple[float]:
     """Converts linear sRGB values to CIE 1931 XYZ colour space values using procedure defined in 
     IEC standard IEC 61966-2-1:1999/AMD1:2003 Section 5.2
@@ -67,24 +181,31 @@ def lin_sRGB_to_XYZ(colour : list[float]|tuple[float]|np.ndarray) -> tuple[float
     return xyz
 
 
-def calc_relative_luminance(image : Image.Image | np.ndarray, mask: Image.Image|np.ndarray = None) -> float:
+def calc_relative_luminance(image : Image.Image | np.ndarray, mask: Image.Image|np.ndarray = None, bit_depth:int|None=None) -> float:
     """Calculate relative luminance of an image in Candela per Sq. Meter (cd/m^2)
+    Integer images are processed with per-channel histograms and a transfer function lookup table (see
+    relative_luminance_from_histograms). Float images are linearised pixel by pixel.
 
     Args:
         image (Image.Image | np.ndarray): PIL Image (Must be in RGB8 mode) or Numpy array containing RGB pixel values.
-    Returns:
-        float: relative luminance of image
-    """    
-    """
+        mask (Image.Image | np.ndarray, optional): Mask with value 255 for pixels to include. Defaults to None.
+        bit_depth (int | None, optional): Bit depth of integer pixel values. Required for integer types wider than uint8. Defaults to None (8 for uint8 images).
 
-    Args:
-        image (Image.Image): 
+    Raises:
+        ValueError: If the bit depth of an integer image is missing or its pixel values do not fit in it (see integer_bit_depth)
 
     Returns:
-        float: 
+        float: relative luminance of image
     """    
     #TODO: convert PIL mode to RGB8 regardless of existing mode
-    image_array = np.array(image)
+    image_array = np.asarray(image)
+    
+    if np.issubdtype(image_array.dtype, np.integer):
+        if bit_depth is None:
+            bit_depth = integer_bit_depth(image_array)
+        histograms = channel_histograms(image_array, mask=mask, bit_depth=bit_depth)
+        return relative_luminance_from_histograms(histograms, bit_depth=bit_depth)
+    
     norm_array = normalise_colours(image_array)
 
     lin_array = linearise_colours(norm_array)
@@ -104,13 +225,11 @@ def calc_relative_luminance(image : Image.Image | np.ndarray, mask: Image.Image|
 
 
 
-def calc_unscaled_absolute_luminance(image : Image.Image, integration_time : float, aperture : float,  speed : float, speed_format : str = ISO, mask:Image.Image=None, relative_luminance:float=None) -> float:
-    """Calculate Unscaled Absolute Luminance
-        Uses ISO2720:1974 procedure to calculate the unscaled absolute luminance of an image using the aperture, integration, and sensor speed
-        Sensore speed may be in Gain or ISO format
+def absolute_luminance_scale(integration_time : float, aperture : float,  speed : float, speed_format : str = ISO) -> float:
+    """Factor relating relative luminance to unscaled absolute luminance using the ISO2720:1974 procedure
+    (see calc_unscaled_absolute_luminance)
 
     Args:
-        image (Image.Image): PIL image to process
         integration_time (float): integration time in seconds
         aperture (float): f-number 
         speed (float): ISO or gain
@@ -120,7 +239,7 @@ def calc_unscaled_absolute_luminance(image : Image.Image, integration_time : flo
         ValueError: if speed_format is not equal to one of "ISO" or "DB"
 
     Returns:
-        float: Unscaled Absolute Average Luminance
+        float: Unscaled absolute luminance per unit relative luminance
     """    
     speed_iso = None
     if speed_format not in [ISO, DB]:
@@ -149,15 +268,107 @@ def calc_unscaled_absolute_luminance(image : Image.Image, integration_time : flo
         speed_iso = 100*(10**(speed/20))
     elif speed_format == ISO:
         speed_iso = speed
-        
-    if relative_luminance is None:
-        relative_luminance = calc_relative_luminance(image, mask)
     
     # Using ISO2720:1974 - N^2 / t = ( L * S ) / K
     # ==> L / K = N^2 / (S * t)
+    return (aperture**2)/(speed_iso*integration_time)
+
+
+def calc_unscaled_absolute_luminance(image : Image.Image, integration_time : float, aperture : float,  speed : float, speed_format : str = ISO, mask:Image.Image=None, relative_luminance:float=None) -> float:
+    """Calculate Unscaled Absolute Luminance
+        Uses ISO2720:1974 procedure to calculate the unscaled absolute luminance of an image using the aperture, integration, and sensor speed
+        Sensore speed may be in Gain or ISO format
+
+    Args:
+        image (Image.Image): PIL image to process
+        integration_time (float): integration time in seconds
+        aperture (float): f-number 
+        speed (float): ISO or gain
+        speed_format (str, optional): Whether the speed is counted in dB or ISO. Use luminance.ISO or luminance.DB or "ISO"/"DB" Defaults to ISO.
+
+    Raises:
+        ValueError: if speed_format is not equal to one of "ISO" or "DB"
+
+    Returns:
+        float: Unscaled Absolute Average Luminance
+    """    
+    scale = absolute_luminance_scale(integration_time, aperture, speed, speed_format)
+        
+    if relative_luminance is None:
+        relative_luminance = calc_relative_luminance(image, mask)
     
-    unscaled_absolute_luminance = relative_luminance*((aperture**2)/(speed_iso*integration_time))
+    unscaled_absolute_luminance = relative_luminance*scale
     
     return unscaled_absolute_luminance
-         
-     
+
+
+def luminance_map(image : Image.Image | np.ndarray, scale:float=1.0, output:np.ndarray|None=None, bit_depth:int|None=None, tile_rows:int=MAP_TILE_ROWS) -> np.ndarray:
+    """Calculate the relative luminance of every pixel of an integer image as a float32 map.
+    RGB pixels are linearised with the transfer function lookup table and weighted by LUMINANCE_WEIGHTS.
+    Monochrome pixels are scaled to 0-1, as for the relative luminance of Mono8 images.
+    The image is processed a few rows at a time so no full size float64 arrays are created.
+
+    Args:
+        image (Image.Image | np.ndarray): PIL Image (L or RGB mode) or integer array of shape (height, width) or (height, width, 3)
+        scale (float, optional): Factor applied to every pixel, e.g. absolute_luminance_scale() for an unscaled absolute luminance map. Defaults to 1.0.
+        output (np.ndarray | None, optional): float32 array of shape (height, width) to write the map into, e.g. a memory-mapped .npy file. Defaults to None (a new array).
+        bit_depth (int | None, optional): Bit depth of pixel values. Required for integer types wider than uint8. Defaults to None (8 for uint8 images).
+        tile_rows (int, optional): Number of rows processed at once. Defaults to MAP_TILE_ROWS.
+
+    Raises:
+        ValueError: If the image is not an integer image with 1 or 3 channels, or its bit depth is missing or too small for its pixel values
+
+    Returns:
+        np.ndarray: float32 luminance map of shape (height, width)
+    """
+    image_array = np.asarray(image)
+    if not np.issubdtype(image_array.dtype, np.integer) or image_array.ndim not in (2, 3) or (image_array.ndim == 3 and image_array.shape[2] != 3):
+        raise ValueError(f"Image must be an integer array of shape (height, width) or (height, width, 3). Given: {image_array.dtype} {image_array.shape}")
+    bit_depth = integer_bit_depth(image_array, bit_depth)
+    
+    height, width = image_array.shape[:2]
+    if output is None:
+        output = np.empty((height, width), dtype=np.float32)
+    
+    if image_array.ndim == 3:
+        #One table per channel, including the channel weight and scale, so each pixel only needs 3 lookups and 2 additions
+        channel_luts = [(transfer_lut(bit_depth) * (weight * scale)).astype(np.float32) for weight in LUMINANCE_WEIGHTS]
+    else:
+        channel_luts = [((np.arange(2**bit_depth) / (2**bit_depth - 1)) * scale).astype(np.float32)]
+    
+    for start in range(0, height, tile_rows):
+        tile = image_array[start:start+tile_rows]
+        output_tile = output[start:start+tile_rows]
+        if tile.ndim == 2:
+            np.take(channel_luts[0], tile, out=output_tile)
+        else:
+            np.take(channel_luts[0], tile[:, :, 0], out=output_tile)
+            output_tile += channel_luts[1][tile[:, :, 1]]
+            output_tile += channel_luts[2][tile[:, :, 2]]
+    
+    return output
+
+
+def write_luminance_map(image : Image.Image | np.ndarray, path:str|Path, scale:float=1.0, bit_depth:int|None=None, tile_rows:int=MAP_TILE_ROWS) -> Path:
+    """Calculate a luminance map (see luminance_map) and write it to a .npy file.
+    The map is written through a memory map, so it is never held in memory in full.
+    Load it with np.load(path, mmap_mode="r").
+
+    Args:
+        image (Image.Image | np.ndarray): PIL Image (L or RGB mode) or integer array of shape (height, width) or (height, width, 3)
+        path (str | Path): Path of the .npy file
+        scale (float, optional): Factor applied to every pixel. Defaults to 1.0 (relative luminance).
+        bit_depth (int | None, optional): Bit depth of pixel values. Required for integer types wider than uint8. Defaults to None (8 for uint8 images).
+        tile_rows (int, optional): Number of rows processed at once. Defaults to MAP_TILE_ROWS.
+
+    Returns:
+        Path: Path of the .npy file
+    """
+    image_array = np.asarray(image)
+    output = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=image_array.shape[:2])
+    try:
+        luminance_map(image_array, scale=scale, output=output, bit_depth=bit_depth, tile_rows=tile_rows)
+        output.flush()
+    finally:
+        del output
+    return Path(path)
@@ -0,0 +1,236 @@
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+import warnings
+warnings.filterwarnings("ignore", module=".*colour.*")
+
+import colour_demosaicing
+
+#Memory budget mode for devices with little memory e.g. the Raspberry Pi.
+#Demosaicing a full BayerRG8 frame at once creates many full size float64 arrays, which for a 5MP frame
+#need several hundred MB. In budget mode frames are demosaiced a band of rows at a time, with the band height
+#chosen so the temporary arrays fit in the budget, and the result is kept in a float32 scratch buffer which
+#is reused for every frame. Bands are still demosaiced in float64: in float32, rounding changes which interpolation
+#direction the Menon method picks at some pixels, and after the per frame normalisation (see cam_image.debayer)
+#those pixels can differ from the float64 result by any amount, e.g. over 100 levels in dark frames.
+#Peak allocations can be recorded for each processing stage with tracemalloc (see start_report).
+
+#Approximate bytes allocated per pixel while demosaicing a band of rows in float64
+DEMOSAIC_BYTES_PER_PIXEL = {"menon": 120, "ddfapd": 120, "menon_r": 200, "ddfapd_r": 200, "malvar": 100, "bilinear": 80}
+#Rows demosaiced above and below each band, so bands match the full frame result
+TILE_OVERLAP = 16
+MIN_TILE_ROWS = 32
+
+_budget : int|None = None
+_report : dict[str, int]|None = None
+#Peak traced memory of each open stage before its inner stages reset the tracemalloc peak
+_open_peaks : list[int] = []
+
+
+def set_budget(megabytes:float|None) -> None:
+    """Turn memory budget mode on, or off if megabytes is None
+
+    Args:
+        megabytes (float | None): Peak memory (MB) allowed for processing each frame
+    """
+    global _budget
+    _budget = None if megabytes is None else int(megabytes * 1024 * 1024)
+    SCRATCH.clear()
+
+
+def get_budget() -> int|None:
+    """Get the memory budget in bytes, or None if budget mode is off
+    """
+    return _budget
+
+
+def enabled() -> bool:
+    return _budget is not None
+
+
+class Scratch_Buffers:
+
+    def __init__(self) -> None:
+        """Named arrays which are allocated once and reused for every frame of the same shape
+        """
+        self._buffers : dict[str, np.ndarray] = {}
+
+    def get(self, name:str, shape:tuple[int], dtype:np.dtype) -> np.ndarray:
+        """Get a scratch array. Its contents are left over from the last use.
+
+        Args:
+            name (str): Buffer name
+            shape (tuple[int]): Shape of the array
+            dtype (np.dtype): Type of the array
+
+        Returns:
+            np.ndarray: Scratch array
+        """
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != np.dtype(dtype):
+            #Drop the old buffer before allocating so both are not held at once
+            self._buffers.pop(name, None)
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+        return buffer
+
+    def clear(self) -> None:
+        self._buffers.clear()
+
+    def nbytes(self) -> int:
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+
+SCRATCH = Scratch_Buffers()
+
+
+def tile_rows(shape:tuple[int], method:str="menon", budget:int|None=None) -> int:
+    """Choose the number of rows demosaiced at once so the temporary arrays fit in the budget,
+    after the float32 result buffer
+
+    Args:
+        shape (tuple[int]): Shape (height, width) of the Bayer frame
+        method (str, optional): Demosaicing method. Defaults to "menon".
+        budget (int | None, optional): Budget in bytes. Defaults to None (the budget set with set_budget()).
+
+    Returns:
+        int: Rows per band (even, so every band starts on the same Bayer phase)
+    """
+    height, width = shape[:2]
+    budget = _budget if budget is None else budget
+    if budget is None:
+        return height
+    available = budget - height * width * 3 * np.dtype(np.float32).itemsize
+    rows = available // (width * DEMOSAIC_BYTES_PER_PIXEL.get(method, 160)) - 2 * TILE_OVERLAP
+    rows = int(min(max(rows, MIN_TILE_ROWS), height))
+    return rows - rows % 2
+
+
+def _demosaic(cfa:np.ndarray, method:str, pattern:str) -> np.ndarray:
+    match method:
+        case "menon_r" | "ddfapd_r":
+            return colour_demosaicing.demosaicing_CFA_Bayer_Menon2007(CFA=cfa, pattern=pattern)
+        case "menon" | "ddfapd":
+            return colour_demosaicing.demosaicing_CFA_Bayer_Menon2007(CFA=cfa, pattern=pattern, refining_step=False)
+        case "malvar":
+            return colour_demosaicing.demosaicing_CFA_Bayer_Malvar2004(CFA=cfa, pattern=pattern)
+        case "bilinear":
+            return colour_demosaicing.demosaicing_CFA_Bayer_bilinear(CFA=cfa, pattern=pattern)
+    raise ValueError(f"Unknown demosaicing method '{method}'")
+
+
+def debayer(image:np.ndarray, method:str="menon", pattern:str="RGGB", rows:int|None=None) -> np.ndarray:
+    """Demosaic a Bayer frame a band of rows at a time, normalised as cam_image.debayer does.
+    Each band is demosaiced in float64 and matches the full frame result. Only the result is kept in float32,
+    so a pixel can differ from cam_image.debayer by at most 1 level where its value rounds differently.
+
+    Args:
+        image (np.ndarray): uint8 Bayer frame
+        method (str, optional): Demosaicing method (see cam_image.debayer). Defaults to "menon".
+        pattern (str, optional): Bayer pattern. Defaults to "RGGB".
+        rows (int | None, optional): Rows per band. Defaults to None (see tile_rows()).
+
+    Returns:
+        np.ndarray: uint8 RGB array of shape (height, width, 3)
+    """
+    height, width = image.shape
+    if rows is None:
+        rows = tile_rows(image.shape, method)
+    result = SCRATCH.get("demosaic", (height, width, 3), np.float32)
+    maximum = -np.inf
+
+    for start in range(0, height, rows):
+        end = min(start + rows, height)
+        #Bands are extended by an even number of rows so they start on the same Bayer phase
+        top = max(start - TILE_OVERLAP, 0)
+        bottom = min(end + TILE_OVERLAP, height)
+        cfa = np.divide(image[top:bottom], 255)
+        band = _demosaic(cfa, method, pattern)[start-top:end-top]
+        maximum = max(maximum, float(band.max()))
+        result[start:end] = band
+        del cfa, band
+
+    #Normalise to between 0 and 255 in place, as cam_image.debayer does, using the float64 maximum
+    result *= np.float32(255 / maximum)
+    return result.astype(np.uint8)
+
+
+def start_report() -> None:
+    """Start recording the peak allocations of each processing stage (see stage())
+    """
+    global _report
+    _report = {}
+    _open_peaks.clear()
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def stop_report() -> dict[str, int]:
+    """Stop recording peak allocations
+
+    Returns:
+        dict[str, int]: Highest peak allocation (bytes) of each stage
+    """
+    global _report
+    report = _report or {}
+    _report = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return report
+
+
+@contextmanager
+def stage(name:str):
+    """Record the peak memory allocated during a processing stage, if a report has been started.
+    Stages can be nested: the peak of an inner stage is included in the peak of the stage around it.
+
+        with memory_budget.stage("demosaic"):
+            ...
+
+    Args:
+        name (str): Stage name
+    """
+    if _report is None or not tracemalloc.is_tracing():
+        yield
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    #Keep the enclosing stage's peak so far, as it is lost when the peak is reset for this stage
+    if _open_peaks:
+        _open_peaks[-1] = max(_open_peaks[-1], peak)
+    _open_peaks.append(0)
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, _open_peaks.pop())
+        if _open_peaks:
+            _open_peaks[-1] = max(_open_peaks[-1], peak)
+        _report[name] = max(_report.get(name, 0), peak - current)
+
+
+def report() -> dict[str, int]:
+    """Get the highest peak allocation (bytes) of each stage recorded so far
+    """
+    return dict(_report or {})
+
+
+def format_report(stages:dict[str, int]) -> str:
+    """Format a stage report as a table in MB, with the budget if set
+
+    Args:
+        stages (dict[str, int]): Peak allocation of each stage (see report())
+
+    Returns:
+        str: Report
+    """
+    lines = ["Peak allocation per stage (MB):"]
+    for name, peak in stages.items():
+        over = " (over budget)" if _budget is not None and peak > _budget else ""
+        lines.append(f"  {name.ljust(20)} {peak/1024/1024:9.1f}{over}")
+    if _budget is not None:
+        lines.append(f"  {'budget'.ljust(20)} {_budget/1024/1024:9.1f}")
+        lines.append(f"  {'scratch buffers'.ljust(20)} {SCRATCH.nbytes()/1024/1024:9.1f}")
+    return "\n".join(lines)
@@ -0,0 +1,290 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+#Timers and counters for each stage of capturing and processing, to find what limits a routine
+#(exposure and transfer, demosaicing, statistics, PNG encoding, log writing...).
+#Metrics are kept in memory in this process. They can be written in the Prometheus text format (served by the
+#live view at /metrics, or written to a file for a node_exporter textfile collector), and a summary of each
+#run is saved in the session directory by auto_capture.py.
+#Timing a stage costs two perf_counter() calls and a short locked update, so it can be left on.
+
+PREFIX = "triton"
+
+#Upper bounds (seconds) of the stage duration histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+#Descriptions of the counters and gauges, used as HELP text
+DESCRIPTIONS = {"frames_captured": "Frames read from the device",
+                "frames_processed": "Frames processed into images",
+                "metering_iterations": "Frames captured while adjusting the integration time",
+                "bytes_read": "Bytes of raw frames read from the device",
+                "bytes_written": "Bytes of images and luminance maps written",
+                "capture_errors": "Failed frame captures",
+                "tick_errors": "Errors in the routine loop",
+                "previews_skipped": "Previews skipped because the preview worker was behind",
+                "live_view_frames_skipped": "Frames replaced before the live view encoded them",
+                "preview_queue_depth": "Frames waiting for the preview worker",
+                "log_queue_depth": "Records waiting to be written to the session output file",
+                "live_view_viewers": "Connected live view stream viewers"}
+
+
+class _Timer:
+
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self) -> None:
+        self.count : int = 0
+        self.total : float = 0.0
+        self.max : float = 0.0
+        self.buckets : list[int] = [0] * len(BUCKETS)
+
+    def observe(self, seconds:float) -> None:
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        index = bisect.bisect_left(BUCKETS, seconds)
+        if index < len(BUCKETS):
+            self.buckets[index] += 1
+
+
+_lock = threading.Lock()
+_timers : dict[str, _Timer] = {}
+_counters : dict[str, float] = {}
+_gauges : dict[str, float] = {}
+_gauge_functions : dict[str, callable] = {}
+#Context managers entered around particular stages e.g. to profile them (see profiling.py)
+_stage_hooks : dict[str, callable] = {}
+_started : float = time.time()
+
+
+def reset() -> None:
+    """Clear every timer, counter and gauge (e.g. at the start of a run). Gauge functions are kept.
+    """
+    global _started
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _gauges.clear()
+        _started = time.time()
+
+
+def observe(stage:str, seconds:float) -> None:
+    """Record the duration of a stage
+
+    Args:
+        stage (str): Stage name e.g. "demosaic"
+        seconds (float): Duration in seconds
+    """
+    with _lock:
+        timer = _timers.get(stage)
+        if timer is None:
+            timer = _timers[stage] = _Timer()
+        timer.observe(seconds)
+
+
+@contextmanager
+def stage(name:str):
+    """Time a stage of capturing or processing.
+
+        with metrics.stage("demosaic"):
+            ...
+
+    Args:
+        name (str): Stage name
+    """
+    hook = _stage_hooks.get(name)
+    start = time.perf_counter()
+    try:
+        if hook is None:
+            yield
+        else:
+            with hook():
+                yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def set_stage_hook(name:str, hook) -> None:
+    """Set a function returning a context manager which is entered around every run of a stage
+
+    Args:
+        name (str): Stage name
+        hook (callable): Function with no arguments returning a context manager, or None to remove the hook
+    """
+    if hook is None:
+        _stage_hooks.pop(name, None)
+    else:
+        _stage_hooks[name] = hook
+
+
+def count(name:str, amount:float=1) -> None:
+    """Add to a counter
+
+    Args:
+        name (str): Counter name e.g. "bytes_written"
+        amount (float, optional): Amount to add. Defaults to 1.
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def set_gauge(name:str, value:float) -> None:
+    """Set a gauge to its current value
+
+    Args:
+        name (str): Gauge name
+        value (float): Value
+    """
+    with _lock:
+        _gauges[name] = value
+
+
+def gauge_function(name:str, function) -> None:
+    """Register a function which gives the current value of a gauge when metrics are read
+    (e.g. the size of a queue), so nothing has to be updated as it changes
+
+    Args:
+        name (str): Gauge name
+        function (callable): Function with no arguments returning the value, or None to remove the gauge
+    """
+    with _lock:
+        if function is None:
+            _gauge_functions.pop(name, None)
+        else:
+            _gauge_functions[name] = function
+
+
+def _read_gauges() -> dict[str, float]:
+    with _lock:
+        gauges = dict(_gauges)
+        functions = dict(_gauge_functions)
+    for name, function in functions.items():
+        try:
+            gauges[name] = function()
+        except Exception:
+            pass
+    return gauges
+
+
+def summary() -> dict:
+    """Get a summary of every metric
+
+    Returns:
+        dict: {"stages": {stage: {"count", "total", "mean", "max"}}, "counters": {...}, "gauges": {...}, "elapsed": seconds}
+    """
+    with _lock:
+        stages = {name: {"count": timer.count,
+                         "total": round(timer.total, 6),
+                         "mean": round(timer.total / timer.count, 6) if timer.count else None,
+                         "max": round(timer.max, 6)} for name, timer in _timers.items()}
+        counters = dict(_counters)
+        elapsed = round(time.time() - _started, 3)
+    return {"stages": stages, "counters": counters, "gauges": _read_gauges(), "elapsed": elapsed}
+
+
+def format_summary(metrics:dict) -> str:
+    """Format a summary (see summary()) as a table, with the stages that took longest in total first
+
+    Args:
+        metrics (dict): Summary
+
+    Returns:
+        str: Summary table
+    """
+    lines = [f"{'Stage'.ljust(24)} {'count':>7} {'total (s)':>10} {'mean (ms)':>10} {'max (ms)':>10} {'share':>6}"]
+    elapsed = metrics["elapsed"] or 1
+    for name, timer in sorted(metrics["stages"].items(), key=lambda item: -item[1]["total"]):
+        mean = timer["mean"] or 0
+        lines.append(f"{name.ljust(24)} {timer['count']:>7} {timer['total']:>10.3f} {mean*1000:>10.1f} {timer['max']*1000:>10.1f} {timer['total']/elapsed:>6.1%}")
+    for name, value in {**metrics["counters"], **metrics["gauges"]}.items():
+        lines.append(f"{name.ljust(24)} {value:>7,}" if isinstance(value, int) else f"{name.ljust(24)} {value:>7g}")
+    lines.append(f"{'elapsed (s)'.ljust(24)} {metrics['elapsed']:>7g}")
+    return "\n".join(lines)
+
+
+def write_summary(path:str|Path) -> Path:
+    """Write a summary of every metric (see summary()) to a JSON file
+
+    Args:
+        path (str | Path): JSON file e.g. [session directory]/run_[number]_metrics.json
+
+    Returns:
+        Path: JSON file
+    """
+    path = Path(path)
+    with open(path, mode="w") as summary_file:
+        json.dump(summary(), summary_file, indent=4)
+    return path
+
+
+def _label(value:str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def prometheus_text() -> str:
+    """Get every metric in the Prometheus text exposition format
+
+    Returns:
+        str: Metrics
+    """
+    with _lock:
+        timers = {name: (timer.count, timer.total, timer.max, list(timer.buckets)) for name, timer in _timers.items()}
+        counters = dict(_counters)
+    gauges = _read_gauges()
+
+    lines = []
+    name = f"{PREFIX}_stage_seconds"
+    lines.append(f"# HELP {name} Duration of each stage of capturing and processing")
+    lines.append(f"# TYPE {name} histogram")
+    for stage_name, (timer_count, total, _, buckets) in timers.items():
+        label = f'stage="{_label(stage_name)}"'
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS, buckets):
+            cumulative += bucket
+            lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{label},le="+Inf"}} {timer_count}')
+        lines.append(f"{name}_sum{{{label}}} {total}")
+        lines.append(f"{name}_count{{{label}}} {timer_count}")
+
+    name = f"{PREFIX}_stage_max_seconds"
+    lines.append(f"# HELP {name} Longest duration of each stage")
+    lines.append(f"# TYPE {name} gauge")
+    for stage_name, (_, _, longest, _) in timers.items():
+        lines.append(f'{name}{{stage="{_label(stage_name)}"}} {longest}')
+
+    for counter_name, value in counters.items():
+        name = f"{PREFIX}_{counter_name}_total"
+        lines.append(f"# HELP {name} {DESCRIPTIONS.get(counter_name, counter_name)}")
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {value}")
+
+    for gauge_name, value in gauges.items():
+        name = f"{PREFIX}_{gauge_name}"
+        lines.append(f"# HELP {name} {DESCRIPTIONS.get(gauge_name, gauge_name)}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path:str|Path) -> Path:
+    """Write every metric in the Prometheus text format to a file. The file is replaced in one step, so it can
+    be read at any time (e.g. by the node_exporter textfile collector).
+
+    Args:
+        path (str | Path): File e.g. triton.prom
+
+    Returns:
+        Path: File
+    """
+    path = Path(path)
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, mode="w") as metrics_file:
+        metrics_file.write(prometheus_text())
+    os.replace(temp_path, path)
+    return path
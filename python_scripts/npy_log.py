@@ -0,0 +1,144 @@
+import ast
+import os
+import traceback
+from pathlib import Path
+
+import numpy as np
+
+#Append-only .npy files.
+#The .npy header is written with enough padding that the row count can be rewritten in place,
+#so rows can be appended to the end of the file without ever rewriting the data.
+#The file is a standard .npy file at all times, and can be memory-mapped with np.load(path, mmap_mode="r").
+
+MAGIC = b"\x93NUMPY\x01\x00"
+
+#Row count used to reserve room for the shape in the header
+_MAX_ROWS = 10**15
+
+
+def _header_string(dtype:np.dtype, shape:tuple) -> str:
+    return str({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": shape})
+
+
+class Npy_Appender:
+
+    def __init__(self, path:str|Path, dtype:np.dtype, row_shape:tuple=(), block_size:int=32) -> None:
+        """Open an .npy file for appending rows. Rows are collected in a preallocated block in memory
+        and written to the file each time the block is full, or when flush() is called.
+        If the file already exists its rows are kept and new rows are appended after them.
+
+        Args:
+            path (str | Path): Path of the .npy file
+            dtype (np.dtype): Data type of the array. May be a structured dtype.
+            row_shape (tuple, optional): Shape of each row, e.g. (3, 256). Defaults to () (one element per row).
+            block_size (int, optional): Number of rows held in memory before being written. Defaults to 32.
+        """
+        self.path = Path(path)
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.block_size = max(1, int(block_size))
+
+        self._block = np.zeros((self.block_size, *self.row_shape), dtype=self.dtype)
+        self._block_rows = 0
+
+        if self.path.exists() and self.path.stat().st_size > 0:
+            self._file = open(self.path, mode="r+b")
+            self._header_length, self._rows = self._read_header()
+            #Drop any partly written rows left after the last header update (e.g. after a power cut)
+            row_bytes = self._block[0].nbytes
+            self._file.truncate(len(MAGIC) + 2 + self._header_length + self._rows * row_bytes)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, mode="w+b")
+            self._rows = 0
+            #Reserve room for the largest shape the file can have, then pad so the data is 64 byte aligned
+            reserved = len(_header_string(self.dtype, (_MAX_ROWS, *self.row_shape)))
+            self._header_length = reserved + 1 + (64 - (len(MAGIC) + 2 + reserved + 1) % 64) % 64
+            self._write_header()
+
+        self._file.seek(0, os.SEEK_END)
+
+    def _read_header(self) -> tuple[int, int]:
+        self._file.seek(0)
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"'{self.path}' is not an appendable .npy file")
+        header_length = int.from_bytes(self._file.read(2), "little")
+        header = ast.literal_eval(self._file.read(header_length).decode("latin1"))
+
+        if np.dtype(np.lib.format.descr_to_dtype(header["descr"])) != self.dtype or tuple(header["shape"][1:]) != self.row_shape:
+            raise ValueError(f"'{self.path}' does not match the expected data type and row shape")
+
+        return header_length, header["shape"][0]
+
+    def _write_header(self) -> None:
+        header = _header_string(self.dtype, (self._rows, *self.row_shape))
+        header = header.ljust(self._header_length - 1) + "\n"
+        self._file.seek(0)
+        self._file.write(MAGIC + self._header_length.to_bytes(2, "little") + header.encode("latin1"))
+
+    def __len__(self) -> int:
+        return self._rows + self._block_rows
+
+    def append(self, row) -> int:
+        """Append a row. For structured dtypes the row may be a tuple of field values.
+
+        Args:
+            row: Row to append
+
+        Returns:
+            int: Index of the appended row
+        """
+        self._block[self._block_rows] = row
+        self._block_rows += 1
+        if self._block_rows == self.block_size:
+            self.flush()
+        return len(self) - 1
+
+    def flush(self, sync:bool=False) -> None:
+        """Write rows held in memory to the end of the file and update the row count in the header.
+
+        Args:
+            sync (bool, optional): Also fsync the file. Defaults to False.
+        """
+        if self._file is None:
+            return
+        if self._block_rows > 0:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(self._block[:self._block_rows].tobytes())
+            self._rows += self._block_rows
+            self._block_rows = 0
+            #Data is written before the header so the header never counts rows which are not on disk
+            self._file.flush()
+            self._write_header()
+            self._file.seek(0, os.SEEK_END)
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        """Flush any rows held in memory and close the file.
+        """
+        try:
+            if self._file is not None:
+                self.flush(sync=True)
+                self._file.close()
+                self._file = None
+        except Exception as e:
+            traceback.print_exception(e)
+
+
+def load(path:str|Path, writable:bool=False) -> np.ndarray:
+    """Load an .npy file as a memory-mapped array, without copying the data into memory.
+
+    Args:
+        path (str | Path): Path of the .npy file
+        writable (bool, optional): Open the memory map in read/write mode. Defaults to False.
+
+    Returns:
+        np.ndarray: Memory-mapped array
+    """
+    try:
+        return np.load(path, mmap_mode="r+" if writable else "r")
+    except ValueError:
+        #Files with no rows cannot be memory-mapped
+        return np.load(path)
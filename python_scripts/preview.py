@@ -0,0 +1,327 @@
+import argparse
+import math
+import queue
+import shutil
+import sys
+import threading
+import traceback
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import metrics
+import session_logging
+
+log = session_logging.get_logger("preview")
+
+#Small previews of each image are saved in the session's previews/ directory so a session can be checked
+#over SSH without opening the full size PNGs: a thumbnail and a larger quicklook JPEG.
+#Previews are made from the raw frame rather than the processed image: each 2x2 RGGB block is taken as one RGB
+#superpixel (no demosaicing), then the superpixels are averaged in blocks to the preview size.
+#They are made on a background thread so they do not delay capturing, and can be shown in the console as
+#ANSI colour text (see to_ansi).
+
+PREVIEW_DIR = "previews"
+
+#Maximum widths of the previews in pixels
+QUICKLOOK_WIDTH = 640
+THUMBNAIL_WIDTH = 160
+JPEG_QUALITY = 85
+
+#Frames waiting for the background worker. If it falls behind, previews of further frames are skipped.
+MAX_PENDING = 4
+
+#Characters per row of previews shown in the console
+CONSOLE_WIDTH = 80
+
+
+def preview_paths(image_path:str|Path) -> tuple[Path]:
+    """Get the paths of the previews of an image saved at image_path
+
+    Args:
+        image_path (str | Path): filepath of the image
+
+    Returns:
+        tuple[Path]: Paths of the thumbnail and quicklook ([session]/previews/[image name]_thumb.jpg, [image name]_quick.jpg)
+    """
+    image_path = Path(image_path)
+    preview_dir = image_path.parent / PREVIEW_DIR
+    return preview_dir / f"{image_path.stem}_thumb.jpg", preview_dir / f"{image_path.stem}_quick.jpg"
+
+
+def superpixel(raw:np.ndarray, format:str) -> np.ndarray:
+    """Reduce a raw frame to half size by combining each 2x2 block of pixels.
+    For BayerRG8 frames each RGGB block becomes one RGB pixel (R, mean of the two G, B), which is much
+    cheaper than demosaicing. Mono8 blocks are averaged.
+
+    Args:
+        raw (np.ndarray): Raw frame of shape (height, width)
+        format (str): Pixel format of the frame
+
+    Returns:
+        np.ndarray: float32 array of shape (height // 2, width // 2, 3) for BayerRG8, or (height // 2, width // 2, 1)
+    """
+    height, width = raw.shape[0] - raw.shape[0] % 2, raw.shape[1] - raw.shape[1] % 2
+    raw = raw[:height, :width]
+    if format == "BayerRG8":
+        result = np.empty((height // 2, width // 2, 3), dtype=np.float32)
+        result[..., 0] = raw[0::2, 0::2]
+        np.add(raw[0::2, 1::2], raw[1::2, 0::2], out=result[..., 1], dtype=np.float32)
+        result[..., 1] *= 0.5
+        result[..., 2] = raw[1::2, 1::2]
+        return result
+    return box_downscale(raw[..., np.newaxis], 2)
+
+
+def box_downscale(array:np.ndarray, factor:int) -> np.ndarray:
+    """Reduce an array by averaging blocks of factor x factor pixels
+
+    Args:
+        array (np.ndarray): Array of shape (height, width, channels)
+        factor (int): Block size
+
+    Returns:
+        np.ndarray: float32 array of shape (height // factor, width // factor, channels)
+    """
+    if factor <= 1:
+        return array
+    height, width = array.shape[0] // factor, array.shape[1] // factor
+    #Summing one strided view per position in the block is much faster than a mean over a reshaped array
+    result = np.zeros((height, width, array.shape[2]), dtype=np.float32)
+    for row in range(factor):
+        for col in range(factor):
+            result += array[row:height*factor:factor, col:width*factor:factor]
+    result *= 1 / factor**2
+    return result
+
+
+def to_image(array:np.ndarray) -> Image.Image:
+    """Convert a float preview array to an 8 bit image, scaled so the brightest pixel is 255 (as cam_image.debayer does)
+
+    Args:
+        array (np.ndarray): Array of shape (height, width, 3) or (height, width, 1)
+
+    Returns:
+        Image.Image: RGB or L image
+    """
+    peak = array.max()
+    scaled = array * (255 / peak) if peak > 0 else array
+    scaled = scaled.astype(np.uint8)
+    if scaled.shape[2] == 1:
+        return Image.fromarray(scaled[..., 0], mode="L")
+    return Image.fromarray(scaled, mode="RGB")
+
+
+def make_previews(raw:np.ndarray, format:str, quicklook_width:int=QUICKLOOK_WIDTH, thumbnail_width:int=THUMBNAIL_WIDTH) -> tuple[Image.Image]:
+    """Make the thumbnail and quicklook of a raw frame
+
+    Args:
+        raw (np.ndarray): Raw frame of shape (height, width)
+        format (str): Pixel format of the frame
+        quicklook_width (int, optional): Maximum quicklook width. Defaults to QUICKLOOK_WIDTH.
+        thumbnail_width (int, optional): Maximum thumbnail width. Defaults to THUMBNAIL_WIDTH.
+
+    Returns:
+        tuple[Image.Image]: Thumbnail and quicklook
+    """
+    superpixels = superpixel(raw.squeeze(), format)
+    quicklook = box_downscale(superpixels, math.ceil(superpixels.shape[1] / quicklook_width))
+    #The thumbnail is reduced from the quicklook rather than the full frame
+    thumbnail = box_downscale(quicklook, math.ceil(quicklook.shape[1] / thumbnail_width))
+    return to_image(thumbnail), to_image(quicklook)
+
+
+def save_previews(raw:np.ndarray, format:str, image_path:str|Path) -> tuple[Path]:
+    """Make and save the previews of a raw frame for the image saved at image_path (see preview_paths)
+
+    Args:
+        raw (np.ndarray): Raw frame
+        format (str): Pixel format of the frame
+        image_path (str | Path): filepath of the image
+
+    Returns:
+        tuple[Path]: Paths of the thumbnail and quicklook
+    """
+    paths = preview_paths(image_path)
+    paths[0].parent.mkdir(parents=True, exist_ok=True)
+    for preview, path in zip(make_previews(raw, format), paths):
+        preview.save(path, quality=JPEG_QUALITY)
+    return paths
+
+
+def save_previews_from_image(image_path:str|Path) -> tuple[Path]:
+    """Make and save the previews of an image from its saved PNG (e.g. for images captured before previews were made)
+
+    Args:
+        image_path (str | Path): filepath of the image
+
+    Returns:
+        tuple[Path]: Paths of the thumbnail and quicklook
+    """
+    paths = preview_paths(image_path)
+    paths[0].parent.mkdir(parents=True, exist_ok=True)
+    with Image.open(image_path) as png:
+        array = np.asarray(png, dtype=np.float32)
+    if array.ndim == 2:
+        array = array[..., np.newaxis]
+    quicklook = box_downscale(array, math.ceil(array.shape[1] / QUICKLOOK_WIDTH))
+    thumbnail = box_downscale(quicklook, math.ceil(quicklook.shape[1] / THUMBNAIL_WIDTH))
+    for preview, path in zip((to_image(thumbnail), to_image(quicklook)), paths):
+        preview.save(path, quality=JPEG_QUALITY)
+    return paths
+
+
+class Preview_Worker:
+
+    def __init__(self, max_pending:int=MAX_PENDING) -> None:
+        """Background thread which makes and saves the previews of captured frames
+
+        Args:
+            max_pending (int, optional): Frames which can wait to be previewed. Defaults to MAX_PENDING.
+        """
+        self._queue : queue.Queue = queue.Queue(maxsize=max_pending)
+        self.saved : int = 0
+        self.skipped : int = 0
+        self._thread = threading.Thread(target=self._run, name="preview", daemon=True)
+        self._thread.start()
+        metrics.gauge_function("preview_queue_depth", self._queue.qsize)
+
+    def submit(self, raw:np.ndarray, format:str, image_path:str|Path) -> bool:
+        """Queue a frame to be previewed. This does not wait: if the worker is behind, the frame is skipped.
+        The raw frame is only read, so it can be submitted before the image is released.
+
+        Args:
+            raw (np.ndarray): Raw frame
+            format (str): Pixel format of the frame
+            image_path (str | Path): filepath of the image
+
+        Returns:
+            bool: True if queued, False if skipped
+        """
+        try:
+            self._queue.put_nowait((raw, format, image_path))
+            return True
+        except queue.Full:
+            self.skipped += 1
+            metrics.count("previews_skipped")
+            log.warning(f"Preview skipped for {Path(image_path).name}: {self._queue.maxsize} frames already waiting")
+            return False
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                with metrics.stage("preview"):
+                    save_previews(*item)
+                self.saved += 1
+            except Exception as e:
+                print(f"Unable to save previews of {item[2]}")
+                traceback.print_exception(e)
+            finally:
+                self._queue.task_done()
+
+    def flush(self) -> None:
+        """Wait until every queued frame has been previewed
+        """
+        self._queue.join()
+
+    def close(self) -> None:
+        """Preview the remaining queued frames and stop the worker
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        metrics.gauge_function("preview_queue_depth", None)
+
+
+def to_ansi(image:Image.Image, width:int=CONSOLE_WIDTH) -> str:
+    """Draw an image as text with 24 bit ANSI colours. Each character is an upper half block, coloured with one
+    pixel as the foreground and the pixel below as the background, so each row of text shows two rows of pixels.
+
+    Args:
+        image (Image.Image): Image
+        width (int, optional): Width in characters. Defaults to CONSOLE_WIDTH.
+
+    Returns:
+        str: Text to print
+    """
+    width = min(width, image.width)
+    height = max(2, round(image.height * width / image.width))
+    height += height % 2
+    pixels = np.asarray(image.convert("RGB").resize((width, height), Image.Resampling.BOX))
+    lines = []
+    for top, bottom in zip(pixels[0::2], pixels[1::2]):
+        cells = [f"\x1b[38;2;{t[0]};{t[1]};{t[2]}m\x1b[48;2;{b[0]};{b[1]};{b[2]}m▀" for t, b in zip(top, bottom)]
+        lines.append("".join(cells) + "\x1b[0m")
+    return "\n".join(lines)
+
+
+def show(image_path:str|Path, width:int|None=None, quicklook:bool=False) -> bool:
+    """Print the preview of an image in the console (see to_ansi). The full size image is not opened.
+
+    Args:
+        image_path (str | Path): filepath of the image
+        width (int | None, optional): Width in characters. Defaults to None (the console width, up to CONSOLE_WIDTH for thumbnails).
+        quicklook (bool, optional): If True, the quicklook is shown instead of the thumbnail. Defaults to False.
+
+    Returns:
+        bool: True if a preview was shown, otherwise False
+    """
+    thumbnail_path, quicklook_path = preview_paths(image_path)
+    path = quicklook_path if quicklook else thumbnail_path
+    if not path.exists():
+        print(f"No preview of {Path(image_path).name}. Run preview.py make [session directory] to make previews.")
+        return False
+    if width is None:
+        width = shutil.get_terminal_size().columns
+        if not quicklook:
+            width = min(width, CONSOLE_WIDTH)
+    with Image.open(path) as preview:
+        print(to_ansi(preview, width))
+    return True
+
+
+def main():
+    """Make or show the previews of the images of a session.
+    Call from command line with:
+    $> preview.py make [session directory] [--all]
+    $> preview.py show [session directory] [image number] [--quicklook] [--width characters]
+    """
+    parser = argparse.ArgumentParser(description="Make or show image previews of a session")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    make_parser = subparsers.add_parser("make", help="Make previews from the saved images")
+    make_parser.add_argument("session", help="Session directory")
+    make_parser.add_argument("--all", action="store_true", help="Remake existing previews")
+    show_parser = subparsers.add_parser("show", help="Show the preview of an image in the console")
+    show_parser.add_argument("session", help="Session directory")
+    show_parser.add_argument("number", type=int, help="Image number")
+    show_parser.add_argument("--quicklook", action="store_true", help="Show the quicklook instead of the thumbnail")
+    show_parser.add_argument("--width", type=int, help="Width in characters")
+    args = parser.parse_args()
+
+    directory = Path(args.session)
+    if args.command == "show":
+        image_path = directory / f"{directory.name}_{str(args.number).rjust(3, '0')}.png"
+        if not show(image_path, width=args.width, quicklook=args.quicklook):
+            sys.exit(1)
+        return
+
+    made = 0
+    for image_path in sorted(directory.glob(f"{directory.name}_*.png")):
+        if not args.all and all(path.exists() for path in preview_paths(image_path)):
+            continue
+        save_previews_from_image(image_path)
+        made += 1
+    print(f"Made previews of {made} images in {directory / PREVIEW_DIR}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+        sys.exit(0)
+    except Exception as e:
+        traceback.print_exception(e)
+        sys.exit(1)
@@ -0,0 +1,366 @@
+import argparse
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import tracemalloc
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+import metrics
+
+#Opt-in profiling of capture runs (auto_capture.py --profile, console_interface.py --profile), written to the
+#session's profile/ directory in standard formats so runs can be compared between software versions:
+#   [name].pstats / [name]_[stage].pstats    cProfile statistics of the whole run, or of selected metrics stages
+#                                           (open with pstats, snakeviz, or profiling.py show / compare)
+#   [name]_frame_[number].tracemalloc       tracemalloc snapshots every N frames (tracemalloc.Snapshot.load)
+#   [name].collapsed                        wall-clock samples of every thread as collapsed stacks
+#                                           (flamegraph.pl, speedscope)
+#cProfile only records the thread which enabled it: the thread which started the profiler (the auto_capture.py loop),
+#or the thread inside Profiler.thread() (the console interface's routine thread). Stages run on other threads
+#(e.g. previews) are not profiled, but appear in the wall-clock samples.
+
+PROFILE_DIR = "profile"
+
+#Frames kept in each tracemalloc traceback
+TRACEMALLOC_FRAMES = 10
+#Default wall-clock sampling interval (milliseconds)
+SAMPLE_INTERVAL_MS = 10
+#Functions listed in the text report of each .pstats file
+REPORT_LIMIT = 40
+
+
+def frame_label(frame) -> str:
+    """Label of a stack frame in collapsed stacks: function (file:first line)
+    """
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})".replace(";", ":")
+
+
+class Wall_Sampler:
+
+    def __init__(self, interval_ms:float=SAMPLE_INTERVAL_MS) -> None:
+        """Sample the stack of every thread at a fixed wall-clock interval on a background thread.
+        Unlike cProfile, time spent waiting (e.g. for the device or for disk) is included.
+
+        Args:
+            interval_ms (float, optional): Sampling interval in milliseconds. Defaults to SAMPLE_INTERVAL_MS.
+        """
+        self.interval : float = interval_ms / 1000
+        self.samples : Counter = Counter()
+        self.count : int = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="wall_sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                #Collapsed stacks are written root first, with the thread name as the root
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+            self.count += 1
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def write(self, path:str|Path) -> Path:
+        """Write the samples as collapsed stacks: one line per distinct stack with its number of samples
+
+        Args:
+            path (str | Path): File e.g. run_0.collapsed
+
+        Returns:
+            Path: File
+        """
+        path = Path(path)
+        with open(path, mode="w") as collapsed_file:
+            for stack, samples in self.samples.most_common():
+                collapsed_file.write(f"{stack} {samples}\n")
+        return path
+
+
+class Profiler:
+
+    def __init__(self, directory:str|Path, name:str, whole_run:bool=True, stages:list[str]|None=None,
+                 memory_every:int=0, sample_interval_ms:float|None=None) -> None:
+        """Profile a capture run. Call start() before the run, frame() after each image, and close() at the end.
+
+        Args:
+            directory (str | Path): Session directory. Results are written to its profile/ directory.
+            name (str): Name of the results e.g. "run_0"
+            whole_run (bool, optional): Record cProfile statistics of the whole run. Ignored if stages are given. Defaults to True.
+            stages (list[str] | None, optional): Record cProfile statistics of only these metrics stages (e.g. "demosaic", "save"), each to its own file. Defaults to None.
+            memory_every (int, optional): Take a tracemalloc snapshot every this many frames, or never if 0. Defaults to 0.
+            sample_interval_ms (float | None, optional): Sample the stacks of every thread at this interval, or not if None. Defaults to None.
+        """
+        self.directory : Path = Path(directory) / PROFILE_DIR
+        self.name = name
+        self.stages : list[str] = list(stages or [])
+        self.whole_run : bool = whole_run and not self.stages
+        self.memory_every : int = memory_every
+        self.sample_interval_ms = sample_interval_ms
+
+        self._profile : cProfile.Profile|None = None
+        self._profile_enabled : bool = False
+        self._stage_profiles : dict[str, cProfile.Profile] = {}
+        self._active_stage : str|None = None
+        self._thread_id : int|None = None
+        self._started_tracemalloc : bool = False
+        self._sampler : Wall_Sampler|None = None
+        self._frames : int = 0
+        self.paths : list[Path] = []
+
+    def start(self, profile_thread:bool=True) -> None:
+        """Start profiling
+
+        Args:
+            profile_thread (bool, optional): Record cProfile statistics of the current thread from now on. If False, cProfile
+                statistics are only recorded inside thread() (e.g. in the thread which captures). Defaults to True.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._thread_id = threading.get_ident() if profile_thread else None
+        if self.memory_every > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._started_tracemalloc = True
+        if self.sample_interval_ms is not None:
+            self._sampler = Wall_Sampler(self.sample_interval_ms)
+            self._sampler.start()
+        for stage in self.stages:
+            metrics.set_stage_hook(stage, lambda stage=stage: self._profile_stage(stage))
+        if self.whole_run:
+            self._profile = cProfile.Profile()
+            if profile_thread:
+                self._profile.enable()
+                self._profile_enabled = True
+
+    @contextmanager
+    def thread(self):
+        """Record cProfile statistics of the current thread while in the context, for a profiler started with
+        profile_thread=False. Only one thread can be profiled at a time.
+
+            with profiler.thread():
+                ...capture loop...
+        """
+        if self._thread_id is not None:
+            #Another thread is already profiled
+            yield
+            return
+        self._thread_id = threading.get_ident()
+        if self._profile is not None:
+            self._profile.enable()
+            self._profile_enabled = True
+        try:
+            yield
+        finally:
+            if self._profile is not None:
+                self._profile.disable()
+                self._profile_enabled = False
+            self._thread_id = None
+
+    @contextmanager
+    def _profile_stage(self, stage:str):
+        #Only one profiler can be active, so stages on other threads, and stages inside another profiled stage
+        #(which are included in its statistics), are not profiled separately
+        if self._active_stage is not None or threading.get_ident() != self._thread_id:
+            yield
+            return
+        profile = self._stage_profiles.get(stage)
+        if profile is None:
+            profile = self._stage_profiles[stage] = cProfile.Profile()
+        self._active_stage = stage
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._active_stage = None
+
+    def frame(self, number:int|None=None) -> Path|None:
+        """Record that a frame has been captured, taking a tracemalloc snapshot if one is due
+
+        Args:
+            number (int | None, optional): Frame number used in the snapshot name. Defaults to None (the count of frames).
+
+        Returns:
+            Path|None: Snapshot file if one was taken
+        """
+        self._frames += 1
+        if self.memory_every <= 0 or self._frames % self.memory_every != 0 or not tracemalloc.is_tracing():
+            return None
+        number = self._frames if number is None else number
+        path = self.directory / f"{self.name}_frame_{str(number).rjust(3, '0')}.tracemalloc"
+        tracemalloc.take_snapshot().dump(str(path))
+        self.paths.append(path)
+        return path
+
+    def _write_stats(self, profile:cProfile.Profile, path:Path) -> None:
+        if len(profile.getstats()) == 0:
+            #Nothing was profiled (e.g. no images were captured in the console interface)
+            return
+        profile.dump_stats(path)
+        #A text report is written next to each file so results can be read on the device
+        path.with_suffix(".txt").write_text(report(path))
+        self.paths.append(path)
+
+    def close(self) -> list[Path]:
+        """Stop profiling and write the results
+
+        Returns:
+            list[Path]: Files written
+        """
+        if self._profile is not None:
+            if self._profile_enabled:
+                self._profile.disable()
+                self._profile_enabled = False
+            self._write_stats(self._profile, self.directory / f"{self.name}.pstats")
+            self._profile = None
+        for stage in self.stages:
+            metrics.set_stage_hook(stage, None)
+        for stage, profile in self._stage_profiles.items():
+            self._write_stats(profile, self.directory / f"{self.name}_{stage.replace(' ', '_')}.pstats")
+        self._stage_profiles.clear()
+        if self._sampler is not None:
+            self._sampler.stop()
+            self.paths.append(self._sampler.write(self.directory / f"{self.name}.collapsed"))
+            self._sampler = None
+        if self._started_tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._started_tracemalloc = False
+        return self.paths
+
+
+def add_arguments(parser:argparse.ArgumentParser) -> None:
+    """Add the profiling options to a command line parser (see from_arguments)
+
+    Args:
+        parser (argparse.ArgumentParser): Parser
+    """
+    parser.add_argument('--profile', action='store_true', help='Record cProfile statistics of the whole run in the session profile/ directory')
+    parser.add_argument('--profile-stages', nargs='+', default=None, metavar='STAGE', help='Record cProfile statistics of only these stages (e.g. demosaic save), each to its own file')
+    parser.add_argument('--profile-memory', type=int, default=0, metavar='N', help='Save a tracemalloc snapshot every N frames')
+    parser.add_argument('--profile-sample', type=float, nargs='?', const=SAMPLE_INTERVAL_MS, default=None, metavar='MS', help=f'Sample the stacks of every thread every MS milliseconds (default: {SAMPLE_INTERVAL_MS}) and save them as collapsed stacks')
+
+
+def from_arguments(args:argparse.Namespace, directory:str|Path, name:str) -> Profiler|None:
+    """Create a profiler from the options added by add_arguments, or None if profiling is not turned on
+
+    Args:
+        args (argparse.Namespace): Parsed arguments
+        directory (str | Path): Session directory
+        name (str): Name of the results e.g. "run_0"
+
+    Returns:
+        Profiler|None: Profiler (not started)
+    """
+    if not (args.profile or args.profile_stages or args.profile_memory > 0 or args.profile_sample is not None):
+        return None
+    return Profiler(directory, name, whole_run=args.profile, stages=args.profile_stages,
+                    memory_every=args.profile_memory, sample_interval_ms=args.profile_sample)
+
+
+def report(path:str|Path, sort:str="cumulative", limit:int=REPORT_LIMIT) -> str:
+    """Format the functions with the most time in a .pstats file
+
+    Args:
+        path (str | Path): .pstats file
+        sort (str, optional): Sort key (see pstats.Stats.sort_stats). Defaults to "cumulative".
+        limit (int, optional): Number of functions. Defaults to REPORT_LIMIT.
+
+    Returns:
+        str: Report
+    """
+    stream = io.StringIO()
+    stats = pstats.Stats(str(path), stream=stream)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
+
+
+def compare(before:str|Path, after:str|Path, limit:int=REPORT_LIMIT) -> str:
+    """Compare the cumulative time of each function in two .pstats files, e.g. from two software versions
+
+    Args:
+        before (str | Path): .pstats file of the earlier run
+        after (str | Path): .pstats file of the later run
+        limit (int, optional): Number of functions, with the largest changes first. Defaults to REPORT_LIMIT.
+
+    Returns:
+        str: Table of functions with their cumulative time in each run and the change
+    """
+    def cumulative(path) -> tuple[dict, float]:
+        stats = pstats.Stats(str(path)).strip_dirs().stats
+        times = {}
+        for (filename, line, function), (_, calls, _, cumulative_time, _) in stats.items():
+            key = f"{function} ({filename}:{line})"
+            times[key] = times.get(key, 0) + cumulative_time
+        return times, max(times.values(), default=0)
+
+    before_times, before_total = cumulative(before)
+    after_times, after_total = cumulative(after)
+    functions = sorted(set(before_times) | set(after_times),
+                       key=lambda function: -abs(after_times.get(function, 0) - before_times.get(function, 0)))
+    lines = [f"{'before (s)':>11} {'after (s)':>11} {'change (s)':>11}  function",
+             f"{before_total:>11.3f} {after_total:>11.3f} {after_total - before_total:>+11.3f}  (total)"]
+    for function in functions[:limit]:
+        old, new = before_times.get(function, 0), after_times.get(function, 0)
+        lines.append(f"{old:>11.3f} {new:>11.3f} {new - old:>+11.3f}  {function}")
+    return "\n".join(lines)
+
+
+def main():
+    """Show or compare profiling results.
+    Call from command line with:
+    $> profiling.py show [.pstats file] [--sort cumulative] [--limit 40]
+    $> profiling.py compare [before .pstats file] [after .pstats file] [--limit 40]
+    $> profiling.py memory [before .tracemalloc file] [after .tracemalloc file] [--limit 20]
+    """
+    parser = argparse.ArgumentParser(description="Show or compare profiling results")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    show_parser = subparsers.add_parser("show", help="Show the functions with the most time")
+    show_parser.add_argument("file", help=".pstats file")
+    show_parser.add_argument("--sort", default="cumulative", help="Sort key e.g. cumulative, tottime, ncalls (default: cumulative)")
+    show_parser.add_argument("--limit", type=int, default=REPORT_LIMIT)
+    compare_parser = subparsers.add_parser("compare", help="Compare the cumulative time of each function in two runs")
+    compare_parser.add_argument("before", help=".pstats file of the earlier run")
+    compare_parser.add_argument("after", help=".pstats file of the later run")
+    compare_parser.add_argument("--limit", type=int, default=REPORT_LIMIT)
+    memory_parser = subparsers.add_parser("memory", help="Show the allocations which grew most between two tracemalloc snapshots")
+    memory_parser.add_argument("before", help=".tracemalloc snapshot")
+    memory_parser.add_argument("after", help=".tracemalloc snapshot")
+    memory_parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    match args.command:
+        case "show":
+            print(report(args.file, sort=args.sort, limit=args.limit))
+        case "compare":
+            print(compare(args.before, args.after, limit=args.limit))
+        case "memory":
+            before = tracemalloc.Snapshot.load(args.before)
+            after = tracemalloc.Snapshot.load(args.after)
+            for difference in after.compare_to(before, "lineno")[:args.limit]:
+                print(difference)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+        sys.exit(0)
+    except Exception as e:
+        traceback.print_exception(e)
+        sys.exit(1)
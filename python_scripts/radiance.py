@@ -0,0 +1,387 @@
+import argparse
+import os
+import sys
+import traceback
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+
+import geometry
+import luminance
+
+load_dotenv()
+
+#Radiance distribution and irradiance of fisheye images.
+#The angle of every pixel in the fisheye circle is calculated once for each lens geometry, and stored
+#as the flat index of each pixel inside the circle and the (zenith, azimuth) bin it falls in. The bins are
+#cached in memory and in the calibration directory, so each frame only needs a single np.bincount
+#to build its table of mean pixel values by angle.
+#Irradiance weight maps (the solid angle of each pixel, and the solid angle times the cosine of its zenith angle)
+#are cached in the same way, so planar and scalar irradiance are each one weighted sum per frame.
+
+DATA_DIR = Path(os.environ.get("DATA_DIRECTORY"))
+CALIBRATION_DIR = DATA_DIR / "calibration"
+
+#The fisheye circle is the active geometry (see geometry.py) unless a centre and radius are passed
+
+#Full angle of view of the fisheye lens in degrees. The circle edge is at a zenith angle of half this.
+FIELD_OF_VIEW = 180
+
+ZENITH_BIN_DEG = 10
+AZIMUTH_BIN_DEG = 30
+
+
+def resolve_circle(centre:tuple[int]|None, radius:int|None) -> tuple[tuple[int], int]:
+    """Fill in the centre and radius of the fisheye circle from the active geometry if they are not given
+
+    Returns:
+        tuple[tuple[int], int]: Centre (x, y) and radius
+    """
+    active = geometry.get_geometry()
+    centre = active.centre if centre is None else centre
+    radius = active.radius if radius is None else radius
+    return (int(centre[0]), int(centre[1])), int(radius)
+
+
+class Angular_Bins:
+
+    def __init__(self, shape:tuple[int], pixel_index:np.ndarray, bin_index:np.ndarray, zenith_bins:int, azimuth_bins:int) -> None:
+        """Angular bins of the pixels of a fisheye image. Create with get_angular_bins().
+
+        Args:
+            shape (tuple[int]): Shape (height, width) of the images the bins are for
+            pixel_index (np.ndarray): Flat index of each pixel inside the fisheye circle
+            bin_index (np.ndarray): Bin of each of these pixels (zenith_bin * azimuth_bins + azimuth_bin)
+            zenith_bins (int): Number of zenith bins
+            azimuth_bins (int): Number of azimuth bins
+        """
+        self.shape = tuple(shape)
+        self.pixel_index = pixel_index
+        self.bin_index = bin_index
+        self.zenith_bins = zenith_bins
+        self.azimuth_bins = azimuth_bins
+        self.counts = np.bincount(bin_index, minlength=self.size)
+        self._channel_index = {}
+
+    @property
+    def size(self) -> int:
+        return self.zenith_bins * self.azimuth_bins
+
+    def channel_index(self, channels:int) -> np.ndarray:
+        """Bin of each value of the pixels inside the circle, with channels counted as separate bins
+        (bin * channels + channel), so every channel is binned in one np.bincount. Cached for each number of channels.
+
+        Args:
+            channels (int): Number of channels
+
+        Returns:
+            np.ndarray: Bin index of each pixel value, in the order of image.reshape(-1, channels)[pixel_index].ravel()
+        """
+        if channels not in self._channel_index:
+            index = (self.bin_index.astype(np.int32)[:, np.newaxis] * channels + np.arange(channels, dtype=np.int32)).ravel()
+            index.setflags(write=False)
+            self._channel_index[channels] = index
+        return self._channel_index[channels]
+
+
+def calc_angular_bins(shape:tuple[int], centre:tuple[int]|None=None, radius:int|None=None, zenith_bin_deg:float=ZENITH_BIN_DEG,
+                      azimuth_bin_deg:float=AZIMUTH_BIN_DEG, field_of_view:float=FIELD_OF_VIEW) -> Angular_Bins:
+    """Calculate the angular bin of every pixel in the fisheye circle, assuming an equidistant (f-theta) lens
+    where the zenith angle is proportional to the distance from the centre.
+    Azimuth is measured clockwise from the top of the image.
+
+    Args:
+        shape (tuple[int]): Shape (height, width) of the images
+        centre (tuple[int] | None, optional): Centre (x, y) of the fisheye circle. Defaults to None (the active geometry).
+        radius (int | None, optional): Radius of the fisheye circle in pixels. Defaults to None (the active geometry).
+        zenith_bin_deg (float, optional): Width of zenith bins in degrees. Defaults to ZENITH_BIN_DEG.
+        azimuth_bin_deg (float, optional): Width of azimuth bins in degrees. Defaults to AZIMUTH_BIN_DEG.
+        field_of_view (float, optional): Full angle of view of the lens in degrees. Defaults to FIELD_OF_VIEW.
+
+    Returns:
+        Angular_Bins: Angular bins
+    """
+    height, width = shape[:2]
+    centre, radius = resolve_circle(centre, radius)
+    x, y = centre
+    max_zenith = field_of_view / 2
+    zenith_bins = int(np.ceil(max_zenith / zenith_bin_deg))
+    azimuth_bins = int(np.ceil(360 / azimuth_bin_deg))
+
+    #Only the rows and columns covering the circle are needed
+    top, bottom = max(0, int(y - radius)), min(height, int(y + radius) + 1)
+    left, right = max(0, int(x - radius)), min(width, int(x + radius) + 1)
+    rows, cols = np.mgrid[top:bottom, left:right]
+    dx = cols - x
+    dy = rows - y
+    distance = np.hypot(dx, dy)
+    inside = distance <= radius
+
+    zenith = distance[inside] / radius * max_zenith
+    azimuth = np.degrees(np.arctan2(dx[inside], -dy[inside])) % 360
+
+    zenith_bin = np.minimum((zenith // zenith_bin_deg).astype(np.int32), zenith_bins - 1)
+    azimuth_bin = np.minimum((azimuth // azimuth_bin_deg).astype(np.int32), azimuth_bins - 1)
+    bin_index = (zenith_bin * azimuth_bins + azimuth_bin).astype(np.uint16)
+    pixel_index = (rows[inside] * width + cols[inside]).astype(np.int64)
+
+    return Angular_Bins((height, width), pixel_index, bin_index, zenith_bins, azimuth_bins)
+
+
+def cache_path(shape:tuple[int], centre:tuple[int], radius:int, zenith_bin_deg:float, azimuth_bin_deg:float, field_of_view:float) -> Path:
+    """Get the path the angular bins for a lens geometry are cached at
+
+    Returns:
+        Path: Cache file path ([data directory]/calibration/angular_bins_....npz)
+    """
+    height, width = shape[:2]
+    name = f"angular_bins_{width}x{height}_c{centre[0]}_{centre[1]}_r{radius}_fov{field_of_view:g}_z{zenith_bin_deg:g}_a{azimuth_bin_deg:g}.npz"
+    return CALIBRATION_DIR / name
+
+
+def get_angular_bins(shape:tuple[int], centre:tuple[int]|None=None, radius:int|None=None, zenith_bin_deg:float=ZENITH_BIN_DEG,
+                     azimuth_bin_deg:float=AZIMUTH_BIN_DEG, field_of_view:float=FIELD_OF_VIEW) -> Angular_Bins:
+    """Get the angular bins for a lens geometry (see calc_angular_bins). Bins are loaded from the calibration
+    directory if they have been calculated before, otherwise they are calculated and saved there.
+    They are kept in memory for as long as the program runs.
+
+    Returns:
+        Angular_Bins: Angular bins
+    """
+    centre, radius = resolve_circle(centre, radius)
+    return _angular_bins(tuple(shape[:2]), centre, radius, zenith_bin_deg, azimuth_bin_deg, field_of_view)
+
+
+@lru_cache(maxsize=8)
+def _angular_bins(shape:tuple[int], centre:tuple[int], radius:int, zenith_bin_deg:float,
+                  azimuth_bin_deg:float, field_of_view:float) -> Angular_Bins:
+    path = cache_path(shape, centre, radius, zenith_bin_deg, azimuth_bin_deg, field_of_view)
+    try:
+        if path.exists():
+            with np.load(path) as cached:
+                return Angular_Bins(shape, cached["pixel_index"], cached["bin_index"],
+                                    int(cached["zenith_bins"]), int(cached["azimuth_bins"]))
+    except Exception as e:
+        print(f"Unable to load cached angular bins from {path}, recalculating")
+        traceback.print_exception(e)
+
+    bins = calc_angular_bins(shape, centre, radius, zenith_bin_deg, azimuth_bin_deg, field_of_view)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.stem + ".tmp.npz")
+        np.savez(temp_path, pixel_index=bins.pixel_index, bin_index=bins.bin_index,
+                 zenith_bins=bins.zenith_bins, azimuth_bins=bins.azimuth_bins)
+        os.replace(temp_path, path)
+    except Exception as e:
+        print(f"Unable to cache angular bins to {path}")
+        traceback.print_exception(e)
+    return bins
+
+
+def radiance_table(image:np.ndarray, bins:Angular_Bins|None=None) -> np.ndarray:
+    """Calculate the mean pixel value of each channel in each (zenith, azimuth) bin of a fisheye image
+
+    Args:
+        image (np.ndarray): Image array of shape (height, width) or (height, width, channels)
+        bins (Angular_Bins | None, optional): Angular bins. Defaults to None (get_angular_bins() for the image shape).
+
+    Returns:
+        np.ndarray: Array of shape (zenith bins, azimuth bins, channels) of mean pixel values. Empty bins are NaN.
+    """
+    image = np.asarray(image)
+    if bins is None:
+        bins = get_angular_bins(image.shape[:2])
+    channels = 1 if image.ndim == 2 else image.shape[2]
+
+    values = image.reshape(-1, channels)[bins.pixel_index].ravel()
+    sums = np.bincount(bins.channel_index(channels), weights=values, minlength=bins.size * channels).reshape(bins.size, channels)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / bins.counts[:, np.newaxis]
+    return means.reshape(bins.zenith_bins, bins.azimuth_bins, channels)
+
+
+def table_record(table:np.ndarray, zenith_bin_deg:float=ZENITH_BIN_DEG, azimuth_bin_deg:float=AZIMUTH_BIN_DEG) -> dict:
+    """Convert a radiance table to a dict which can be stored in a session image record
+
+    Args:
+        table (np.ndarray): Radiance table from radiance_table()
+        zenith_bin_deg (float, optional): Width of zenith bins in degrees. Defaults to ZENITH_BIN_DEG.
+        azimuth_bin_deg (float, optional): Width of azimuth bins in degrees. Defaults to AZIMUTH_BIN_DEG.
+
+    Returns:
+        dict: {"zenith bin (deg)", "azimuth bin (deg)", "means": [zenith][azimuth][channel]} with empty bins as None
+    """
+    means = np.round(table, 3).tolist()
+    means = [[[None if np.isnan(value) else value for value in channels] for channels in row] for row in means]
+    return {"zenith bin (deg)": zenith_bin_deg,
+            "azimuth bin (deg)": azimuth_bin_deg,
+            "means": means}
+
+
+class Irradiance_Weights:
+
+    def __init__(self, shape:tuple[int], pixel_index:np.ndarray, planar:np.ndarray, scalar:np.ndarray) -> None:
+        """Per-pixel irradiance weights of the pixels in the fisheye circle. Create with get_irradiance_weights().
+
+        Args:
+            shape (tuple[int]): Shape (height, width) of the images the weights are for
+            pixel_index (np.ndarray): Flat index of each pixel inside the fisheye circle
+            planar (np.ndarray): Solid angle of each of these pixels times the cosine of its zenith angle (steradians)
+            scalar (np.ndarray): Solid angle of each of these pixels (steradians)
+        """
+        self.shape = tuple(shape)
+        self.pixel_index = pixel_index
+        self.planar = planar
+        self.scalar = scalar
+
+
+def calc_irradiance_weights(shape:tuple[int], centre:tuple[int]|None=None, radius:int|None=None, field_of_view:float=FIELD_OF_VIEW) -> Irradiance_Weights:
+    """Calculate the irradiance weights of every pixel in the fisheye circle, assuming an equidistant (f-theta) lens.
+    A pixel at distance r from the centre has zenith angle theta = r * k where k = (field_of_view/2) / radius (in radians),
+    and covers a solid angle of k * sin(theta) / r steradians (k^2 at the centre).
+
+    Args:
+        shape (tuple[int]): Shape (height, width) of the images
+        centre (tuple[int] | None, optional): Centre (x, y) of the fisheye circle. Defaults to None (the active geometry).
+        radius (int | None, optional): Radius of the fisheye circle in pixels. Defaults to None (the active geometry).
+        field_of_view (float, optional): Full angle of view of the lens in degrees. Defaults to FIELD_OF_VIEW.
+
+    Returns:
+        Irradiance_Weights: Irradiance weights
+    """
+    height, width = shape[:2]
+    centre, radius = resolve_circle(centre, radius)
+    x, y = centre
+    k = np.radians(field_of_view / 2) / radius
+
+    top, bottom = max(0, int(y - radius)), min(height, int(y + radius) + 1)
+    left, right = max(0, int(x - radius)), min(width, int(x + radius) + 1)
+    rows, cols = np.mgrid[top:bottom, left:right]
+    distance = np.hypot(cols - x, rows - y)
+    inside = distance <= radius
+
+    distance = distance[inside]
+    zenith = distance * k
+    with np.errstate(invalid="ignore", divide="ignore"):
+        solid_angle = np.where(distance > 0, k * np.sin(zenith) / distance, k**2)
+    pixel_index = (rows[inside] * width + cols[inside]).astype(np.int64)
+
+    return Irradiance_Weights((height, width), pixel_index, solid_angle * np.cos(zenith), solid_angle)
+
+
+def get_irradiance_weights(shape:tuple[int], centre:tuple[int]|None=None, radius:int|None=None, field_of_view:float=FIELD_OF_VIEW) -> Irradiance_Weights:
+    """Get the irradiance weights for a lens geometry (see calc_irradiance_weights). Weights are loaded from the
+    calibration directory if they have been calculated before, otherwise they are calculated and saved there.
+    They are kept in memory for as long as the program runs.
+
+    Returns:
+        Irradiance_Weights: Irradiance weights
+    """
+    centre, radius = resolve_circle(centre, radius)
+    return _irradiance_weights(tuple(shape[:2]), centre, radius, field_of_view)
+
+
+@lru_cache(maxsize=8)
+def _irradiance_weights(shape:tuple[int], centre:tuple[int], radius:int, field_of_view:float) -> Irradiance_Weights:
+    height, width = shape[:2]
+    path = CALIBRATION_DIR / f"irradiance_weights_{width}x{height}_c{centre[0]}_{centre[1]}_r{radius}_fov{field_of_view:g}.npz"
+    try:
+        if path.exists():
+            with np.load(path) as cached:
+                return Irradiance_Weights((height, width), cached["pixel_index"], cached["planar"], cached["scalar"])
+    except Exception as e:
+        print(f"Unable to load cached irradiance weights from {path}, recalculating")
+        traceback.print_exception(e)
+
+    weights = calc_irradiance_weights((height, width), centre, radius, field_of_view)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.stem + ".tmp.npz")
+        np.savez(temp_path, pixel_index=weights.pixel_index, planar=weights.planar, scalar=weights.scalar)
+        os.replace(temp_path, path)
+    except Exception as e:
+        print(f"Unable to cache irradiance weights to {path}")
+        traceback.print_exception(e)
+    return weights
+
+
+def calc_irradiance(image:np.ndarray, weights:Irradiance_Weights|None=None, scale:float=1.0, bit_depth:int|None=None) -> dict:
+    """Calculate planar and scalar irradiance from a fisheye image by integrating the linearised pixel values
+    over the fisheye circle. RGB values are linearised with the sRGB transfer function (see luminance.transfer_lut),
+    and monochrome values are scaled to 0-1, as for relative luminance.
+
+    Args:
+        image (np.ndarray): Integer image array of shape (height, width) or (height, width, 3)
+        weights (Irradiance_Weights | None, optional): Irradiance weights. Defaults to None (get_irradiance_weights() for the image shape).
+        scale (float, optional): Factor applied to the results, e.g. luminance.absolute_luminance_scale(). Defaults to 1.0 (relative).
+        bit_depth (int | None, optional): Bit depth of pixel values. Required for integer types wider than uint8. Defaults to None (8 for uint8 images).
+
+    Raises:
+        ValueError: If the bit depth is missing or too small for the pixel values (see luminance.integer_bit_depth)
+
+    Returns:
+        dict: {"planar": irradiance, "scalar": irradiance, "planar channels": [per channel], "scalar channels": [per channel]}
+        where irradiance is weighted by luminance for RGB images
+    """
+    image = np.asarray(image)
+    if weights is None:
+        weights = get_irradiance_weights(image.shape[:2])
+    bit_depth = luminance.integer_bit_depth(image, bit_depth)
+    channels = 1 if image.ndim == 2 else image.shape[2]
+
+    values = image.reshape(-1, channels)[weights.pixel_index]
+    if channels == 3:
+        linear = luminance.transfer_lut(bit_depth)[values]
+    else:
+        linear = values / (2**bit_depth - 1)
+
+    #One matrix product per weight map for all channels
+    planar_channels = (weights.planar @ linear) * scale
+    scalar_channels = (weights.scalar @ linear) * scale
+    if channels == 3:
+        planar, scalar = float(planar_channels @ luminance.LUMINANCE_WEIGHTS), float(scalar_channels @ luminance.LUMINANCE_WEIGHTS)
+    else:
+        planar, scalar = float(planar_channels[0]), float(scalar_channels[0])
+
+    return {"planar": planar,
+            "scalar": scalar,
+            "planar channels": planar_channels.tolist(),
+            "scalar channels": scalar_channels.tolist()}
+
+
+def main():
+    """Precalculate and cache the angular bins and irradiance weights for a lens geometry.
+    Call from command line with:
+    $> radiance.py [--width W] [--height H] [--serial S | --centre X Y --radius R]
+    """
+    parser = argparse.ArgumentParser(description="Calculate and cache angular bins and irradiance weights for fisheye images")
+    parser.add_argument("--width", type=int, default=2448)
+    parser.add_argument("--height", type=int, default=2048)
+    parser.add_argument("--serial", help="Use the saved geometry of this device (see geometry.py)")
+    parser.add_argument("--centre", type=int, nargs=2, default=None, metavar=("X", "Y"), help="Default: the saved or default geometry")
+    parser.add_argument("--radius", type=int, default=None, help="Default: the saved or default geometry")
+    parser.add_argument("--zenith-bin", type=float, default=ZENITH_BIN_DEG, help="Zenith bin width (degrees)")
+    parser.add_argument("--azimuth-bin", type=float, default=AZIMUTH_BIN_DEG, help="Azimuth bin width (degrees)")
+    args = parser.parse_args()
+
+    if args.serial is not None:
+        geometry.load_geometry(args.serial)
+    centre, radius = resolve_circle(args.centre, args.radius)
+
+    bins = get_angular_bins((args.height, args.width), centre, radius, args.zenith_bin, args.azimuth_bin)
+    path = cache_path((args.height, args.width), centre, radius, args.zenith_bin, args.azimuth_bin, FIELD_OF_VIEW)
+    print(f"{bins.zenith_bins}x{bins.azimuth_bins} bins covering {len(bins.pixel_index)} pixels cached at {path}")
+    weights = get_irradiance_weights((args.height, args.width), centre, radius)
+    print(f"Irradiance weights cached (planar total {weights.planar.sum():.4f} sr, scalar total {weights.scalar.sum():.4f} sr)")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+        sys.exit(0)
+    except Exception as e:
+        traceback.print_exception(e)
+        sys.exit(1)
@@ -0,0 +1,401 @@
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+
+import cam_image
+import geometry
+import histograms
+import run_table
+import session
+import session_index
+import session_log
+
+load_dotenv()
+
+#Reprocess the saved images of existing sessions with the current processing code, e.g. after changing
+#the region geometry, demosaicing method or luminance calculation.
+#Images are decoded and processed on a pool of processes. Each result is appended to a checkpoint file as
+#it is completed, so an interrupted run continues where it stopped. When every image of a session is done,
+#the image log, run tables, histograms (and log.json/run csv files if the session has them) are replaced atomically.
+
+DATA_DIR = Path(os.environ.get("DATA_DIRECTORY"))
+CHECKPOINT_FILE = "reprocess.checkpoint.jsonl"
+TIMESTAMP_FORMAT = "%Y_%m_%d__%H_%M_%S"
+
+#Fields of an image record which describe corrections applied when the image was captured. The saved PNG already
+#has them applied, so they are kept. Every other field is replaced by the reprocessed record.
+CAPTURE_FIELDS = ("calibration", "dark model offset", "defects corrected")
+#Fields measured from the raw sensor frame. Colour images are saved demosaiced and scaled (see cam_image.debayer),
+#so the raw values cannot be measured again: they are kept from the existing record, or left out if it has none.
+RAW_FIELDS = ("outer raw averages",)
+
+#Run csv columns and the image record fields they were written from, used to find the run of older images
+LEGACY_MATCH_FIELDS = [("int_time_s", "integration (seconds)"), ("temp_C", "device temp (°C)"),
+                       ("inner_wf", "inner fraction white"), ("outer_wf", "outer fraction white"), ("corner_wf", "corner fraction white")]
+
+
+def load_image(path:str|Path, irradiance:bool=False) -> cam_image.Cam_Image:
+    """Load a saved image and process it again, using the metadata saved in the PNG by cam_image.create_metadata.
+    Colour images are saved demosaiced, so they are mosaiced again before processing (see cam_image.mosaic).
+
+    Args:
+        path (str | Path): Path of the PNG
+        irradiance (bool, optional): Calculate the irradiance of the image. Defaults to False.
+
+    Returns:
+        cam_image.Cam_Image: Reprocessed image
+    """
+    with Image.open(path) as png:
+        metadata = dict(png.text)
+        pixels = np.asarray(png)
+
+    format = metadata.get("format", "Mono8")
+    raw = cam_image.mosaic(pixels) if pixels.ndim == 3 else pixels
+
+    def number(key:str) -> float|None:
+        try:
+            return float(metadata[key])
+        except (KeyError, ValueError):
+            return None
+
+    return cam_image.Cam_Image(image=raw,
+                               timestamp=datetime.strptime(metadata["timestamp"], TIMESTAMP_FORMAT),
+                               integration_time=int(number("integration")),
+                               gain=number("gain"),
+                               depth=number("depth"),
+                               temp=number("temp"),
+                               format=format,
+                               irradiance=irradiance)
+
+
+def reprocess_image(path:str, record:dict, lens_geometry:dict|None=None) -> dict:
+    """Reprocess one image. Runs in a worker process.
+
+    Args:
+        path (str): Path of the PNG
+        record (dict): Existing image record. Only its number, run, CAPTURE_FIELDS and RAW_FIELDS are kept, and the irradiance
+            is recalculated if the record has it.
+        lens_geometry (dict | None, optional): Geometry to process the image with (see geometry.Lens_Geometry.to_dict).
+            Defaults to None (the worker's active geometry).
+
+    Returns:
+        dict: {"number", "record": updated image record, "row": run table row, "histograms": histogram row}
+    """
+    if lens_geometry is not None:
+        geometry.set_geometry(geometry.from_dict(lens_geometry))
+    image = load_image(path, irradiance="irradiance" in record)
+    updated = session.image_record(image, number=record.get("number"), run=record.get("run"))
+    for field in CAPTURE_FIELDS:
+        if field in record and field not in updated:
+            updated[field] = record[field]
+    for field in RAW_FIELDS:
+        updated.pop(field, None)
+        if field in record:
+            updated[field] = record[field]
+    #Images which were processed with a different geometry to the rest of the session keep it
+    if lens_geometry is not None and "geometry" in record:
+        updated["geometry"] = record["geometry"]
+    number, raw, channels = histograms.image_row(record.get("number"), image)
+    return {"number": record.get("number"), "record": updated, "row": list(run_table.image_row(image)),
+            "histograms": [number, raw.tolist(), channels.tolist()]}
+
+
+def read_checkpoint(directory:Path) -> dict:
+    """Read the results already completed for a session
+
+    Args:
+        directory (Path): Session directory
+
+    Returns:
+        dict: {image number: result}
+    """
+    results = {}
+    checkpoint_path = directory / CHECKPOINT_FILE
+    if checkpoint_path.exists():
+        with open(checkpoint_path, mode="r", encoding="utf-8") as checkpoint_file:
+            for line in checkpoint_file:
+                try:
+                    result = json.loads(line)
+                    results[result["number"]] = result
+                except (json.JSONDecodeError, KeyError):
+                    #A line cut short when the run was interrupted
+                    continue
+    return results
+
+
+def _same_value(record_value, csv_value:str) -> bool:
+    try:
+        record_value = float(record_value)
+        csv_value = float(csv_value)
+    except (TypeError, ValueError):
+        return str(record_value) == str(csv_value)
+    if math.isnan(record_value) or math.isnan(csv_value):
+        return math.isnan(record_value) and math.isnan(csv_value)
+    return math.isclose(record_value, csv_value, rel_tol=1e-9, abs_tol=1e-9)
+
+
+def legacy_runs(directory:Path, records:list[dict]) -> tuple[dict[int, int], list[int]]:
+    """Find the run of images recorded before runs were stored in image records, from the run_[number].csv files
+    which have no run table. The csv rows have no image numbers, but were written in the order the images were
+    captured, so each row is matched to the next image with the same integration time, device temperature and
+    white fractions.
+    Images which match no row (e.g. captured in the console interface) are not part of a run.
+
+    Args:
+        directory (Path): Session directory
+        records (list[dict]): Image records in order
+
+    Returns:
+        tuple[dict[int, int], list[int]]: {image number: run}, and the runs whose rows could not all be matched
+    """
+    legacy = [record for record in records if record.get("run") is None]
+    runs = {}
+    unmatched = []
+    position = 0
+    run = 0
+    while (directory / f"run_{run}.csv").exists():
+        if (directory / f"run_{run}.npy").exists():
+            run += 1
+            continue
+        with open(directory / f"run_{run}.csv", mode="r") as csv_file:
+            lines = [line.split() for line in csv_file if line.strip() != ""]
+        columns = lines[0] if len(lines) > 0 else []
+        if "int_time_s" not in columns or "temp_C" not in columns:
+            unmatched.append(run)
+            run += 1
+            continue
+
+        #The white fractions were written to the csv and the record from the same image, so they tell apart images
+        #with the same settings. If the records were changed since (e.g. reprocessed), only the settings are matched.
+        matched = None
+        for fields in (LEGACY_MATCH_FIELDS, LEGACY_MATCH_FIELDS[:2]):
+            fields = [(field, columns.index(column)) for column, field in fields if column in columns]
+            matched = _match_rows(legacy, position, lines[1:], fields)
+            if matched is not None:
+                break
+
+        if matched is not None:
+            numbers, position = matched
+            runs.update({number: run for number in numbers})
+        else:
+            unmatched.append(run)
+        run += 1
+    return runs, unmatched
+
+
+def _match_rows(records:list[dict], position:int, rows:list[list[str]], fields:list[tuple[str, int]]) -> tuple[list[int], int]|None:
+    numbers = []
+    index = position
+    for row in rows:
+        while index < len(records) and not all(_same_value(records[index].get(field), row[column]) for field, column in fields):
+            index += 1
+        if index == len(records):
+            return None
+        numbers.append(records[index].get("number"))
+        index += 1
+    return numbers, index
+
+
+def write_run_tables(directory:Path, records:list[dict], rows:dict) -> list[Path]:
+    """Replace the run tables of a session with the reprocessed rows
+
+    Args:
+        directory (Path): Session directory
+        records (list[dict]): Image records in order
+        rows (dict): {image number: run table row}
+
+    Returns:
+        list[Path]: Run tables written
+    """
+    runs = {}
+    for record in records:
+        if record.get("run") is not None and record.get("number") in rows:
+            runs.setdefault(record["run"], []).append(rows[record["number"]])
+
+    tables = []
+    for run, run_rows in sorted(runs.items()):
+        table_path = directory / f"run_{run}.npy"
+        temp_path = directory / f"run_{run}.tmp.npy"
+        if temp_path.exists():
+            temp_path.unlink()
+        writer = run_table.Run_Table_Writer(temp_path, block_size=max(1, len(run_rows)))
+        for row in run_rows:
+            writer.append_row(row)
+        writer.close()
+        os.replace(temp_path, table_path)
+        if (directory / f"run_{run}.csv").exists():
+            run_table.export_csv(table_path)
+        tables.append(table_path)
+    return tables
+
+
+def write_histograms(directory:Path, results:dict) -> Path:
+    """Replace the histograms of a session with the reprocessed histograms
+
+    Args:
+        directory (Path): Session directory
+        results (dict): {image number: result}
+
+    Returns:
+        Path: Histogram file
+    """
+    histogram_path = directory / histograms.HISTOGRAM_FILE
+    temp_path = directory / f"{histogram_path.stem}.tmp.npy"
+    if temp_path.exists():
+        temp_path.unlink()
+    writer = histograms.Histogram_Writer(temp_path, block_size=max(1, len(results)))
+    for number in sorted(results):
+        if "histograms" in results[number]:
+            writer.append_row(results[number]["histograms"])
+    writer.close()
+    os.replace(temp_path, histogram_path)
+    return histogram_path
+
+
+def reprocess_session(directory:str|Path, executor:ProcessPoolExecutor, restart:bool=False, device_geometry:geometry.Lens_Geometry|None=None) -> tuple[int, int]:
+    """Reprocess every image in a session. Images are processed with the lens geometry recorded in the session
+    (or in their own record), unless a device geometry is given.
+
+    Args:
+        directory (str | Path): Session directory
+        executor (ProcessPoolExecutor): Process pool to process images on
+        restart (bool, optional): Ignore results from an interrupted run. Defaults to False.
+        device_geometry (geometry.Lens_Geometry | None, optional): Geometry to process every image with, which must also be the
+            active geometry of the worker processes (see main). It is recorded in the session header. Defaults to None.
+
+    Returns:
+        tuple[int, int]: Number of images reprocessed in this run, and number of images which could not be reprocessed
+    """
+    directory = Path(directory)
+    header = session_log.read_header(directory)
+    if header is None:
+        raise FileNotFoundError(f"No session found at '{directory}'")
+    name = header["session"].replace(" ", "_")
+
+    checkpoint_path = directory / CHECKPOINT_FILE
+    if restart and checkpoint_path.exists():
+        checkpoint_path.unlink()
+    results = read_checkpoint(directory)
+    if len(results) > 0:
+        print(f"{directory}: resuming, {len(results)} images already reprocessed")
+
+    if device_geometry is not None:
+        session_geometry = None
+    else:
+        session_geometry = header.get("geometry")
+        if session_geometry is None:
+            session_geometry = geometry.DEFAULT_GEOMETRY.to_dict()
+            print(f"{directory}: no lens geometry recorded, using centre {geometry.DEFAULT_CENTRE} and radius {geometry.DEFAULT_RADIUS}."
+                  " Use --serial to use the saved geometry of a device")
+
+    records = list(session_log.iter_records(directory))
+    futures = {}
+    missing = 0
+    for record in records:
+        number = record.get("number")
+        if number in results:
+            continue
+        png_path = directory / f"{name}_{str(number).rjust(3, '0')}.png"
+        if not png_path.exists():
+            missing += 1
+            continue
+        image_geometry = None if device_geometry is not None else record.get("geometry", session_geometry)
+        futures[executor.submit(reprocess_image, str(png_path), record, image_geometry)] = number
+
+    processed = 0
+    failed = missing
+    with open(checkpoint_path, mode="a", encoding="utf-8") as checkpoint_file:
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Unable to reprocess image {futures[future]} of {directory}")
+                traceback.print_exception(e)
+                continue
+            checkpoint_file.write(json.dumps(result, ensure_ascii=False, separators=(",", ":")) + "\n")
+            checkpoint_file.flush()
+            results[result["number"]] = result
+            processed += 1
+
+    #Images which could not be reprocessed keep their existing records
+    updated = [results[record.get("number")]["record"] if record.get("number") in results else record for record in records]
+    #Images captured before runs were recorded are given the run of their row in the run csv files
+    runs, unmatched = legacy_runs(directory, records)
+    for record in updated:
+        if record.get("run") is None and record.get("number") in runs:
+            record["run"] = runs[record.get("number")]
+    for run in unmatched:
+        print(f"{directory}: the rows of run_{run}.csv could not be matched to images, so it was not rewritten")
+    session_log.write_records(directory, updated)
+    if device_geometry is not None:
+        header["geometry"] = device_geometry.to_dict()
+        session_log.write_header(header, directory)
+    write_run_tables(directory, updated, {number: result["row"] for number, result in results.items()})
+    write_histograms(directory, results)
+    if (directory / session_log.LEGACY_LOG_FILE).exists():
+        session_log.export_json(directory)
+    if (DATA_DIR / session_index.INDEX_FILE).exists():
+        session_index.Session_Index().import_session(directory)
+
+    checkpoint_path.unlink()
+    return processed, failed
+
+
+def main():
+    """Reprocess the images of existing sessions.
+    Call from command line with:
+    $> reprocess.py [session directories]... [--workers N] [--restart] [--serial S]
+    """
+    parser = argparse.ArgumentParser(description="Reprocess the images of existing sessions with the current processing code")
+    parser.add_argument("sessions", nargs="+", help="Session directories")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--restart", action="store_true", help="Ignore results from an interrupted run and start again")
+    parser.add_argument("--serial", help="Serial number of a device, to process every image with its saved geometry (see geometry.py) instead of the geometry recorded in each session")
+    args = parser.parse_args()
+
+    workers = max(1, args.workers)
+    total = 0
+    failed = 0
+    start = time.perf_counter()
+    #Each worker process loads the geometry of the device
+    initializer, initargs = (geometry.load_geometry, (args.serial,)) if args.serial is not None else (None, ())
+    device_geometry = geometry.load_geometry(args.serial) if args.serial is not None else None
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        for directory in args.sessions:
+            try:
+                session_start = time.perf_counter()
+                processed, session_failed = reprocess_session(directory, executor, restart=args.restart, device_geometry=device_geometry)
+                elapsed = time.perf_counter() - session_start
+                print(f"{directory}: {processed} images reprocessed in {elapsed:.1f}s"
+                      f"{f', {session_failed} could not be reprocessed' if session_failed > 0 else ''}")
+                total += processed
+                failed += session_failed
+            except Exception as e:
+                failed += 1
+                print(f"Unable to reprocess {directory}")
+                traceback.print_exception(e)
+
+    elapsed = time.perf_counter() - start
+    rate = total / elapsed if elapsed > 0 else 0
+    print(f"Reprocessed {total} images in {elapsed:.1f}s: {rate:.2f} frames/s, {rate/workers:.2f} frames/s per core ({workers} workers)")
+    return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except Exception as e:
+        traceback.print_exception(e)
+        sys.exit(1)
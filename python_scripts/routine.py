@@ -58,6 +58,11 @@ class Routine:
                                                        loop_gain=loop_gain,
                                                        loop_integration_time=loop_integration_time)
 
+        #Number of captures in each repeat of the routine (e.g. one integration time ladder)
+        self.bracket_length = settings.shape[1]
+        #Whether the captures of a repeat have different settings, so they can be merged into an HDR frame
+        self.bracketed = np.unique(settings, axis=1).shape[1] > 1
+        
         settings = np.tile(settings, self.repeat)
 
         
@@ -125,10 +130,14 @@ class Routine:
         captured_image = None
         string = ""
         
+        #Repeat of the routine which the captured image belongs to
+        captured_repeat = None
+        
         def tick_outcome(value:bool=True, return_string:str=""):
             return({"complete": value,
                     "image": captured_image ,
                     "image_count": self.image_count,
+                    "repeat": captured_repeat,
                     "string": return_string})
         
         if self.start_time is None:
@@ -159,6 +168,8 @@ class Routine:
           
             
         if now > self.next_capture:
+            #Captures which fail still use up their settings, so the repeat follows from the position in the settings
+            captured_repeat = self.image_count // self.bracket_length
             captured_image = self.capture_image(self.int_times[self.image_count], self.gains[self.image_count])
             self.set_next_capture_time()
         
@@ -0,0 +1,153 @@
+import argparse
+import sys
+import traceback
+from pathlib import Path
+
+import numpy as np
+
+import npy_log
+
+#Each run of a routine stores one row per image in a run table (run_[number].npy).
+#The table is an append-only .npy file of a structured array, so it can be loaded
+#without copying using load_run_table, or exported to the old run_[number].csv format.
+
+REGIONS = ["inner", "outer", "corner"]
+
+#Averages are stored for 3 channels. Mono8 images only use the first, the others are NaN.
+CHANNELS = 3
+
+RUN_TABLE_DTYPE = np.dtype([("int_time_s", np.float64),
+                            ("temp_C", np.float64),
+                            *[(f"{region}_wf", np.float64) for region in REGIONS],
+                            *[(f"{region}_avg_{channel}", np.float64) for region in REGIONS for channel in range(CHANNELS)]])
+
+
+def image_row(image) -> tuple:
+    """Build a run table row from a Cam_Image (or the Frame_Record of a released image)
+
+    Args:
+        image (Cam_Image | Frame_Record): Captured image
+
+    Returns:
+        tuple: Row values in the order of RUN_TABLE_DTYPE
+    """
+    def channels(avgs:tuple[float]) -> list[float]:
+        avgs = [np.nan if avg is None else avg for avg in avgs]
+        return (avgs + [np.nan]*CHANNELS)[:CHANNELS]
+
+    return (image.integration_time/1000000, image.temp,
+            image.inner_fraction_white, image.outer_fraction_white, image.corner_fraction_white,
+            *channels(list(image.inner_avgs)), *channels(list(image.outer_avgs)), *channels(list(image.corner_avgs)))
+
+
+class Run_Table_Writer:
+
+    def __init__(self, path:str|Path, block_size:int=16) -> None:
+        """Open a run table for writing. The file is kept open and rows are written in blocks.
+
+        Args:
+            path (str | Path): Path of the run table (.npy)
+            block_size (int, optional): Number of rows held in memory before being written to the file. Defaults to 16.
+        """
+        self.path = Path(path)
+        self._appender = npy_log.Npy_Appender(self.path, RUN_TABLE_DTYPE, block_size=block_size)
+
+    def __len__(self) -> int:
+        return len(self._appender)
+
+    def append_image(self, image) -> bool:
+        """Add a row for a Cam_Image to the run table
+
+        Args:
+            image (Cam_Image): Captured image
+
+        Returns:
+            bool: True if successful, otherwise False
+        """
+        try:
+            self._appender.append(image_row(image))
+            return True
+        except Exception as e:
+            traceback.print_exception(e)
+            return False
+
+    def append_row(self, row:tuple) -> None:
+        """Add a row to the run table
+
+        Args:
+            row (tuple): Row values in the order of RUN_TABLE_DTYPE (see image_row)
+        """
+        self._appender.append(tuple(row))
+
+    def flush(self) -> None:
+        self._appender.flush()
+
+    def close(self) -> None:
+        self._appender.close()
+
+
+def load_run_table(path:str|Path) -> np.ndarray:
+    """Load a run table as a read-only memory-mapped structured array.
+    Columns can be accessed by name, e.g. table["temp_C"].
+
+    Args:
+        path (str | Path): Path of the run table (.npy)
+
+    Returns:
+        np.ndarray: Structured array with dtype RUN_TABLE_DTYPE
+    """
+    return npy_log.load(path)
+
+
+def export_csv(path:str|Path, csv_path:str|Path|None=None) -> Path:
+    """Export a run table to the space separated run_[number].csv format.
+    Channel columns are only included if they are used (i.e. 1 channel for Mono8, 3 for RGB).
+
+    Args:
+        path (str | Path): Path of the run table (.npy)
+        csv_path (str | Path | None, optional): Path of the csv file. Defaults to the run table path with a .csv suffix.
+
+    Returns:
+        Path: Path of the csv file
+    """
+    table = load_run_table(path)
+    if csv_path is None:
+        csv_path = Path(path).with_suffix(".csv")
+
+    #Count channels which have a value in any row
+    channels = 1
+    for channel in range(1, CHANNELS):
+        if table.size > 0 and not np.all(np.isnan(table[f"inner_avg_{channel}"])):
+            channels = channel + 1
+
+    columns = ["int_time_s", "temp_C", *[f"{region}_wf" for region in REGIONS],
+               *[f"{region}_avg_{channel}" for region in REGIONS for channel in range(channels)]]
+
+    with open(csv_path, mode="w") as csv_file:
+        csv_file.write(" ".join(columns) + "\n")
+        for row in table[columns].tolist():
+            csv_file.write(" ".join(str(item) for item in row) + "\n")
+
+    return Path(csv_path)
+
+
+def main():
+    """Export run tables to csv.
+    Call from command line with:
+    $> run_table.py [run table .npy files]...
+    """
+    parser = argparse.ArgumentParser(description="Export run tables to csv")
+    parser.add_argument("tables", nargs="+", help="Run table files (.npy)")
+    args = parser.parse_args()
+
+    for table in args.tables:
+        print(f"Exported {table} to {export_csv(table)}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+        sys.exit(0)
+    except Exception as e:
+        traceback.print_exception(e)
+        sys.exit(1)
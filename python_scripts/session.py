@@ -4,33 +4,33 @@ from pathlib import Path
 import numpy as np
 import json
 import cam_image
+import geometry
+import histograms
+import metrics
+import preview
+import radiance
+import session_log
+import session_index
+import session_logging
+import logging
 import sys, os
 from dotenv import load_dotenv
 import traceback
 
 from datetime import datetime
 
-from contextlib import contextmanager
-
-@contextmanager
-def redirect_output(fileobj):
-    old = sys.stdout
-    sys.stdout = fileobj
-    try:
-        yield fileobj
-    finally:
-        sys.stdout = old
-        
 load_dotenv()
 
 SESSION_DIR =  Path(os.environ.get("DATA_DIRECTORY"))
 PRETTY_FORMAT = "%Y-%m-%d %H:%M:%S"
 FILEPATH_FORMAT = "%Y_%m_%d__%H_%M_%S"
+
+log = session_logging.get_logger("session")
         
 
 class Session:
     
-    def __init__(self, name:str|None=None, coords:tuple[float|None] = (None,None), start_time:datetime|None = None, directory:str|None=None, images:dict=None) -> None:
+    def __init__(self, name:str|None=None, coords:tuple[float|None] = (None,None), start_time:datetime|None = None, directory:str|None=None, images:dict=None, index:session_index.Session_Index|None=None, previews:bool=True) -> None:
         try:
             
             if start_time is None:
@@ -55,15 +55,44 @@ class Session:
             
             full_path.mkdir(parents=True, exist_ok=True)
             
-            if images is None:
-                images = []
+            #Output from every module is written to output.txt in the session directory while the session is open
+            self.session_log = session_logging.Session_Log(full_path / "output.txt")
+            metrics.gauge_function("log_queue_depth", self.session_log.queue.qsize)
+            
             self.log : dict = {"session" : self.name,
                                 "start_time" : self.time_string(),
                                 "coords" : str(self.coords[0])+", " + str(self.coords[1]),
                                 "path" : str(self.directory_path),
-                                "images" : images
+                                #Lens geometry the images are processed with, so they can be reprocessed with the same regions
+                                "geometry" : geometry.get_geometry().to_dict()
                                 }
-            self.write_to_log()
+            
+            #Images are appended to an append-only log. Image records are not kept in memory, only the number of images.
+            #If the session was loaded from a legacy log.json, its images are copied into the new log before the first new image is added.
+            self.image_log = session_log.Image_Log(full_path)
+            self._legacy_images = images
+            if images is not None:
+                self.image_count:int = len(images)
+            elif self.image_log.exists():
+                self.image_count:int = session_log.count_records(full_path)
+            else:
+                self.image_count:int = 0
+            
+            #Region histograms of each image are appended to histograms.npy. It is opened when the first image is added.
+            self._histogram_writer : histograms.Histogram_Writer|None = None
+            
+            #Thumbnails and quicklooks of each image are made from its raw frame on a background thread
+            self.previews : bool = previews
+            self._preview_worker : preview.Preview_Worker|None = None
+            
+            #Opening an existing session does not write to it
+            if not (full_path / session_log.HEADER_FILE).exists():
+                self.write_to_log()
+            
+            #Register the session in the session index so it can be listed and searched
+            self.index = index
+            if self.index is not None:
+                self.index.add_session(self.name, self.time_string(), self.coords, self.directory_path)
         
             
                 
@@ -75,9 +104,9 @@ class Session:
     def time_string(self, format:str="%Y-%m-%d %H:%M:%S") -> str:
         return datetime.strftime(self.start_time, format)
             
-    def add_image(self, image:cam_image.Cam_Image) -> bool:
+    def add_image(self, image:cam_image.Cam_Image, run:int|None=None) -> bool:
         try:
-            image_num = len(self.log['images'])+1
+            image_num = self.image_count+1
             
             image_location = self.directory_path / f"{self.name.replace(' ', '_')}" / f"{self.name.replace(' ', '_')}_{str(image_num).rjust(3, '0')}.png"
                         
@@ -86,53 +115,175 @@ class Session:
                 print("Unable to Save Image")
                 return False
             
-            image_info = {"number" : image_num,
-                          "time" : image.time_string(PRETTY_FORMAT),
-                          "integration (microseconds)" : image.integration_time,
-                          "integration (seconds)": image.integration_time/1000000,
-                          "gain (dB)" : image.gain,
-                          "depth (m)" : image.depth,
-                          "device temp (°C)": image.temp,
-                          "format": image.format,
-                          "inner fraction white": image.inner_fraction_white,
-                          "inner_pixel_averages:":str(image.inner_avgs),
-                          "outer fraction white": image.outer_fraction_white,
-                          "outer_pixel_averages" : str(image.outer_avgs),
-                          "corner fraction white": image.corner_fraction_white,
-                          "corner_pixel_averages" : str(image.corner_avgs),
-                          "unscaled absolute luminance": str(image.unscaled_absolute_luminance),
-                          "relative luminance": str(image.relative_luminance)}
+            with metrics.stage("image record"):
+                image_info = self.image_record(image, number=image_num, run=run)
+                self._record_geometry(image_info)
             
-            self.log["images"].append(image_info)
-            self.write_to_log()
+            with metrics.stage("image log"):
+                if self._legacy_images is not None:
+                    for legacy_info in self._legacy_images:
+                        self.image_log.append(legacy_info)
+                    self._legacy_images = None
+                
+                self.image_log.append(image_info)
+            self.image_count = image_num
+            with metrics.stage("histograms"):
+                if self._histogram_writer is None:
+                    self._histogram_writer = histograms.Histogram_Writer(self.directory_path / self.name.replace(' ', '_') / histograms.HISTOGRAM_FILE, block_size=4)
+                self._histogram_writer.append_image(image_num, image)
+            if self.previews and image.raw is not None:
+                if self._preview_worker is None:
+                    self._preview_worker = preview.Preview_Worker()
+                self._preview_worker.submit(image.raw, image.format, image_location)
+            if self.index is not None:
+                with metrics.stage("session index"):
+                    self.index.add_image(self.name, image_info, image_location)
             return True
     
         except Exception as e:
             traceback.print_exc(e)
     
-    def write_to_log(self) -> bool:
+    def _record_geometry(self, image_info:dict) -> None:
+        #The header records the geometry of the first image (the device may be connected after the session is started).
+        #Images processed with a different geometry (e.g. after the lens circle was detected again) record their own.
+        active = geometry.get_geometry().to_dict()
+        if self.log.get("geometry") == active:
+            return
+        if self.image_count == 0:
+            self.log["geometry"] = active
+            self.write_to_log()
+        else:
+            image_info["geometry"] = active
+    
+    def image_record(self, image:cam_image.Cam_Image|cam_image.Frame_Record, number:int|None=None, run:int|None=None) -> dict:
+        """Build the record of an image which is stored in the session image log. See image_record()
+        """        
+        return image_record(image, number=number, run=run)
+    
+    def add_product(self, kind:str, array:np.ndarray, record:dict|None=None) -> Path|None:
+        """Add a derived product (e.g. an HDR frame made from several images) to the session.
+        The array is saved to products/[kind]_[number].npy in the session directory, and a record
+        of it is appended to the session's product log (products.jsonl).
+
+        Args:
+            kind (str): Kind of product e.g. "hdr"
+            array (np.ndarray): Product array
+            record (dict | None, optional): Additional fields to record, e.g. the source image numbers. Defaults to None.
+
+        Returns:
+            Path|None: Path of the saved array, or None if unsuccessful
+        """        
         try:
+            session_path = self.directory_path / self.name.replace(' ', '_')
+            product_num = sum(1 for _ in session_log.iter_products(session_path, kind=kind)) + 1
+            product_path = session_path / session_log.PRODUCT_DIR / f"{kind}_{str(product_num).rjust(3, '0')}.npy"
+            product_path.parent.mkdir(parents=True, exist_ok=True)
+            np.save(product_path, array)
+            
+            product_info = {"kind": kind,
+                            "number": product_num,
+                            "time": datetime.now().strftime(PRETTY_FORMAT),
+                            "file": str(product_path.relative_to(session_path)),
+                            "shape": list(array.shape),
+                            "dtype": str(array.dtype)}
+            if record is not None:
+                product_info.update(record)
+            session_log.append_product(session_path, product_info)
+            return product_path
+        except Exception as e:
+            traceback.print_exception(e)
+            return None
+    
+    def flush_previews(self) -> None:
+        """Wait until the previews of every added image have been saved
+        """        
+        if self._preview_worker is not None:
+            self._preview_worker.flush()
+    
+    def write_to_log(self) -> bool:
+        """Write the session header. Images are not included as they are appended
+        to the image log as they are added.
 
-            return write_json(self.log, self.directory_path)
+        Returns:
+            bool: True if successful, otherwise False
+        """        
+        try:
+            return session_log.write_header(self.log, self.directory_path / self.name.replace(' ', '_'))
         except Exception as e:
             traceback.print_exc(e)
             return False    
         
-    def output(self, output) -> bool:
+    def view(self) -> session_log.Session_View:
+        """Get a read-only view of the session for reading image records
+
+        Returns:
+            session_log.Session_View: Session view
+        """        
+        self.image_log.sync()
+        return session_log.Session_View(self.directory_path / self.name.replace(' ', '_'))
+        
+    def export_log(self) -> bool:
+        """Export the session to the single file log.json format
+
+        Returns:
+            bool: True if successful, otherwise False
+        """        
         try:
-            with open(self.directory_path / f"{self.name.replace(' ', '_')}" / "output.txt", "a") as session_output_file:
-                session_output_file.write(output + '\n')
-                        
+            self.image_log.sync()
+            with metrics.stage("export log"):
+                session_log.export_json(self.directory_path / self.name.replace(' ', '_'))
+            return True
+        except Exception as e:
+            traceback.print_exception(e)
+            return False
+    
+    def close(self) -> None:
+        """Sync the image log and histograms to disk and close them, finish the queued previews, and stop writing to the session output file
+        """        
+        try:
+            self.image_log.close()
+            if self._histogram_writer is not None:
+                self._histogram_writer.close()
+            if self._preview_worker is not None:
+                self._preview_worker.close()
+            metrics.gauge_function("log_queue_depth", None)
+            self.session_log.close()
+        except Exception as e:
+            traceback.print_exception(e)
+        
+    def output(self, output:str, level:int=logging.INFO, stage:str|None=None, frame:int|None=None) -> bool:
+        """Write a line to the session output file
+
+        Args:
+            output (str): Line to write
+            level (int, optional): Logging level. Defaults to logging.INFO.
+            stage (str | None, optional): Stage of processing e.g. "capture". Defaults to the current stage.
+            frame (int | None, optional): Image number. Defaults to the current frame.
+
+        Returns:
+            bool: True if successful, otherwise False
+        """        
+        try:
+            log.log(level, output, extra={"stage": stage, "frame": frame})
             return True
         except Exception as e:
             traceback.print_exc(e)
             return False
     
-    def run_and_log(self, function):
+    def run_and_log(self, function, stage:str="capture", frame:int|None=None):
+        """Run a function, recording anything it logs with the given stage and frame number.
+
+        Args:
+            function (callable): Function to run
+            stage (str, optional): Stage recorded with log messages. Defaults to "capture".
+            frame (int | None, optional): Frame number recorded with log messages. Defaults to None.
+
+        Returns:
+            The return value of the function, or False if it raised an exception
+        """        
         try:
-            with open(self.directory_path / f"{self.name.replace(' ', '_')}" / "output.txt", "a") as session_output_file:
-                with redirect_output(session_output_file):
-                    return function()
+            with session_logging.log_context(stage=stage, frame=frame):
+                return function()
                         
         except Exception as e:
             traceback.print_exc(e)
@@ -145,10 +296,13 @@ class Session:
         print(f"    Data location: {self.directory_path}")
         print("         Latitude:", self.coords[0])
         print("        Longitude:", self.coords[1])
-        print(" Number of images:", len(self.log['images']))              
+        print(" Number of images:", self.image_count)              
          
              
 def write_json(log:dict, directory:Path) -> bool:
+    """Write a complete session log (including images) to log.json in a single file.
+    Sessions are no longer stored this way, see Session.export_log.
+    """    
     try:
         with open(directory / f"{log['session'].replace(' ', '_')}" / "log.json", "w") as session_log_file:
             json.dump(log, session_log_file, indent=4, ensure_ascii=False)
@@ -298,7 +452,58 @@ def get_valid_name(name:str|None=None) -> str:
                      
     
         
-def start_session(name:str|None=None, coords:tuple[float|None] = (None,None), start_time:datetime|None = None, directory:str|None=None):
+def image_record(image:cam_image.Cam_Image|cam_image.Frame_Record, number:int|None=None, run:int|None=None) -> dict:
+    """Build the record of an image which is stored in a session image log
+
+    Args:
+        image (cam_image.Cam_Image | cam_image.Frame_Record): Image, or the record of a released image
+        number (int | None, optional): Image number in the session. Defaults to None.
+        run (int | None, optional): Routine run the image was captured in. Defaults to None.
+
+    Returns:
+        dict: Image record
+    """        
+    image_info = {"number" : number,
+                  "time" : image.time_string(PRETTY_FORMAT),
+                  "integration (microseconds)" : image.integration_time,
+                  "integration (seconds)": image.integration_time/1000000,
+                  "gain (dB)" : image.gain,
+                  "depth (m)" : image.depth,
+                  "device temp (°C)": image.temp,
+                  "format": image.format,
+                  "inner fraction white": image.inner_fraction_white,
+                  "inner_pixel_averages:":str(image.inner_avgs),
+                  "outer fraction white": image.outer_fraction_white,
+                  "outer_pixel_averages" : str(image.outer_avgs),
+                  "corner fraction white": image.corner_fraction_white,
+                  "corner_pixel_averages" : str(image.corner_avgs),
+                  "unscaled absolute luminance": str(image.unscaled_absolute_luminance),
+                  "relative luminance": str(image.relative_luminance),
+                  "radiance distribution": radiance.table_record(image.radiance_table)}
+    
+    if image.outer_raw_avgs is not None:
+        image_info["outer raw averages"] = list(image.outer_raw_avgs)
+    
+    if image.calibration is not None:
+        image_info["calibration"] = image.calibration
+    
+    if image.dark_offset is not None:
+        image_info["dark model offset"] = image.dark_offset
+    
+    if image.defects_corrected is not None:
+        image_info["defects corrected"] = image.defects_corrected
+    
+    if image.irradiance is not None:
+        image_info["irradiance"] = image.irradiance
+    
+    #Record which routine run (run_[number].npy) the image belongs to
+    if run is not None:
+        image_info["run"] = run
+    
+    return image_info
+
+
+def start_session(name:str|None=None, coords:tuple[float|None] = (None,None), start_time:datetime|None = None, directory:str|None=None, index:session_index.Session_Index|None=None):
     
     name = get_valid_name(name)
             
@@ -312,33 +517,31 @@ def start_session(name:str|None=None, coords:tuple[float|None] = (None,None), st
         directory = get_directory()
         
 
-    session = Session(name, coords, start_time, directory)
+    session = Session(name, coords, start_time, directory, index=index)
     
     print(f"Created Session: '{session.name}'")
     session.print_info()
     
     return session 
 
-def from_file(path:str|Path) -> Session:
+def from_file(path:str|Path, index:session_index.Session_Index|None=None) -> Session:
     """Open Session:
-        Open a session from a log file
+        Open a session from its directory. The session header is read and the image records
+        are streamed from the image log (or from log.json for sessions saved in the old format).
 
     Args:
-        log_file (str): path to log session
+        path (str|Path): path to session directory
+        index (Session_Index, optional): Session index to record new images in. Defaults to None.
 
     Returns:
         Session: A session object with details matching those in log file
     """    
     try:
-        log_file = Path(path) / "log.json"
-        if not log_file.exists():
+        session_dict = session_log.read_header(path)
+        if session_dict is None:
             print("Session does not exist")
             return None
         
-        session_dict = {}
-        with open(log_file, mode="r") as file:
-            session_dict = json.load(file)
-        
         name = session_dict["session"]
         start_time = datetime.strptime(session_dict["start_time"], "%Y-%m-%d %H:%M:%S")
         coord_str = session_dict["coords"]
@@ -351,8 +554,15 @@ def from_file(path:str|Path) -> Session:
                 
         coords = tuple(coords)
         
+        #Image records are only loaded for sessions in the legacy format, so they can be converted when an image is added
+        images = None
+        if not (Path(path) / session_log.IMAGE_LOG_FILE).exists():
+            images = list(session_log.iter_records(path))
+        
         path = session_dict["path"]
-        session = Session(name=name, start_time=start_time, coords=coords, directory=path, images=session_dict['images'])
+        session = Session(name=name, start_time=start_time, coords=coords, directory=path, images=images, index=index)
+        #Sessions from older versions have no geometry recorded
+        session.log["geometry"] = session_dict.get("geometry")
         
         print("Opened session:")
         session.print_info()
@@ -362,4 +572,4 @@ def from_file(path:str|Path) -> Session:
     
     except Exception as e:
         traceback.print_exc(e)
-        return None
\ No newline at end of file
+        return None
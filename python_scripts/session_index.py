@@ -0,0 +1,429 @@
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+import traceback
+import json
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+import session_log
+
+load_dotenv()
+
+DATA_DIR = Path(os.environ.get("DATA_DIRECTORY"))
+INDEX_FILE = "session_index.sqlite"
+PRETTY_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+#Image columns which can be used to filter queries, and the image record key each is read from
+IMAGE_COLUMNS = {"number": "number",
+                 "time": "time",
+                 "integration_s": "integration (seconds)",
+                 "gain_db": "gain (dB)",
+                 "depth_m": "depth (m)",
+                 "temp_c": "device temp (°C)",
+                 "format": "format",
+                 "inner_fraction_white": "inner fraction white",
+                 "outer_fraction_white": "outer fraction white",
+                 "corner_fraction_white": "corner fraction white",
+                 "relative_luminance": "relative luminance",
+                 "unscaled_absolute_luminance": "unscaled absolute luminance",
+                 "run_number": "run"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    start_time TEXT,
+    latitude REAL,
+    longitude REAL,
+    directory_path TEXT,
+    images INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    run_number INTEGER NOT NULL,
+    routine TEXT,
+    start_time TEXT,
+    table_path TEXT,
+    UNIQUE(session_id, run_number)
+);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    number INTEGER NOT NULL,
+    run_number INTEGER,
+    time TEXT,
+    integration_s REAL,
+    gain_db REAL,
+    depth_m REAL,
+    temp_c REAL,
+    format TEXT,
+    inner_fraction_white REAL,
+    outer_fraction_white REAL,
+    corner_fraction_white REAL,
+    relative_luminance REAL,
+    unscaled_absolute_luminance REAL,
+    path TEXT,
+    UNIQUE(session_id, number)
+);
+CREATE INDEX IF NOT EXISTS images_time ON images(time);
+CREATE INDEX IF NOT EXISTS images_integration ON images(integration_s);
+CREATE INDEX IF NOT EXISTS images_gain ON images(gain_db);
+CREATE INDEX IF NOT EXISTS images_relative_luminance ON images(relative_luminance);
+CREATE INDEX IF NOT EXISTS images_absolute_luminance ON images(unscaled_absolute_luminance);
+CREATE TRIGGER IF NOT EXISTS images_count_insert AFTER INSERT ON images BEGIN
+    UPDATE sessions SET images = images + 1 WHERE id = NEW.session_id;
+END;
+CREATE TRIGGER IF NOT EXISTS images_count_delete AFTER DELETE ON images BEGIN
+    UPDATE sessions SET images = images - 1 WHERE id = OLD.session_id;
+END;
+"""
+
+
+def _to_float(value) -> float|None:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_coords(coords) -> tuple[float|None]:
+    if isinstance(coords, str):
+        coords = coords.split(", ")
+    if coords is None or len(coords) != 2:
+        return (None, None)
+    return tuple(None if coord in [None, "None"] else _to_float(coord) for coord in coords)
+
+
+class Session_Index:
+
+    def __init__(self, path:str|Path|None=None) -> None:
+        """Open (or create) the SQLite index of sessions, runs and images.
+        The database uses write-ahead logging so the console and auto-capture processes can use it at the same time.
+
+        Args:
+            path (str | Path | None, optional): Database file. Defaults to session_index.sqlite in the data directory.
+        """
+        if path is None:
+            path = DATA_DIR / INDEX_FILE
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        #The connection is shared between threads (e.g. the console routine thread), so access is locked
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("PRAGMA foreign_keys=ON")
+            self._connection.executescript(_SCHEMA)
+            self._connection.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _execute(self, sql:str, parameters=()) -> list[sqlite3.Row]:
+        with self._lock:
+            with self._connection:
+                return self._connection.execute(sql, parameters).fetchall()
+
+    def add_session(self, name:str, start_time:str, coords:tuple[float|None], directory_path:str|Path) -> int:
+        """Add a session to the index, or update its details if it is already there
+
+        Args:
+            name (str): Session name
+            start_time (str): Start time in "%Y-%m-%d %H:%M:%S" format
+            coords (tuple[float | None]): (Latitude, Longitude)
+            directory_path (str | Path): Directory containing the session directory
+
+        Returns:
+            int: Session id
+        """
+        latitude, longitude = _parse_coords(coords)
+        rows = self._execute("""INSERT INTO sessions (name, start_time, latitude, longitude, directory_path) VALUES (?, ?, ?, ?, ?)
+                                ON CONFLICT(name) DO UPDATE SET start_time=excluded.start_time, latitude=excluded.latitude,
+                                longitude=excluded.longitude, directory_path=excluded.directory_path
+                                RETURNING id""",
+                             (name, start_time, latitude, longitude, str(directory_path)))
+        return rows[0]["id"]
+
+    def session_id(self, name:str) -> int|None:
+        rows = self._execute("SELECT id FROM sessions WHERE name = ?", (name,))
+        return rows[0]["id"] if rows else None
+
+    def sessions(self) -> dict:
+        """Get the details of every session, keyed by session name.
+
+        Returns:
+            dict: {name: {"start_time", "coords", "directory_path", "images"}}
+        """
+        sessions = {}
+        for row in self._execute("SELECT * FROM sessions ORDER BY start_time"):
+            sessions[row["name"]] = {"start_time": row["start_time"],
+                                     "coords": [row["latitude"], row["longitude"]],
+                                     "directory_path": row["directory_path"],
+                                     "images": row["images"]}
+        return sessions
+
+    def add_run(self, session_name:str, run_number:int, routine:str|None=None, table_path:str|Path|None=None, start_time:datetime|None=None) -> None:
+        """Record a run of a routine in a session
+
+        Args:
+            session_name (str): Session name
+            run_number (int): Run number
+            routine (str | None, optional): Name of routine. Defaults to None.
+            table_path (str | Path | None, optional): Path of the run table. Defaults to None.
+            start_time (datetime | None, optional): Start time of the run. Defaults to now.
+        """
+        if start_time is None:
+            start_time = datetime.now()
+        self._execute("""INSERT INTO runs (session_id, run_number, routine, start_time, table_path)
+                         VALUES ((SELECT id FROM sessions WHERE name = ?), ?, ?, ?, ?)
+                         ON CONFLICT(session_id, run_number) DO UPDATE SET routine=excluded.routine, table_path=excluded.table_path""",
+                      (session_name, run_number, routine, start_time.strftime(PRETTY_FORMAT), None if table_path is None else str(table_path)))
+
+    def add_image(self, session_name:str, record:dict, path:str|Path|None=None) -> bool:
+        """Add an image record (as stored in the session image log) to the index.
+        If the image is already in the index its values are updated.
+
+        Args:
+            session_name (str): Session name
+            record (dict): Image record
+            path (str | Path | None, optional): Path of the image file. Defaults to None.
+
+        Returns:
+            bool: True if successful, otherwise False
+        """
+        try:
+            self.add_images(session_name, [record], [path])
+            return True
+        except Exception as e:
+            traceback.print_exception(e)
+            return False
+
+    def add_images(self, session_name:str, records, paths=None) -> int:
+        """Add many image records to the index in a single transaction
+
+        Args:
+            session_name (str): Session name
+            records (Iterable[dict]): Image records
+            paths (Iterable[str|Path|None], optional): Path of each image file. Defaults to None.
+
+        Returns:
+            int: Number of records added or updated
+        """
+        session_id = self.session_id(session_name)
+        if session_id is None:
+            raise KeyError(f"Session '{session_name}' is not in the index")
+
+        columns = list(IMAGE_COLUMNS)
+        rows = []
+        for index, record in enumerate(records):
+            values = [record.get(key) for key in IMAGE_COLUMNS.values()]
+            for position, column in enumerate(columns):
+                if column not in ["time", "format"]:
+                    values[position] = _to_float(values[position])
+            path = None if paths is None else paths[index]
+            rows.append((session_id, *values, None if path is None else str(path)))
+
+        updates = ", ".join(f"{column}=excluded.{column}" for column in columns[1:])
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(f"""INSERT INTO images (session_id, {', '.join(columns)}, path)
+                                                 VALUES ({', '.join('?' * (len(columns) + 2))})
+                                                 ON CONFLICT(session_id, number) DO UPDATE SET {updates}, path=excluded.path""",
+                                             rows)
+        return len(rows)
+
+    def import_session(self, directory:str|Path) -> int:
+        """Import an existing session directory (with either an image log or a legacy log.json)
+
+        Args:
+            directory (str | Path): Session directory
+
+        Returns:
+            int: Number of images imported
+        """
+        directory = Path(directory)
+        header = session_log.read_header(directory)
+        if header is None:
+            raise FileNotFoundError(f"No session found at '{directory}'")
+
+        name = header["session"]
+        self.add_session(name, header.get("start_time"), header.get("coords"), directory.parent)
+
+        records = list(session_log.iter_records(directory))
+        paths = [directory / f"{name.replace(' ', '_')}_{str(record.get('number')).rjust(3, '0')}.png" for record in records]
+        self.add_images(name, records, paths)
+
+        for table in sorted(directory.glob("run_*.npy")):
+            try:
+                self.add_run(name, int(table.stem.split("_", 1)[1]), table_path=table,
+                             start_time=datetime.fromtimestamp(table.stat().st_ctime))
+            except ValueError:
+                continue
+
+        return len(records)
+
+    def import_all(self, sessions_dir:str|Path|None=None) -> int:
+        """Import every session in the sessions directory, and any sessions listed in the
+        old session_list.json file (which may be stored in other directories).
+
+        Args:
+            sessions_dir (str | Path | None, optional): Directory to search. Defaults to the sessions directory in the data directory.
+
+        Returns:
+            int: Number of sessions imported
+        """
+        if sessions_dir is None:
+            sessions_dir = DATA_DIR / "sessions"
+        sessions_dir = Path(sessions_dir)
+
+        directories = []
+        if sessions_dir.exists():
+            directories = [path for path in sessions_dir.iterdir() if path.is_dir()]
+
+        session_list_file = sessions_dir / "session_list.json"
+        if session_list_file.exists():
+            try:
+                with open(session_list_file, mode="r") as session_list:
+                    for name, details in json.load(session_list).items():
+                        directories.append(Path(details["directory_path"]) / name.replace(" ", "_"))
+            except Exception as e:
+                traceback.print_exception(e)
+
+        imported = set()
+        for directory in directories:
+            directory = directory.resolve()
+            if directory in imported:
+                continue
+            try:
+                if session_log.read_header(directory) is not None:
+                    self.import_session(directory)
+                    imported.add(directory)
+            except Exception as e:
+                print(f"Unable to import session at {directory}")
+                traceback.print_exception(e)
+
+        return len(imported)
+
+    def ensure_imported(self) -> None:
+        """Import existing sessions if the index is empty (e.g. the first time it is used)
+        """
+        if len(self._execute("SELECT id FROM sessions LIMIT 1")) == 0:
+            self.import_all()
+
+    def find_images(self, session:str|None=None, since:datetime|str|None=None, until:datetime|str|None=None,
+                    order_by:str="time", limit:int|None=None, **ranges) -> list[dict]:
+        """Find images matching a set of conditions.
+        Ranges are given as column=(minimum, maximum), where either may be None. Both are inclusive.
+
+        e.g all frames with an inner white fraction greater than 0.05 in the last month:
+            index.find_images(since=datetime.now()-timedelta(days=30), inner_fraction_white=(0.05, None))
+
+        Args:
+            session (str | None, optional): Only find images in this session. Defaults to None.
+            since (datetime | str | None, optional): Earliest capture time. Defaults to None.
+            until (datetime | str | None, optional): Latest capture time. Defaults to None.
+            order_by (str, optional): Column to sort by. Defaults to "time".
+            limit (int | None, optional): Maximum number of images to return. Defaults to None.
+            **ranges: Ranges of values for any of the columns in IMAGE_COLUMNS
+
+        Raises:
+            ValueError: If a range or order_by column is not an image column
+
+        Returns:
+            list[dict]: Matching images, each including the session name
+        """
+        conditions = []
+        parameters = []
+
+        if session is not None:
+            conditions.append("sessions.name = ?")
+            parameters.append(session)
+
+        for column, value, operator in [("time", since, ">="), ("time", until, "<=")]:
+            if value is not None:
+                if isinstance(value, datetime):
+                    value = value.strftime(PRETTY_FORMAT)
+                conditions.append(f"images.{column} {operator} ?")
+                parameters.append(value)
+
+        for column, (minimum, maximum) in ranges.items():
+            if column not in IMAGE_COLUMNS:
+                raise ValueError(f"'{column}' is not an image column. Accepted values: {list(IMAGE_COLUMNS)}")
+            if minimum is not None:
+                conditions.append(f"images.{column} >= ?")
+                parameters.append(minimum)
+            if maximum is not None:
+                conditions.append(f"images.{column} <= ?")
+                parameters.append(maximum)
+
+        if order_by not in IMAGE_COLUMNS:
+            raise ValueError(f"'{order_by}' is not an image column. Accepted values: {list(IMAGE_COLUMNS)}")
+
+        sql = "SELECT images.*, sessions.name AS session FROM images JOIN sessions ON sessions.id = images.session_id"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY images.{order_by}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(int(limit))
+
+        return [dict(row) for row in self._execute(sql, parameters)]
+
+
+def main():
+    """Command line tool for the session index.
+    Call from command line with:
+    $> session_index.py import [session directories]...     (imports every session if none are given)
+    $> session_index.py query --days 30 --min inner_fraction_white 0.05
+    """
+    parser = argparse.ArgumentParser(description="Import sessions into, or query, the session index")
+    subparsers = parser.add_subparsers(dest="action", required=True)
+
+    import_parser = subparsers.add_parser("import", help="Import existing sessions")
+    import_parser.add_argument("sessions", nargs="*", help="Session directories. Imports all sessions if not set")
+
+    query_parser = subparsers.add_parser("query", help="Find images")
+    query_parser.add_argument("--session", help="Session name")
+    query_parser.add_argument("--days", type=float, help="Only images captured in this many days before now")
+    query_parser.add_argument("--min", nargs=2, action="append", default=[], metavar=("COLUMN", "VALUE"), help="Minimum value of a column")
+    query_parser.add_argument("--max", nargs=2, action="append", default=[], metavar=("COLUMN", "VALUE"), help="Maximum value of a column")
+    query_parser.add_argument("--limit", type=int, help="Maximum number of images")
+
+    args = parser.parse_args()
+    index = Session_Index()
+
+    if args.action == "import":
+        if len(args.sessions) == 0:
+            print(f"Imported {index.import_all()} sessions")
+        for directory in args.sessions:
+            print(f"Imported {index.import_session(directory)} images from {directory}")
+        return
+
+    ranges = {}
+    for column, value in args.min:
+        ranges[column] = (float(value), ranges.get(column, (None, None))[1])
+    for column, value in args.max:
+        ranges[column] = (ranges.get(column, (None, None))[0], float(value))
+
+    since = None if args.days is None else datetime.now() - timedelta(days=args.days)
+    for image in index.find_images(session=args.session, since=since, limit=args.limit, **ranges):
+        print(f"{image['session']} #{image['number']} {image['time']} | I: {image['integration_s']}s | G: {image['gain_db']}dB | {image['path']}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+        sys.exit(0)
+    except Exception as e:
+        traceback.print_exception(e)
+        sys.exit(1)
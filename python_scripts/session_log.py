@@ -0,0 +1,561 @@
+import argparse
+import json
+import os
+import sys
+import traceback
+from pathlib import Path
+
+import numpy as np
+
+#A session is stored as a small header file holding the session fields, plus an append-only
+#JSON Lines file with one compact record per image. Adding an image only appends one line,
+#so the cost of a capture does not grow with the number of images already in the session.
+#log.json is still available, but only as an export built from these two files.
+
+HEADER_FILE = "session.json"
+IMAGE_LOG_FILE = "images.jsonl"
+OFFSET_INDEX_FILE = "images.idx"
+LEGACY_LOG_FILE = "log.json"
+PRODUCT_LOG_FILE = "products.jsonl"
+PRODUCT_DIR = "products"
+
+#Alongside the image log, images.idx holds the byte offset of each record as a little-endian uint64,
+#so any record can be read without reading the rest of the log, and the number of images is known
+#from the size of the index file.
+OFFSET_DTYPE = np.dtype("<u8")
+
+#Number of appended records between each fsync of the image log
+DEFAULT_FSYNC_INTERVAL = 10
+
+
+class Image_Log:
+
+    def __init__(self, directory:str|Path, fsync_interval:int=DEFAULT_FSYNC_INTERVAL) -> None:
+        """Open (or create) the append-only image log of a session directory.
+
+        Args:
+            directory (str | Path): Session directory containing the image log
+            fsync_interval (int, optional): Number of records appended between each call to os.fsync.
+            Records are always flushed to the OS after each append. Defaults to DEFAULT_FSYNC_INTERVAL.
+        """
+        self.path = Path(directory) / IMAGE_LOG_FILE
+        self.index_path = Path(directory) / OFFSET_INDEX_FILE
+        self.fsync_interval = max(1, int(fsync_interval))
+        self._file = None
+        self._index_file = None
+        self._offset = 0
+        self._unsynced = 0
+
+    def _open(self):
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, mode="a+b")
+            
+            #Drop a final record which was only partly written (e.g. after a power cut)
+            self._file.seek(0, os.SEEK_END)
+            size = self._file.tell()
+            if size > 0:
+                self._file.seek(size-1)
+                if self._file.read(1) != b"\n":
+                    self._file.truncate(last_line_end(self._file, size))
+            self._file.seek(0, os.SEEK_END)
+            self._offset = self._file.tell()
+
+            #Rebuild the offset index if it does not match the log
+            if load_offsets(self.path.parent) is None:
+                write_offsets(self.path.parent, build_offsets(self.path))
+            self._index_file = open(self.index_path, mode="ab")
+        return self._file
+
+    def append(self, record:dict) -> bool:
+        """Append a single image record to the log as one line of compact JSON.
+
+        Args:
+            record (dict): Image record
+
+        Returns:
+            bool: True if the record was written, otherwise False
+        """
+        try:
+            file = self._open()
+            line = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+            file.write(line)
+            file.flush()
+            
+            #The index is written after the record, so it never points past the end of the log
+            self._index_file.write(np.array([self._offset], dtype=OFFSET_DTYPE).tobytes())
+            self._index_file.flush()
+            self._offset += len(line)
+
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_interval:
+                self.sync()
+            return True
+        except Exception as e:
+            traceback.print_exception(e)
+            return False
+
+    def sync(self) -> None:
+        """Force any appended records to disk.
+        """
+        for file in [self._file, self._index_file]:
+            if file is not None:
+                file.flush()
+                os.fsync(file.fileno())
+        self._unsynced = 0
+
+    def close(self) -> None:
+        """Sync and close the log file. The log is reopened automatically by the next append.
+        """
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._index_file.close()
+            self._file = None
+            self._index_file = None
+
+    def exists(self) -> bool:
+        return self.path.exists() and self.path.stat().st_size > 0
+
+
+def last_line_end(log_file, size:int, chunk_size:int=1<<16) -> int:
+    """Find the byte after the last newline of an image log, i.e. the end of its last complete line.
+    The log is read backwards from the end, so only the partly written tail is read.
+
+    Args:
+        log_file: Image log opened in binary mode
+        size (int): Size of the log in bytes
+        chunk_size (int, optional): Number of bytes read at a time. Defaults to 64KiB.
+
+    Returns:
+        int: Offset of the end of the last complete line, or 0 if there are none
+    """
+    end = size
+    while end > 0:
+        start = max(0, end - chunk_size)
+        log_file.seek(start)
+        newline = log_file.read(end - start).rfind(b"\n")
+        if newline >= 0:
+            return start + newline + 1
+        end = start
+    return 0
+
+
+def build_offsets(log_path:str|Path, chunk_size:int=1<<20) -> np.ndarray:
+    """Find the byte offset of the start of each complete line in an image log.
+
+    Args:
+        log_path (str | Path): Path of the image log
+        chunk_size (int, optional): Number of bytes read at a time. Defaults to 1MiB.
+
+    Returns:
+        np.ndarray: Offsets of each line
+    """
+    line_ends = []
+    position = 0
+    with open(log_path, mode="rb") as log_file:
+        while True:
+            chunk = log_file.read(chunk_size)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))
+            line_ends.append(newlines.astype(OFFSET_DTYPE) + position + 1)
+            position += len(chunk)
+
+    line_ends = np.concatenate(line_ends) if line_ends else np.zeros(0, dtype=OFFSET_DTYPE)
+    #Each line starts where the previous one ended
+    return np.concatenate([np.zeros(min(1, line_ends.size), dtype=OFFSET_DTYPE), line_ends[:-1]])
+
+
+def write_offsets(directory:str|Path, offsets:np.ndarray) -> None:
+    """Replace the offset index of a session's image log.
+
+    Args:
+        directory (str | Path): Session directory
+        offsets (np.ndarray): Offset of each record
+    """
+    index_path = Path(directory) / OFFSET_INDEX_FILE
+    temp_path = index_path.with_suffix(".tmp")
+    np.asarray(offsets, dtype=OFFSET_DTYPE).tofile(temp_path)
+    os.replace(temp_path, index_path)
+
+
+def load_offsets(directory:str|Path) -> np.ndarray|None:
+    """Load the offset index of a session's image log, if it matches the log.
+    Only the end of the log is read to check this.
+
+    Args:
+        directory (str | Path): Session directory
+
+    Returns:
+        np.ndarray|None: Memory-mapped offsets, or None if there is no index or it does not match the log
+    """
+    directory = Path(directory)
+    index_path = directory / OFFSET_INDEX_FILE
+    log_path = directory / IMAGE_LOG_FILE
+    if not index_path.exists() or not log_path.exists():
+        return None
+
+    log_size = log_path.stat().st_size
+    index_size = index_path.stat().st_size
+    if index_size % OFFSET_DTYPE.itemsize != 0:
+        return None
+    if index_size == 0:
+        return np.zeros(0, dtype=OFFSET_DTYPE) if log_size == 0 else None
+
+    offsets = np.memmap(index_path, dtype=OFFSET_DTYPE, mode="r")
+    last = int(offsets[-1])
+    if last >= log_size:
+        return None
+
+    #The last offset must be the start of the final line of the log
+    with open(log_path, mode="rb") as log_file:
+        if last > 0:
+            log_file.seek(last-1)
+            if log_file.read(1) != b"\n":
+                return None
+        tail = log_file.read()
+        if tail.count(b"\n") != 1 or not tail.endswith(b"\n"):
+            return None
+
+    return offsets
+
+
+def write_header(header:dict, directory:str|Path) -> bool:
+    """Write the session header file. The file is replaced atomically so a crash
+    while writing cannot leave a half written header.
+
+    Args:
+        header (dict): Session fields (name, start time, coords, path...)
+        directory (str | Path): Session directory
+
+    Returns:
+        bool: True if successful, otherwise False
+    """
+    try:
+        header_path = Path(directory) / HEADER_FILE
+        temp_path = header_path.with_suffix(".tmp")
+        with open(temp_path, mode="w", encoding="utf-8") as header_file:
+            json.dump(header, header_file, indent=4, ensure_ascii=False)
+            header_file.flush()
+            os.fsync(header_file.fileno())
+        os.replace(temp_path, header_path)
+        return True
+    except Exception as e:
+        traceback.print_exception(e)
+        return False
+
+
+def read_header(directory:str|Path) -> dict|None:
+    """Read the session fields of a session directory.
+    Falls back to the fields of a legacy log.json if there is no header file.
+
+    Args:
+        directory (str | Path): Session directory
+
+    Returns:
+        dict|None: Session fields, or None if the directory does not contain a session
+    """
+    directory = Path(directory)
+    header_path = directory / HEADER_FILE
+    if header_path.exists():
+        with open(header_path, mode="r", encoding="utf-8") as header_file:
+            return json.load(header_file)
+
+    legacy_path = directory / LEGACY_LOG_FILE
+    if legacy_path.exists():
+        with open(legacy_path, mode="r", encoding="utf-8") as legacy_file:
+            header = json.load(legacy_file)
+        header.pop("images", None)
+        return header
+
+    return None
+
+
+def iter_records(directory:str|Path):
+    """Stream the image records of a session one at a time.
+    Lines which cannot be parsed (e.g. a final line cut short by a power failure) are skipped.
+    If the session only has a legacy log.json, the images in that are used instead.
+
+    Args:
+        directory (str | Path): Session directory
+
+    Yields:
+        dict: Image record
+    """
+    directory = Path(directory)
+    log_path = directory / IMAGE_LOG_FILE
+
+    if not log_path.exists():
+        legacy_path = directory / LEGACY_LOG_FILE
+        if legacy_path.exists():
+            with open(legacy_path, mode="r", encoding="utf-8") as legacy_file:
+                yield from json.load(legacy_file).get("images", [])
+        return
+
+    with open(log_path, mode="r", encoding="utf-8") as log_file:
+        for line in log_file:
+            line = line.strip()
+            if line == "":
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def append_product(directory:str|Path, record:dict) -> None:
+    """Append the record of a derived product (e.g. an HDR frame) to the product log of a session.
+    Products are added rarely, so the file is opened for each record.
+
+    Args:
+        directory (str | Path): Session directory
+        record (dict): Product record
+    """
+    with open(Path(directory) / PRODUCT_LOG_FILE, mode="a", encoding="utf-8") as product_file:
+        product_file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        product_file.flush()
+        os.fsync(product_file.fileno())
+
+
+def iter_products(directory:str|Path, kind:str|None=None):
+    """Stream the product records of a session
+
+    Args:
+        directory (str | Path): Session directory
+        kind (str | None, optional): Only yield products of this kind. Defaults to None (all products).
+
+    Yields:
+        dict: Product record
+    """
+    product_path = Path(directory) / PRODUCT_LOG_FILE
+    if not product_path.exists():
+        return
+    with open(product_path, mode="r", encoding="utf-8") as product_file:
+        for line in product_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if kind is None or record.get("kind") == kind:
+                yield record
+
+
+def compact(directory:str|Path) -> int:
+    """Compact the image log of a session.
+    Drops unreadable lines and duplicate image numbers (keeping the latest record for each),
+    sorts records by image number, and atomically replaces the log with the result.
+    A session which only has a legacy log.json is converted to the new format.
+
+    Args:
+        directory (str | Path): Session directory
+
+    Returns:
+        int: Number of records in the compacted log
+    """
+    directory = Path(directory)
+
+    if not (directory / HEADER_FILE).exists():
+        header = read_header(directory)
+        if header is None:
+            raise FileNotFoundError(f"No session found at '{directory}'")
+        write_header(header, directory)
+
+    records = {}
+    unnumbered = []
+    for record in iter_records(directory):
+        if "number" in record:
+            records[record["number"]] = record
+        else:
+            unnumbered.append(record)
+
+    return write_records(directory, [records[number] for number in sorted(records)] + unnumbered)
+
+
+def write_records(directory:str|Path, records) -> int:
+    """Atomically replace the image log of a session with a new set of records, and rebuild its offset index.
+    Nothing should be appending to the log while it is replaced.
+
+    Args:
+        directory (str | Path): Session directory
+        records (Iterable[dict]): Image records, in order
+
+    Returns:
+        int: Number of records written
+    """
+    directory = Path(directory)
+    log_path = directory / IMAGE_LOG_FILE
+    temp_path = log_path.with_suffix(".tmp")
+    count = 0
+    with open(temp_path, mode="w", encoding="utf-8") as temp_file:
+        for record in records:
+            temp_file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+            count += 1
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, log_path)
+    write_offsets(directory, build_offsets(log_path))
+
+    return count
+
+
+def export_json(directory:str|Path, output_path:str|Path|None=None) -> Path:
+    """Export a session to the single-file log.json format.
+    Image records are streamed into the file so the whole session is never held in memory.
+
+    Args:
+        directory (str | Path): Session directory
+        output_path (str | Path | None, optional): File to write to. Defaults to log.json in the session directory.
+
+    Returns:
+        Path: Path of the exported file
+    """
+    directory = Path(directory)
+    header = read_header(directory)
+    if header is None:
+        raise FileNotFoundError(f"No session found at '{directory}'")
+
+    if output_path is None:
+        output_path = directory / LEGACY_LOG_FILE
+    output_path = Path(output_path)
+
+    #Read every record before the output is opened, as the output may be the legacy log being read from
+    records = iter_records(directory)
+    if not (directory / IMAGE_LOG_FILE).exists():
+        records = list(records)
+
+    temp_path = output_path.with_suffix(".tmp")
+    with open(temp_path, mode="w", encoding="utf-8") as export_file:
+        header_string = json.dumps(header, indent=4, ensure_ascii=False)
+        export_file.write(header_string[:-2] + ',\n    "images": [')
+        for index, record in enumerate(records):
+            if index > 0:
+                export_file.write(",")
+            record_string = json.dumps(record, indent=4, ensure_ascii=False).replace("\n", "\n        ")
+            export_file.write(f"\n        {record_string}")
+        export_file.write("\n    ]\n}")
+    os.replace(temp_path, output_path)
+
+    return output_path
+
+
+class Session_View:
+
+    def __init__(self, directory:str|Path) -> None:
+        """Read-only view of a session. Image records are read from the image log on demand using
+        the offset index, so opening a session does not depend on how many images it has, and nothing is written.
+        Sessions which only have a legacy log.json are read from that instead.
+
+        Args:
+            directory (str | Path): Session directory
+
+        Raises:
+            FileNotFoundError: If there is no session in the directory
+        """
+        self.directory = Path(directory)
+        self.header = read_header(self.directory)
+        if self.header is None:
+            raise FileNotFoundError(f"No session found at '{self.directory}'")
+
+        self._log_path = self.directory / IMAGE_LOG_FILE
+        self._records = None
+        self._offsets = None
+        if self._log_path.exists():
+            self._offsets = load_offsets(self.directory)
+            if self._offsets is None:
+                #No valid index (e.g. the log was edited by hand). Find the records without writing an index.
+                self._offsets = build_offsets(self._log_path)
+        else:
+            self._records = list(iter_records(self.directory))
+
+    @property
+    def name(self) -> str:
+        return self.header["session"]
+
+    def __len__(self) -> int:
+        if self._records is not None:
+            return len(self._records)
+        return len(self._offsets)
+
+    def _read(self, indices) -> list[dict]:
+        if self._records is not None:
+            return [self._records[i] for i in indices]
+
+        records = []
+        with open(self._log_path, mode="rb") as log_file:
+            for i in indices:
+                log_file.seek(int(self._offsets[i]))
+                records.append(json.loads(log_file.readline()))
+        return records
+
+    def __getitem__(self, index:int|slice) -> dict|list[dict]:
+        if isinstance(index, slice):
+            return self._read(range(*index.indices(len(self))))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Image index out of range")
+        return self._read([index])[0]
+
+    def __iter__(self):
+        for start in range(0, len(self), 100):
+            yield from self[start:start+100]
+
+    def page(self, page_number:int, page_size:int=50) -> list[dict]:
+        """Get a page of image records
+
+        Args:
+            page_number (int): Page number, starting at 0
+            page_size (int, optional): Number of images per page. Defaults to 50.
+
+        Returns:
+            list[dict]: Image records on the page
+        """
+        return self[page_number*page_size:(page_number+1)*page_size]
+
+    def page_count(self, page_size:int=50) -> int:
+        return max(1, -(-len(self) // page_size))
+
+
+def count_records(directory:str|Path) -> int:
+    """Get the number of images in a session
+
+    Args:
+        directory (str | Path): Session directory
+
+    Returns:
+        int: Number of images
+    """
+    return len(Session_View(directory))
+
+
+def main():
+    """Command line tool for maintaining session logs.
+    Call from command line with:
+    $> session_log.py compact [session directory]...
+    $> session_log.py export [session directory]...
+    """
+    parser = argparse.ArgumentParser(description="Compact or export session image logs")
+    parser.add_argument("action", choices=["compact", "export"], help="compact: rewrite the image log. export: write log.json")
+    parser.add_argument("sessions", nargs="+", help="Session directories")
+    args = parser.parse_args()
+
+    failed = False
+    for session_directory in args.sessions:
+        try:
+            if args.action == "compact":
+                count = compact(session_directory)
+                print(f"Compacted {session_directory}: {count} images")
+            else:
+                path = export_json(session_directory)
+                print(f"Exported {session_directory} to {path}")
+        except Exception as e:
+            failed = True
+            print(f"Unable to {args.action} {session_directory}")
+            traceback.print_exception(e)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
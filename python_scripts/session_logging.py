@@ -0,0 +1,179 @@
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+#Logging for sessions.
+#Every module logs to a child of the "triton" logger (see get_logger). When a session is open, its
+#Session_Log puts each record on a queue, and a background thread writes them to the session output
+#file through a buffered file handler which is flushed on a timer and rotated when it gets too large.
+#Nothing on the capture path has to wait for the file, and stdout is never redirected.
+
+LOGGER_NAME = "triton"
+
+RECORD_FORMAT = "%(asctime)s %(levelname)-8s [%(stage)s] #%(frame)s: %(message)s"
+TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+DEFAULT_MAX_BYTES = 5*1024*1024
+DEFAULT_BACKUP_COUNT = 5
+DEFAULT_FLUSH_INTERVAL = 2.0
+BUFFER_SIZE = 64*1024
+
+_stage:ContextVar[str] = ContextVar("stage", default="-")
+_frame:ContextVar[str] = ContextVar("frame", default="-")
+
+
+def get_logger(name:str) -> logging.Logger:
+    """Get the logger for a module. Records logged with it are written to the output file of the open session.
+
+    Args:
+        name (str): Module name
+
+    Returns:
+        logging.Logger: Logger
+    """
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+@contextmanager
+def log_context(stage:str|None=None, frame:int|None=None):
+    """Set the stage and/or frame number recorded with every record logged inside the context
+    (in the current thread).
+
+    Args:
+        stage (str | None, optional): Stage of processing e.g. "capture". Defaults to None (unchanged).
+        frame (int | None, optional): Frame (image) number. Defaults to None (unchanged).
+    """
+    tokens = []
+    if stage is not None:
+        tokens.append((_stage, _stage.set(str(stage))))
+    if frame is not None:
+        tokens.append((_frame, _frame.set(str(frame))))
+    try:
+        yield
+    finally:
+        for variable, token in reversed(tokens):
+            variable.reset(token)
+
+
+class Context_Filter(logging.Filter):
+    """Adds the stage and frame fields to records which were not logged with them in extra={}
+    """
+    def filter(self, record:logging.LogRecord) -> bool:
+        if not hasattr(record, "stage") or record.stage is None:
+            record.stage = _stage.get()
+        if not hasattr(record, "frame") or record.frame is None:
+            record.frame = _frame.get()
+        return True
+
+
+class Buffered_Rotating_File_Handler(logging.handlers.RotatingFileHandler):
+
+    def __init__(self, filename:str|Path, max_bytes:int=DEFAULT_MAX_BYTES, backup_count:int=DEFAULT_BACKUP_COUNT,
+                 flush_interval:float=DEFAULT_FLUSH_INTERVAL) -> None:
+        """A rotating file handler which writes through a large buffer. The buffer is written to the
+        file at most every flush_interval seconds (or immediately for errors), rather than after every record.
+
+        Args:
+            filename (str | Path): Log file
+            max_bytes (int, optional): Size at which the file is rotated. Defaults to DEFAULT_MAX_BYTES.
+            backup_count (int, optional): Number of rotated files to keep. Defaults to DEFAULT_BACKUP_COUNT.
+            flush_interval (float, optional): Maximum time in seconds records are held in the buffer. Defaults to DEFAULT_FLUSH_INTERVAL.
+        """
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+        self._size = 0
+        super().__init__(filename, mode="a", maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+
+    def _open(self):
+        stream = open(self.baseFilename, self.mode, encoding=self.encoding, buffering=BUFFER_SIZE)
+        self._size = os.fstat(stream.fileno()).st_size
+        return stream
+
+    def emit(self, record:logging.LogRecord) -> None:
+        #The file size is tracked here rather than by seeking the stream (as RotatingFileHandler does),
+        #which would write out the buffer for every record
+        try:
+            message = self.format(record)
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0 and self._size > 0 and self._size + len(message) + 1 >= self.maxBytes:
+                self.doRollover()
+            self.stream.write(message + self.terminator)
+            self._size += len(message) + 1
+            if record.levelno >= logging.ERROR:
+                self.force_flush()
+            else:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self) -> None:
+        #Called after every record is written. Only write the buffer to the file if the flush interval has passed.
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.force_flush()
+
+    def force_flush(self) -> None:
+        """Write the buffer to the file now
+        """
+        logging.StreamHandler.flush(self)
+        self._last_flush = time.monotonic()
+
+
+class Session_Log:
+
+    def __init__(self, path:str|Path, level:int=logging.INFO, max_bytes:int=DEFAULT_MAX_BYTES,
+                 backup_count:int=DEFAULT_BACKUP_COUNT, flush_interval:float=DEFAULT_FLUSH_INTERVAL) -> None:
+        """Start logging records from every TRITON module to a session output file.
+
+        Args:
+            path (str | Path): Output file e.g. [session directory]/output.txt
+            level (int, optional): Minimum level of records written. Defaults to logging.INFO.
+            max_bytes (int, optional): Size at which the file is rotated. Defaults to DEFAULT_MAX_BYTES.
+            backup_count (int, optional): Number of rotated files to keep. Defaults to DEFAULT_BACKUP_COUNT.
+            flush_interval (float, optional): Maximum time in seconds records are held before being written. Defaults to DEFAULT_FLUSH_INTERVAL.
+        """
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+
+        self.file_handler = Buffered_Rotating_File_Handler(self.path, max_bytes=max_bytes, backup_count=backup_count, flush_interval=flush_interval)
+        self.file_handler.setFormatter(logging.Formatter(RECORD_FORMAT, TIME_FORMAT))
+
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = logging.handlers.QueueHandler(self.queue)
+        self.queue_handler.setLevel(level)
+        self.queue_handler.addFilter(Context_Filter())
+        self.listener = logging.handlers.QueueListener(self.queue, self.file_handler)
+        self.listener.start()
+
+        #Write buffered records on a timer, so they reach the file even when nothing else is being logged
+        self._stop_flushing = threading.Event()
+        self._flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flush_thread.start()
+
+        logger = logging.getLogger(LOGGER_NAME)
+        logger.setLevel(min(level, logger.getEffectiveLevel()))
+        logger.addHandler(self.queue_handler)
+
+    def _flush_loop(self) -> None:
+        while not self._stop_flushing.wait(self.flush_interval):
+            self.file_handler.force_flush()
+
+    def flush(self) -> None:
+        """Write all buffered records to the file. Records still on the queue are written by the listener thread.
+        """
+        self.file_handler.force_flush()
+
+    def close(self) -> None:
+        """Stop logging to the session file, writing any remaining records
+        """
+        logging.getLogger(LOGGER_NAME).removeHandler(self.queue_handler)
+        self._stop_flushing.set()
+        self.listener.stop()
+        self.file_handler.force_flush()
+        self.file_handler.close()
@@ -0,0 +1,115 @@
+import numpy as np
+
+#Stacking of repeated frames captured with the same settings.
+#The per-pixel mean and variance are updated with each frame using Welford's algorithm, so frames
+#are never held in memory or saved individually. Only the stacked mean and variance frames are kept,
+#with the statistics of each frame.
+
+
+class Frame_Stack:
+
+    def __init__(self) -> None:
+        """Accumulate the per-pixel mean and variance of a stack of raw (Bayer or mono) frames
+        """
+        self.reset()
+
+    def reset(self) -> None:
+        """Clear the accumulators to start a new stack
+        """
+        self.count = 0
+        self.settings : tuple|None = None
+        self.frames : list[dict] = []
+        self._mean : np.ndarray|None = None
+        self._m2 : np.ndarray|None = None
+        self._delta : np.ndarray|None = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def matches(self, integration_time:int, gain:float) -> bool:
+        """Check whether a frame has the same settings as the frames in the stack
+
+        Args:
+            integration_time (int): Integration time in microseconds
+            gain (float): Gain in dB
+
+        Returns:
+            bool: True if the stack is empty or has the same settings
+        """
+        return self.settings is None or self.settings == (integration_time, gain)
+
+    def add(self, raw:np.ndarray, integration_time:int|None=None, gain:float|None=None, record:dict|None=None) -> None:
+        """Add a frame to the stack
+
+        Args:
+            raw (np.ndarray): Raw sensor frame
+            integration_time (int | None, optional): Integration time in microseconds. Defaults to None.
+            gain (float | None, optional): Gain in dB. Defaults to None.
+            record (dict | None, optional): Statistics of the frame to keep with the stack. Defaults to None.
+        """
+        if self._mean is None:
+            self._mean = np.zeros(raw.shape, dtype=np.float64)
+            self._m2 = np.zeros(raw.shape, dtype=np.float64)
+            self._delta = np.empty(raw.shape, dtype=np.float64)
+            self.settings = (integration_time, gain)
+        elif raw.shape != self._mean.shape:
+            raise ValueError(f"Frame shape {raw.shape} does not match the stack {self._mean.shape}")
+
+        self.count += 1
+        #Welford's update: delta = x - mean; mean += delta / n; m2 += delta * (x - mean)
+        #Since x - mean (after the update) = delta * (n-1)/n, this is m2 += (delta/n)^2 * n * (n-1),
+        #which is calculated in a reused buffer so no temporary frames are created
+        n = self.count
+        np.subtract(raw, self._mean, out=self._delta)
+        self._delta /= n
+        self._mean += self._delta
+        np.square(self._delta, out=self._delta)
+        self._delta *= n * (n - 1)
+        self._m2 += self._delta
+
+        if record is not None:
+            self.frames.append(record)
+
+    def mean(self) -> np.ndarray:
+        """Get the per-pixel mean of the stack
+
+        Returns:
+            np.ndarray: float32 mean frame
+        """
+        if self.count == 0:
+            raise ValueError("No frames have been added")
+        return self._mean.astype(np.float32)
+
+    def variance(self) -> np.ndarray:
+        """Get the per-pixel sample variance of the stack (0 for a single frame)
+
+        Returns:
+            np.ndarray: float32 variance frame
+        """
+        if self.count == 0:
+            raise ValueError("No frames have been added")
+        if self.count == 1:
+            return np.zeros(self._m2.shape, dtype=np.float32)
+        return (self._m2 / (self.count - 1)).astype(np.float32)
+
+    def result(self) -> np.ndarray:
+        """Get the mean and variance frames as one array
+
+        Returns:
+            np.ndarray: float32 array of shape (2, height, width) holding the mean and variance frames
+        """
+        return np.stack([self.mean(), self.variance()])
+
+    def record(self) -> dict:
+        """Get a record of the stack to store with the result
+
+        Returns:
+            dict: {"layers", "frame count", "integration (microseconds)", "gain (dB)", "mean noise (std)", "frames": [frame statistics]}
+        """
+        variance = self.variance()
+        return {"layers": ["mean", "variance"],
+                "frame count": self.count,
+                "integration (microseconds)": None if self.settings is None else self.settings[0],
+                "gain (dB)": None if self.settings is None else self.settings[1],
+                "mean noise (std)": float(np.sqrt(variance.mean(dtype=np.float64))),
+                "frames": self.frames}